@@ -0,0 +1,283 @@
+#! /usr/bin/python
+# pycoact/client/store_sqlite.py
+# Copyright 2026, Trinity College Computing Center
+# Last modified: 17 October 2026
+#
+# Local store for SharedTable kept in an SQLite database rather than
+# in an XML file. An XML local store is parsed in full when it is opened
+# and written out in full each time it is saved. This one reads rows
+# only as they are asked for, writes each change to a row as it is made,
+# and saves by committing the transaction.
+#
+# SharedTable opens a local store of either kind (it looks at the first
+# bytes of the file). To the rest of the client library this one looks
+# like the ElementTree of an XML local store: find("rows") and the like
+# return containers which can be iterated over, appended to and removed
+# from, and the rows in them have the tag, text, attrib, get(), and set()
+# of <row> elements. Changes to their text and attributes go straight
+# to the database.
+#
+# Everything in the local store other than the rows (the <repository>
+# with its URL, credentials, and pulled_version) is small, so it is kept
+# as XML in the database and rewritten on each save.
+#
+# Usage: store_sqlite.py convert <local_store.xml> <local_store.db>
+#        store_sqlite.py export <local_store.db> <local_store.xml>
+#
+
+import os
+import json
+import sqlite3
+import weakref
+import xml.etree.cElementTree as ET
+
+sqlite_header = "SQLite format 3\000"
+
+row_containers = ('conflict_rows', 'rows', 'new_rows')
+
+# Attributes of a <row> which have columns of their own. Any others
+# are stored together in the extra column.
+row_columns = ('id', 'version', 'modified')
+
+# Does this file look like an SQLite database?
+def is_sqlite_store(filename):
+	with open(filename, "rb") as f:
+		return f.read(len(sqlite_header)) == sqlite_header
+
+# Attributes of a row in the local store. Changes are written through
+# to the database.
+class RowAttrib(dict):
+	def __init__(self, row, attrib):
+		dict.__init__(self, attrib)
+		self.row = row
+
+	def __setitem__(self, key, value):
+		dict.__setitem__(self, key, value)
+		self.row.store.update_attrib(self.row)
+
+	def __delitem__(self, key):
+		dict.__delitem__(self, key)
+		self.row.store.update_attrib(self.row)
+
+# A <row> in an SQLite local store
+class SqliteRow(object):
+	tag = 'row'
+	tail = '\n'
+
+	def __init__(self, store, seq, attrib, text):
+		self.store = store
+		self.seq = seq
+		self._attrib = RowAttrib(self, attrib)
+		self._text = text
+
+	def get_attrib(self):
+		return self._attrib
+	def set_attrib(self, attrib):
+		self._attrib = RowAttrib(self, attrib)
+		self.store.update_attrib(self)
+	attrib = property(get_attrib, set_attrib)
+
+	def get_text(self):
+		return self._text
+	def set_text(self, text):
+		self._text = text
+		self.store.update_text(self)
+	text = property(get_text, set_text)
+
+	def get(self, key, default=None):
+		return self._attrib.get(key, default)
+
+	def set(self, key, value):
+		self._attrib[key] = value
+
+	def keys(self):
+		return self._attrib.keys()
+
+	def items(self):
+		return self._attrib.items()
+
+# One of <conflict_rows>, <rows>, or <new_rows> in an SQLite local store
+class SqliteContainer(object):
+	def __init__(self, store, tag):
+		self.store = store
+		self.tag = tag
+
+	def __iter__(self):
+		return self.store.iter_rows(self.tag)
+
+	def __len__(self):
+		return self.store.conn.execute("select count(*) from store_rows where container = ?", (self.tag,)).fetchone()[0]
+
+	# Add a copy of a row (an Element or a row from this or another
+	# container) to the end of this container.
+	def append(self, row):
+		self.store.insert_row(self.tag, dict(row.attrib), row.text)
+
+	# Counterpart to ET.SubElement(container, 'row', attrib).text = text
+	def new_row(self, attrib, text):
+		return self.store.insert_row(self.tag, attrib, text)
+
+	def remove(self, row):
+		assert isinstance(row, SqliteRow), "not a row of this local store"
+		self.store.delete_row(self.tag, row)
+
+class SqliteLocalStore(object):
+	def __init__(self, filename):
+		self.filename = filename
+		# A client may be opened in one thread and used in another (as
+		# one of an XML local store may), so long as only one at a time
+		# uses it.
+		self.conn = sqlite3.connect(filename, check_same_thread=False)
+		self.skeleton = ET.XML(self.get_info('skeleton').encode('utf-8'))
+
+		# So that we hand out one object for each row, as an ElementTree
+		# would. Otherwise changes made through one copy of a row would
+		# not be seen through another.
+		self.row_objects = weakref.WeakValueDictionary()
+
+		self.containers = {}
+		for tag in row_containers:
+			self.containers[tag] = SqliteContainer(self, tag)
+
+	@staticmethod
+	def create_tables(conn):
+		conn.execute("create table store_info (name text primary key, value text)")
+		conn.execute("create table store_rows (seq integer primary key autoincrement, container text not null, id integer, version text, modified text, extra text, text text)")
+		conn.execute("create index store_rows_container on store_rows (container, seq)")
+
+	def get_info(self, name):
+		row = self.conn.execute("select value from store_info where name = ?", (name,)).fetchone()
+		if row is None:
+			raise ValueError("%s is not a local store" % self.filename)
+		return row[0]
+
+	#====================================================
+	# The ElementTree interface used by SharedTable
+	#====================================================
+
+	def getroot(self):
+		return self.skeleton
+
+	def find(self, path):
+		if path in self.containers:
+			return self.containers[path]
+		return self.skeleton.find(path)
+
+	# Write the local store out as XML, in the same form as an XML
+	# local store.
+	def write(self, file, encoding=None):
+		root = ET.Element(self.skeleton.tag, dict(self.skeleton.attrib))
+		root.text = self.skeleton.text
+		for child in self.skeleton:
+			if child.tag in self.containers:
+				container = ET.SubElement(root, child.tag)
+				container.text = '\n'
+				container.tail = child.tail
+				for row in self.containers[child.tag]:
+					element = ET.SubElement(container, 'row', dict(row.attrib))
+					element.text = row.text
+					element.tail = '\n'
+			else:
+				root.append(child)
+		ET.ElementTree(root).write(file, encoding=encoding)
+
+	# Make the changes made since the last call permanent.
+	def commit(self):
+		self.conn.execute("update store_info set value = ? where name = 'skeleton'",
+			(ET.tostring(self.skeleton, encoding='utf-8').decode('utf-8'),))
+		self.conn.commit()
+
+	def close(self):
+		self.conn.close()
+
+	#====================================================
+	# Used by the rows and containers
+	#====================================================
+
+	def make_row(self, seq, id, version, modified, extra, text):
+		row = self.row_objects.get(seq)
+		if row is None:
+			attrib = json.loads(extra) if extra else {}
+			if id is not None:
+				attrib['id'] = str(id)
+			if version is not None:
+				attrib['version'] = version
+			if modified is not None:
+				attrib['modified'] = modified
+			row = SqliteRow(self, seq, attrib, text)
+			self.row_objects[seq] = row
+		return row
+
+	def iter_rows(self, container):
+		cursor = self.conn.execute("select seq, id, version, modified, extra, text from store_rows where container = ? order by seq", (container,))
+		for seq, id, version, modified, extra, text in cursor:
+			yield self.make_row(seq, id, version, modified, extra, text)
+
+	@staticmethod
+	def attrib_columns(attrib):
+		id = attrib.get('id')
+		extra = dict([(key, value) for key, value in attrib.items() if key not in row_columns])
+		return (int(id) if id is not None else None,
+			attrib.get('version'),
+			attrib.get('modified'),
+			json.dumps(extra) if extra else None)
+
+	def insert_row(self, container, attrib, text):
+		columns = self.attrib_columns(attrib)
+		cursor = self.conn.execute("insert into store_rows (container, id, version, modified, extra, text) values (?, ?, ?, ?, ?, ?)",
+			(container,) + columns + (text,))
+		return self.make_row(cursor.lastrowid, *(columns + (text,)))
+
+	def update_attrib(self, row):
+		self.conn.execute("update store_rows set id = ?, version = ?, modified = ?, extra = ? where seq = ?",
+			self.attrib_columns(row.attrib) + (row.seq,))
+
+	def update_text(self, row):
+		self.conn.execute("update store_rows set text = ? where seq = ?", (row.text, row.seq))
+
+	def delete_row(self, container, row):
+		self.conn.execute("delete from store_rows where container = ? and seq = ?", (container, row.seq))
+		self.row_objects.pop(row.seq, None)
+
+#=============================================================================
+# Conversion from and to XML local stores
+#=============================================================================
+
+# Create an SQLite local store with the contents of an XML one.
+def convert(xml_filename, db_filename):
+	if os.path.exists(db_filename):
+		raise ValueError("%s already exists" % db_filename)
+	root = ET.parse(xml_filename).getroot()
+
+	conn = sqlite3.connect(db_filename)
+	SqliteLocalStore.create_tables(conn)
+	for tag in row_containers:
+		container = root.find(tag)
+		if container is None:
+			container = ET.SubElement(root, tag)
+			container.tail = '\n'
+		conn.executemany("insert into store_rows (container, id, version, modified, extra, text) values (?, ?, ?, ?, ?, ?)",
+			((tag,) + SqliteLocalStore.attrib_columns(row.attrib) + (row.text,) for row in container))
+		container.clear()
+		container.text = '\n'
+	conn.execute("insert into store_info (name, value) values ('skeleton', ?)",
+		(ET.tostring(root, encoding='utf-8').decode('utf-8'),))
+	conn.commit()
+	conn.close()
+
+# Write the contents of an SQLite local store to an XML one.
+def export(db_filename, xml_filename):
+	store = SqliteLocalStore(db_filename)
+	store.write(xml_filename, encoding='utf-8')
+	store.close()
+
+if __name__ == "__main__":
+	import sys
+	if len(sys.argv) != 4 or sys.argv[1] not in ("convert", "export"):
+		sys.stderr.write("Usage: %s convert <local_store.xml> <local_store.db>\n" % sys.argv[0])
+		sys.stderr.write("       %s export <local_store.db> <local_store.xml>\n" % sys.argv[0])
+		sys.exit(1)
+	if sys.argv[1] == "convert":
+		convert(sys.argv[2], sys.argv[3])
+	else:
+		export(sys.argv[2], sys.argv[3])
@@ -1,10 +1,21 @@
 # pycoact/client/table.py
 # Copyright 2013--2017, Trinity College Computing Center
-# Last modified: 18 January 2017
+# Last modified: 17 October 2026
 
 import xml.etree.cElementTree as ET
 import urllib2
 import os
+import zlib
+import gzip
+import StringIO
+import bisect
+import uuid
+
+from pycoact import stbbin
+from pycoact import csvdelta
+from pycoact import csvschema
+from pycoact.client import store_sqlite
+from pycoact.client import transport
 
 #=============================================================================
 # Client Library
@@ -18,6 +29,14 @@ class SharedTableError(Exception):
 class SharedTableFormatError(SharedTableError):
 	pass
 
+# Compress a request body for sending with Content-Encoding: gzip.
+def gzip_compress(data):
+	f = StringIO.StringIO()
+	gz = gzip.GzipFile(fileobj=f, mode='wb')
+	gz.write(data)
+	gz.close()
+	return f.getvalue()
+
 class SharedTable:
 	def __init__(self, local_filename, table_format="raw", debug=0):
 		self.local_filename = local_filename
@@ -25,28 +44,54 @@ class SharedTable:
 		self.debug_level = debug
 		self.debug(1, "SharedTable.__init__()")
 
-		# Load the local store into an ElementTree
-		self.xml = ET.parse(self.local_filename)
+		# Load the local store into an ElementTree, or open it if it
+		# is kept in SQLite (see store_sqlite.py).
+		self.sqlite_store = store_sqlite.is_sqlite_store(self.local_filename)
+		if self.sqlite_store:
+			self.xml = store_sqlite.SqliteLocalStore(self.local_filename)
+		else:
+			self.xml = ET.parse(self.local_filename)
 
 		# Find the remote repository
 		self.url = self.xml.find("repository/url").text
 		#for i in self.xml.getroot():
 		#	print "<%s>" % i.tag
+		self.xml_repository = self.xml.find("repository")
 		self.xml_pulled_version = self.xml.find("repository/pulled_version")
+		self.xml_schema_version = self.xml.find("repository/schema_version")
 		realm = self.xml.find("repository/realm").text
 		username = self.xml.find("repository/username").text
 		password = self.xml.find("repository/password").text
 
-		# Prepare to authenticate oneself.
-		auth_handler = urllib2.HTTPDigestAuthHandler()
-		auth_handler.add_password(
-			uri=self.url,
-			realm=realm,
-			user=username,
-			passwd=password
-			)
-		self.urlopener = urllib2.build_opener(auth_handler)
-		#urllib2.install_opener(self.urlopener)
+		# Connection to the server, shared with any other SharedTable
+		# using the same repository. It authenticates us with digest
+		# authentication.
+		self.transport = transport.get_transport(self.url, realm, username, password)
+
+		# Set to "binary" to talk to the server in the stbbin format,
+		# which is smaller and quicker to encode and decode (see
+		# bench_wire() in tests/benchmarks.py). XML is the default since
+		# older servers understand nothing else.
+		self.wire_format = "xml"
+
+		# Set to True to push only the changed cells of modified rows of
+		# stbcsv tables and to ask that rows changed only once since our
+		# last pull be sent the same way. See csvdelta.py.
+		self.delta_encoding = False
+
+		# Will be set once the server says it takes compressed requests.
+		self.server_accepts_gzip = False
+
+		# Totals for all of the requests made through post_xml()
+		self.transfer_stats = {
+			'requests': 0,
+			'bytes_sent': 0,
+			'bytes_sent_uncompressed': 0,
+			'bytes_received': 0,
+			'bytes_received_uncompressed': 0,
+			'round_trips': 0,
+			'round_trips_saved': 0,
+			}
 
 		# Find row containers
 		self.xml_conflict_rows = self.find_or_create("conflict_rows")
@@ -59,6 +104,15 @@ class SharedTable:
 		self.read_conflicts = None
 		self.read_new_rows = None
 
+		# Indexes of <rows> and <conflict_rows> by id, the ids of
+		# <rows> in order, and the ids of the modified <rows>. Built by
+		# load_indexes() the first time they are needed and kept up
+		# to date from then on.
+		self.rows_by_id = None
+		self.conflict_rows_by_id = None
+		self.row_ids = None
+		self.modified_ids = None
+
 		self.new_table = False
 
 	# Locate the specified container tag and return a reference to it.
@@ -74,6 +128,124 @@ class SharedTable:
 			obj.tail = '\n'
 		return obj
 
+	# Add a <row> to one of the row containers of the local store
+	# and return it.
+	def new_row(self, container, attrib, text):
+		if self.sqlite_store:
+			return container.new_row(attrib, text)
+		child = ET.SubElement(container, 'row', attrib)
+		child.text = text
+		child.tail = '\n'
+		return child
+
+	#====================================================
+	# Indexes of the rows in the local store
+	#
+	# Rows with ids should be added to <rows> and
+	# <conflict_rows>, changed, removed, and marked as
+	# modified using these functions so that the indexes
+	# (and those of SharedTableCSV) stay correct.
+	#====================================================
+	def load_indexes(self):
+		if self.rows_by_id is None:
+			self.debug(1, "Indexing local store")
+			self.rows_by_id = self.index_rows(self.xml_rows)
+			self.conflict_rows_by_id = self.index_rows(self.xml_conflict_rows)
+			self.row_ids = sorted(self.rows_by_id.keys())
+			self.modified_ids = set([id for id, row in self.rows_by_id.items() if row.attrib.has_key('modified')])
+
+	# Add a row with an id to <rows> and return it.
+	def add_local_row(self, attrib, text):
+		row = self.new_row(self.xml_rows, attrib, text)
+		if self.rows_by_id is not None:
+			id = int(attrib['id'])
+			assert not self.rows_by_id.has_key(id), "Duplicate row id %d" % id
+			self.rows_by_id[id] = row
+			bisect.insort(self.row_ids, id)
+		return row
+
+	# Add a row with an id to <conflict_rows> and return it.
+	def add_conflict_row(self, attrib, text):
+		row = self.new_row(self.xml_conflict_rows, attrib, text)
+		if self.conflict_rows_by_id is not None:
+			self.conflict_rows_by_id[int(attrib['id'])] = row
+		return row
+
+	# Replace our copy of a row of <rows> with a newer version from
+	# the server.
+	def update_local_row(self, row, version, text):
+		row.attrib['version'] = version
+		row.text = text
+
+	def mark_modified(self, row):
+		row.set('modified', '1')
+		if self.modified_ids is not None:
+			self.modified_ids.add(int(row.get('id')))
+
+	# Change the text of a row of <rows> and mark it as modified. If
+	# we are sending deltas, the text of the version which we had from
+	# the server is kept in the base attribute of the row until the
+	# change has been pushed.
+	def modify_row(self, row, text):
+		self.keep_base(row)
+		row.text = text
+		self.mark_modified(row)
+
+	# Mark a row of <rows> for deletion. It stays in the local
+	# store until the server has accepted the deletion.
+	def mark_deleted(self, row):
+		assert self.table_format != "stbcsv" or row.get('id') != '0', "Row with ID 0 may not be deleted."
+		self.keep_base(row)
+		row.set('deleted', '1')
+		self.mark_modified(row)
+
+	def keep_base(self, row):
+		if self.delta_encoding and not row.attrib.has_key('modified'):
+			row.set('base', row.text or "")
+
+	# The text of the version of a row of <rows> which we had from the
+	# server, or None if we have modified it without keeping that.
+	@staticmethod
+	def base_text(row):
+		base = row.get('base')
+		if base is None and not row.attrib.has_key('modified'):
+			base = row.text or ""
+		return base
+
+	# Our modified copy of a row is now based on the version of it in
+	# the conflict row, so that it will replace that version when it
+	# is pushed. This resolves the conflict.
+	def take_conflict_version(self, row, conflict):
+		row.attrib['version'] = conflict.attrib['version']
+		if self.delta_encoding:
+			row.set('base', conflict.text or "")
+		elif row.get('base') is not None:
+			del row.attrib['base']
+		self.remove_conflict_row(conflict)
+
+	def remove_local_row(self, row):
+		if self.rows_by_id is not None:
+			id = int(row.get('id'))
+			del self.rows_by_id[id]
+			del self.row_ids[bisect.bisect_left(self.row_ids, id)]
+			self.modified_ids.discard(id)
+		self.xml_rows.remove(row)
+
+	def remove_conflict_row(self, row):
+		if self.conflict_rows_by_id is not None:
+			del self.conflict_rows_by_id[int(row.get('id'))]
+		self.xml_conflict_rows.remove(row)
+
+	# The server no longer has a row which we have modified. Rather
+	# than lose our changes, we make it a new row.
+	def restore_as_new_row(self, row):
+		self.debug(1, "    restoring row %s as a new row" % row.get('id'))
+		conflict = self.conflict_rows_by_id.get(int(row.get('id')))
+		if conflict is not None:
+			self.remove_conflict_row(conflict)
+		self.new_row(self.xml_new_rows, {}, row.text)
+		self.remove_local_row(row)
+
 	#====================================================
 	# For debugging
 	#====================================================
@@ -105,17 +277,62 @@ class SharedTable:
 	#====================================================
 	# Send an XML request to the server and receive
 	# an XML response.
+	#
+	# If wire_format is "binary", the request and response
+	# go over the wire in the format defined in stbbin.py
+	# rather than as XML text.
+	#
+	# Responses are always requested compressed. Requests
+	# are compressed once the server has said (with an
+	# Accept-Encoding header in a response) that it can
+	# take them that way. Servers which say nothing get
+	# them uncompressed as before.
+	#
+	# A <batch> (see sync_batch()) is sent through the
+	# transport given, which is that of the batch URL.
 	#====================================================
-	def post_xml(self, xml):
-		data = ET.tostring(xml, encoding='utf-8')
+	def post_xml(self, xml, transport=None):
 		self.debug(1, "====== POSTed XML ======")
-		self.debug(1, data)
+		if transport is None:
+			transport = self.transport
+		if self.wire_format == "binary":
+			self.debug(1, ET.tostring(xml, encoding='utf-8'))
+			if xml.tag == 'batch':
+				data = stbbin.encode_batch(xml)
+			else:
+				data = stbbin.encode_tree(xml)
+			content_type = stbbin.content_type
+		else:
+			data = ET.tostring(xml, encoding='utf-8')
+			self.debug(1, data)
+			content_type = 'application/xml'
+
+		headers = {'Content-Type':content_type, 'Accept-Encoding':'gzip'}
+		body = data
+		if self.server_accepts_gzip:
+			body = gzip_compress(data)
+			headers['Content-Encoding'] = 'gzip'
 
-		req = urllib2.Request(self.url, data, {'Content-Type':'application/xml'})
 		try:
-			#http = urllib2.urlopen(req)
-			http = self.urlopener.open(req)
-			resp_text = http.read()
+			try:
+				http = transport.post(body, headers)
+			except urllib2.HTTPError as e:
+				# The server must have changed its mind about
+				# compressed requests. Send it uncompressed.
+				if e.code != 415 or body is data:
+					raise
+				self.server_accepts_gzip = False
+				body = data
+				del headers['Content-Encoding']
+				http = transport.post(body, headers)
+			accept_encoding = http.info().getheader('Accept-Encoding') or ''
+			self.server_accepts_gzip = 'gzip' in [i.strip() for i in accept_encoding.lower().split(',')]
+			resp_body = http.read()
+			content_encoding = http.info().getheader('Content-Encoding')
+			if content_encoding in ('gzip', 'deflate'):
+				resp_text = zlib.decompress(resp_body, 32 + zlib.MAX_WBITS)
+			else:
+				resp_text = resp_body
 			if resp_text == "":
 				raise SharedTableError("HTTP response is empty.")
 		except urllib2.HTTPError as e:
@@ -123,10 +340,33 @@ class SharedTable:
 		except Exception as e:
 			raise SharedTableError(str(e))
 
+		# Keep count of the bytes sent and received, both as
+		# they were and as they went over the wire.
+		self.transfer_stats['requests'] += 1
+		self.transfer_stats['bytes_sent'] += len(body)
+		self.transfer_stats['bytes_sent_uncompressed'] += len(data)
+		self.transfer_stats['bytes_received'] += len(resp_body)
+		self.transfer_stats['bytes_received_uncompressed'] += len(resp_text)
+		self.transfer_stats['round_trips'] += http.round_trips
+		self.transfer_stats['round_trips_saved'] += http.round_trips_saved
+		self.debug(1, "Sent %d bytes (%d uncompressed), received %d bytes (%d uncompressed)" \
+			% (len(body), len(data), len(resp_body), len(resp_text)))
+		self.debug(1, "%d round trips, %d saved by connection reuse and preemptive authentication" \
+			% (http.round_trips, http.round_trips_saved))
+
+		if http.info().gettype() == stbbin.content_type:
+			if resp_text.startswith(stbbin.batch_magic):
+				resp = stbbin.decode_batch(resp_text)
+			else:
+				resp = stbbin.decode(resp_text)
+			resp_text = ET.tostring(stbbin.to_element(resp), encoding='utf-8') if self.debug_level >= 1 else None
+		else:
+			resp = ET.XML(resp_text)
+
 		self.debug(1, "====== Response XML ======")
 		self.debug(1, resp_text)
 
-		return ET.XML(resp_text)
+		return resp
 
 	#====================================================
 	# Save the current state of the local store to file.
@@ -134,6 +374,12 @@ class SharedTable:
 	def save(self):
 		self.debug(1, "SharedTable.save(): save to \"%s\"..." % self.local_filename)
 
+		# Changes to the rows of an SQLite local store are already
+		# in the database. They need only be committed.
+		if self.sqlite_store:
+			self.xml.commit()
+			return
+
 		# MS-DOS naming scheme
 		(base, ext) = os.path.splitext(self.local_filename)
 		temp = "%s.tmp" % base
@@ -164,42 +410,391 @@ class SharedTable:
 		for row in list(self.xml_new_rows):
 			self.xml_new_rows.remove(row)
 		self.xml_pulled_version.text = '0'
+		continuation = self.xml_repository.find('continuation')
+		if continuation is not None:
+			self.xml_repository.remove(continuation)
+		if self.xml_schema_version is not None:
+			self.xml_repository.remove(self.xml_schema_version)
+			self.xml_schema_version = None
+		self.rows_by_id = None
+		self.conflict_rows_by_id = None
+		self.row_ids = None
+		self.modified_ids = None
 
 	#====================================================
-	# Pull the latest changes down from the server.
+	# Start over after the server has told us that we
+	# have missed the deletion of rows (because it has
+	# since purged the tombstones). Rows which we have
+	# not modified are dropped, as by clear_local_store(),
+	# and will come back in the next pull if they still
+	# exist. Those which we have modified are kept but
+	# marked, and any which the pull does not bring back
+	# are restored as new rows (see finish_reset()).
 	#====================================================
-	def pull(self):
-		self.debug(1, "SharedTable.pull()")
+	def reset_local_store(self):
+		self.debug(1, "SharedTable.reset_local_store()")
+		self.load_indexes()
+		for row in list(self.xml_conflict_rows):
+			self.remove_conflict_row(row)
+		for id in list(self.row_ids):
+			row = self.rows_by_id[id]
+			if id in self.modified_ids:
+				row.set('reset', '1')
+			else:
+				self.remove_local_row(row)
+		self.xml_pulled_version.text = '0'
+		continuation = self.xml_repository.find('continuation')
+		if continuation is not None:
+			self.xml_repository.remove(continuation)
+
+	def finish_reset(self):
+		self.load_indexes()
+		for id in sorted(self.modified_ids):
+			row = self.rows_by_id[id]
+			if row.get('reset') is not None:
+				if row.get('deleted') is not None:
+					self.remove_local_row(row)
+				else:
+					self.restore_as_new_row(row)
+
+	#====================================================
+	# Changes to the columns of stbcsv tables
+	#
+	# The server tells us of these as schema operations
+	# (see csvschema.py) in its responses to our pulls,
+	# pushes, and syncs. Each is applied to all of our
+	# copies of the rows in one pass. The version of the
+	# last one applied is kept in <schema_version> in
+	# the local store and sent with each request so that
+	# the server knows which we still need.
+	#====================================================
+
+	# Local stores from before schema operations have copies of the
+	# rows with the columns they had at pulled_version. An empty one
+	# has none.
+	def schema_version(self):
+		if self.xml_schema_version is not None:
+			return int(self.xml_schema_version.text)
+		if int(self.xml_pulled_version.text) > 0:
+			return int(self.xml_pulled_version.text)
+		return None
+
+	def add_schema_version(self, top):
+		if self.table_format == 'stbcsv':
+			schema_version = self.schema_version()
+			if schema_version is not None:
+				child = ET.SubElement(top, 'schema_version')
+				child.text = str(schema_version)
+				child.tail = '\n'
+
+	# Apply the schema operations in a response which we have yet to
+	# apply and note how far we now are. Returns the number applied.
+	def accept_schema(self, resp):
+		if self.table_format != 'stbcsv':
+			return 0
+		schema_version = self.schema_version()
+		operations = []
+		for op in resp.findall('schema_op'):
+			tver = int(op.get('tver'))
+			if schema_version is None or tver > schema_version:
+				operations.append((tver, op.get('op'), int(op.get('position')), op.get('name')))
+		if len(operations) > 0:
+			self.apply_schema_ops(operations)
+		latest = resp.find('schema_version')
+		if latest is not None:
+			latest = latest.text
+		elif len(operations) > 0:
+			latest = str(operations[-1][0])
+		if latest is not None:
+			if self.xml_schema_version is None:
+				self.xml_schema_version = ET.SubElement(self.xml_repository, 'schema_version')
+				self.xml_schema_version.tail = '\n'
+			self.xml_schema_version.text = latest
+		return len(operations)
+
+	def apply_schema_ops(self, operations):
+		self.debug(1, "Applying schema operations: %s" % str(operations))
+		for container in (self.xml_rows, self.xml_conflict_rows, self.xml_new_rows):
+			for row in list(container):
+				header = container is self.xml_rows and row.get('id') == '0'
+				row.text = csvschema.apply_ops(row.text, operations, header)
+				base = row.get('base')
+				if base is not None:
+					row.set('base', csvschema.apply_ops(base, operations))
+
+	# Ask the server to make schema operations, a list of (op, position,
+	# name), on the table. They come back to us, along with any others
+	# which we have yet to apply, and are applied like them. If there
+	# were any such others, the positions may have been wrong, so the
+	# server does nothing and we return False. Otherwise we return True.
+	def alter(self, operations):
+		self.debug(1, "SharedTable.alter()")
+		assert self.table_format == 'stbcsv', "Only stbcsv tables have columns"
+		if self.schema_version() is None:
+			raise SharedTableError("The table must be pulled before its columns are changed.")
 
 		# Build XML request
 		top = ET.Element('request')
 		top.text = '\n'
 		child = ET.SubElement(top, 'type')
-		child.text = 'pull'
-		child.tail = '\n'
-		child = ET.SubElement(top, 'pulled_version')
-		child.text = self.xml_pulled_version.text
+		child.text = 'alter'
 		child.tail = '\n'
+		self.add_schema_version(top)
+		for op, position, name in operations:
+			child = ET.SubElement(top, 'schema_op')
+			child.set('op', op)
+			child.set('position', str(position))
+			if name is not None:
+				child.set('name', name)
+			child.tail = '\n'
 
 		# Send request and parse the response
 		resp = self.post_xml(top)
+		self.accept_schema(resp)
+		result = resp.find('result').text
+		if result == "FORMAT_CONFLICT":
+			return False
+		elif result != "OK":
+			raise SharedTableError
+		return True
+
+	#====================================================
+	# Filtered pulls of stbcsv tables
+	#
+	# A local store may hold only the rows which pass a
+	# filter, such as those of one territory. The filter
+	# is kept in the <repository> as one or more <filter
+	# column="..." op="..." value="..." />, all of which
+	# a row must pass, and is sent with each pull and
+	# sync. The server must have been told that the
+	# columns may be filtered on (see add_filter_column()
+	# in server/table.py).
+	#
+	# Rows which stop passing the filter come to us as
+	# <row filtered="1"> and are dropped as if they had
+	# been deleted (see merge_rows()).
+	#====================================================
+
+	# The filter as a list of (column, op, value)
+	def get_filter(self):
+		return [(f.get('column'), f.get('op', '='), f.get('value', '')) for f in self.xml_repository.findall('filter')]
+
+	# Set the filter to a list of (column, op, value). Since the rows
+	# we have were picked by the old one, we must start over and pull
+	# them all again, which we cannot do while we have changes to them
+	# which we have yet to push.
+	def set_filter(self, filters):
+		self.debug(1, "SharedTable.set_filter(%s)" % str(filters))
+		assert self.table_format == 'stbcsv', "Only stbcsv tables can be filtered"
+		filters = [(column, op, value) for column, op, value in filters]
+		if filters == self.get_filter():
+			return
+		self.load_indexes()
+		if len(self.modified_ids) > 0:
+			raise SharedTableError("Changes must be pushed before the filter is changed.")
+		for f in self.xml_repository.findall('filter'):
+			self.xml_repository.remove(f)
+		for column, op, value in filters:
+			child = ET.SubElement(self.xml_repository, 'filter', column=column, op=op, value=value)
+			child.tail = '\n'
+		if int(self.xml_pulled_version.text) > 0 or self.xml_repository.find('continuation') is not None:
+			self.reset_local_store()
+
+	def add_filter(self, top):
+		for f in self.xml_repository.findall('filter'):
+			child = ET.SubElement(top, 'filter', dict(f.attrib))
+			child.tail = '\n'
+
+	# Add to a pull or sync request the <client_id> by which the server
+	# tells this copy of the table apart from any others which the same
+	# user has on other devices when it notes how far each has pulled
+	# (see server/meta.py). It is made up the first time it is needed
+	# and kept in the <repository>.
+	def add_client_id(self, top):
+		client_id = self.xml_repository.find('client_id')
+		if client_id is None:
+			client_id = ET.SubElement(self.xml_repository, 'client_id')
+			client_id.text = uuid.uuid4().hex
+			client_id.tail = '\n'
+		child = ET.SubElement(top, 'client_id')
+		child.text = client_id.text
+		child.tail = '\n'
+
+	#====================================================
+	# Pull the latest changes down from the server.
+	#
+	# If page_size is given, the server sends the changes
+	# in pages of no more than that many rows and the
+	# local store is saved after each page along with
+	# the position reached. If the connection is lost,
+	# the next pull() picks up from that position rather
+	# than starting over.
+	#
+	# If wait is given and there are no changes, the
+	# server waits up to that many seconds for some
+	# before it answers. Servers which cannot wait
+	# answer at once.
+	#
+	# If the server answers with a <reset>, we have
+	# missed deletions and must pull everything again.
+	# See reset_local_store().
+	#
+	# If delta_encoding is set, we ask for deltas. If
+	# any of them do not fit our copies of the rows,
+	# the same page is asked for again without them.
+	#
+	# Schema operations are applied before the rows
+	# are merged, since the rows come with the columns
+	# which the table has now.
+	#====================================================
+	def pull(self, page_size=None, wait=None):
+		self.debug(1, "SharedTable.pull()")
+
+		count_changes = 0
+		count_conflicts = 0
+		deltas = self.delta_encoding and self.table_format == 'stbcsv'
+
+		while True:
+			# Build XML request
+			top = ET.Element('request')
+			top.text = '\n'
+			child = ET.SubElement(top, 'type')
+			child.text = 'pull'
+			child.tail = '\n'
+			child = ET.SubElement(top, 'pulled_version')
+			child.text = self.xml_pulled_version.text
+			child.tail = '\n'
+			if page_size is not None:
+				child = ET.SubElement(top, 'page_size')
+				child.text = str(page_size)
+				child.tail = '\n'
+			if wait is not None:
+				child = ET.SubElement(top, 'wait')
+				child.text = str(wait)
+				child.tail = '\n'
+			if deltas:
+				child = ET.SubElement(top, 'deltas')
+				child.text = '1'
+				child.tail = '\n'
+			self.add_schema_version(top)
+			self.add_filter(top)
+			self.add_client_id(top)
+			continuation = self.xml_repository.find('continuation')
+			if continuation is not None:
+				self.debug(1, "Resuming pull at tver=%s, id=%s" % (continuation.get('tver'), continuation.get('id')))
+				child = ET.SubElement(top, 'continuation')
+				child.attrib = dict(continuation.attrib)
+				child.tail = '\n'
+
+			# Send request and parse the response
+			resp = self.post_xml(top)
+
+			if resp.find('reset') is not None:
+				self.reset_local_store()
+				continue
+
+			self.accept_schema(resp)
+
+			# Take the received rows and use them to update our local copy
+			page_changes, page_conflicts = self.merge_rows(resp.find('rows'))
+			count_changes += page_changes
+			count_conflicts += page_conflicts
+			if len(self.unapplied_deltas) > 0:
+				self.debug(1, "Deltas for rows %s did not fit, pulling the page again" % str(self.unapplied_deltas))
+				deltas = False
+				continue
+			deltas = self.delta_encoding and self.table_format == 'stbcsv'
+
+			resp_continuation = resp.find('continuation')
+			if resp_continuation is None:
+				# Copy the version number from the response to the local store.
+				self.xml_pulled_version.text = resp.find('version').text
+				if continuation is not None:
+					self.xml_repository.remove(continuation)
+				self.finish_reset()
+				if page_size is not None:
+					self.save()
+				break
+
+			# There are more pages. Every row last changed before the
+			# tver of the continuation has now been received, so we can
+			# say that we have pulled the version before it even if we
+			# never get the rest.
+			tver = int(resp_continuation.get('tver'))
+			if tver - 1 > int(self.xml_pulled_version.text):
+				self.xml_pulled_version.text = str(tver - 1)
+			if continuation is None:
+				continuation = ET.SubElement(self.xml_repository, 'continuation')
+				continuation.tail = '\n'
+			continuation.attrib = dict(resp_continuation.attrib)
+			self.save()
+
+		assert count_changes >= count_conflicts, "count_changes=%d, count_conflicts=%d" % (count_changes, count_conflicts)
+		return count_changes, count_conflicts
+
+	#====================================================
+	# Take <row>s received from the server and use them
+	# to update our local copy.
+	#
+	# Rows with deleted="1" are tombstones. A row which
+	# the server has deleted is removed from our copy
+	# unless we have modified it, in which case it is
+	# restored as a new row. If the server has changed a
+	# row which we have deleted, its change wins and our
+	# deletion is dropped.
+	#
+	# Rows with delta="1" are turned back into whole rows
+	# by applying the delta to our copy of the version
+	# before. Those for which we do not have it are left
+	# out and their ids put in unapplied_deltas.
+	#
+	# Rows with filtered="1" no longer pass our filter
+	# (see set_filter()) and are treated as tombstones.
+	#====================================================
+	def merge_rows(self, rows):
 
 		# Index the rows already in our copy.
-		conflict_rows_by_id = self.index_rows(self.xml_conflict_rows)
-		rows_by_id = self.index_rows(self.xml_rows)
+		self.load_indexes()
+		conflict_rows_by_id = self.conflict_rows_by_id
+		rows_by_id = self.rows_by_id
 
 		# Take the received rows and use them to update our local copy
 		count_changes = 0
 		count_conflicts = 0
-		for row in resp.find('rows'):
+		self.unapplied_deltas = []
+		for row in rows:
 			assert row.tag == 'row'
 			id = int(row.get('id'))
 			version = row.get('version')
 			self.debug(2, "Received row (id=%d, version=%s): %s" % (id, version, row.text))
 			assert self.table_format != "stbcsv" or id != 0 or int(version) == 1, "Row with ID 0 may not advance beyond version 1."
 
+			if row.get('delta') is not None:
+				text = self.expand_delta(id, int(version), row.text)
+				if text is None:
+					self.debug(2, "  Delta does not fit")
+					self.unapplied_deltas.append(id)
+					continue
+				del row.attrib['delta']
+				row.text = text
+
+			# deleted on the server or no longer passes our filter
+			if row.get('deleted') is not None or row.get('filtered') is not None:
+				existing = rows_by_id.get(id)
+				if existing is None:
+					self.debug(2, "  Deleted or filtered row which we do not have")
+				else:
+					self.debug(2, "  Deleted on server" if row.get('deleted') is not None else "  Filtered out on server")
+					count_changes += 1
+					if existing.attrib.has_key('modified') and existing.get('deleted') is None:
+						self.restore_as_new_row(existing)
+					else:
+						if conflict_rows_by_id.has_key(id):
+							self.remove_conflict_row(conflict_rows_by_id[id])
+						self.remove_local_row(existing)
+
 			# already known to be in conflict
-			if conflict_rows_by_id.has_key(id):
+			elif conflict_rows_by_id.has_key(id):
 				self.debug(2, "  Known conflict")
 				#count_conflicts += 1	# do this below only if also a change
 				existing = conflict_rows_by_id[id]
@@ -212,35 +807,67 @@ class SharedTable:
 			# If this row is in the repository,
 			elif rows_by_id.has_key(id):
 				existing = rows_by_id[id]
+				if existing.get('reset') is not None:		# still on the server after a reset
+					del existing.attrib['reset']
 				if id == 0 and self.table_format == "stbcsv":
 					if existing.text != row.text:
 						raise SharedTableFormatError
 				elif version == existing.get('version'):
 					self.debug(2, "  Not changed on server")
+				elif existing.get('deleted') is not None:
+					self.debug(2, "  Changed on server, deletion dropped")
+					count_changes += 1
+					del existing.attrib['deleted']
+					del existing.attrib['modified']
+					if existing.get('base') is not None:
+						del existing.attrib['base']
+					self.modified_ids.discard(id)
+					self.update_local_row(existing, version, row.text)
 				else:
 					self.debug(2, "  Changed on server")
 					count_changes += 1
 					if existing.attrib.has_key('modified'):		# new conflict
 						self.debug(1, "    new conflict")
 						count_conflicts += 1
-						self.xml_conflict_rows.append(row)
+						self.add_conflict_row(dict(row.attrib), row.text)
 					else:										# non-conflicting change
 						self.debug(2, "    updated")
-						existing.attrib['version'] = version
-						existing.text = row.text
+						self.update_local_row(existing, version, row.text)
 
 			# completely new row
 			else:			
 				self.debug(2, "  New row from server")
-				self.xml_rows.append(row)
+				self.add_local_row(dict(row.attrib), row.text)
 				count_changes += 1
 
-		# Copy the version number from the response to the local store.
-		self.xml_pulled_version.text = resp.find('version').text
-
 		assert count_changes >= count_conflicts, "count_changes=%d, count_conflicts=%d" % (count_changes, count_conflicts)
 		return count_changes, count_conflicts
 
+	# Return the whole text of version version of row id given a delta
+	# against the version before, or None if we do not have that. (If we
+	# already have the version itself, it is returned as it is.)
+	def expand_delta(self, id, version, delta):
+		if self.conflict_rows_by_id.has_key(id):
+			existing = self.conflict_rows_by_id[id]
+			base = existing.text or ""
+		elif self.rows_by_id.has_key(id):
+			existing = self.rows_by_id[id]
+			base = self.base_text(existing)
+			if base is None:
+				return None
+		else:
+			return None
+		existing_version = int(existing.get('version'))
+		if existing_version == version:
+			return base
+		if existing_version != version - 1:
+			return None
+		try:
+			return csvdelta.apply_delta(base, delta)
+		except ValueError as e:
+			self.debug(1, "Delta for row %d does not fit: %s" % (id, str(e)))
+			return None
+
 	@staticmethod
 	def add_row(parent, id, version, data):
 		child = ET.SubElement(parent, 'row')
@@ -253,11 +880,14 @@ class SharedTable:
 
 	#====================================================
 	# Push any modified recoreds up to the server.
+	#
+	# If the server has changed the columns since we
+	# last heard from it, the push is refused. We apply
+	# the changes and push again.
 	#====================================================
 	def push(self):
 		self.debug(1, "SharedTable.push()")
 
-		count_changes = 0
 		count_conflicts = 0
 
 		# Build XML request
@@ -266,83 +896,17 @@ class SharedTable:
 		child = ET.SubElement(top, 'type')
 		child.text = 'push'
 		child.tail = '\n'
-
-		# Push any changes to existing rows
-		req_rows = ET.SubElement(top, 'rows')
-		req_rows.text = '\n'
-		req_rows.tail = '\n'
-		for row in list(self.xml_rows):
-			id = int(row.get('id'))
-			if id == 0 and self.table_format == 'stbcsv':
-				assert int(row.get('version')) == 1, "Row with ID 0 must never be modified."
-				self.add_row(req_rows, row.get('id'), 1, row.text)
-			elif row.attrib.has_key('modified'):
-				self.debug(2, "Row %s is modified: %s" % (row.get('id'), row.text))
-				count_changes += 1
-				self.add_row(req_rows, row.get('id'), int(row.get('version')) + 1, row.text)
-
-		# Push new rows
-		req_new_rows = ET.SubElement(top, 'new_rows')
-		req_new_rows.text = '\n'
-		req_new_rows.tail = '\n'
-		for row in list(self.xml_new_rows):
-			self.debug(2, "New row: %s" % row.text)
-			count_changes += 1
-			child = ET.SubElement(req_new_rows, 'row')
-			child.text = row.text
-			child.tail = '\n'
+		self.add_schema_version(top)
+		count_changes = self.add_push_rows(top)
 
 		# Make the request only if it is non-empty
 		if count_changes > 0:
-			count_changes_accepted = 0
 
 			# Send request and parse the response
 			resp = self.post_xml(top)
-	
-			result = resp.find('result').text
-			if result == "FORMAT_CONFLICT":
-				raise SharedTableFormatError
-			elif result != "OK":
-				raise SharedTableError
-
-			# Remove the modified attribute from rows for which the change
-			# was accepted and bump the version number.
-			rows_by_id = self.index_rows(self.xml_rows)
-			for r_row in list(resp.find("modified_rows")):
-				assert r_row.tag == "row"
-				id = int(r_row.get('id'))
-				self.debug(1, "Row successfully modified: %d" % id)
-				row = rows_by_id[id]
-				del row.attrib['modified']
-				row.attrib['version'] = str(int(row.get('version')) + 1)
-				count_changes_accepted += 1
-	
-			# Accept the IDs which the server has assigned to the new rows
-			# and move them to the end of the main list of rows.
-			r_new_rows = list(resp.find("new_rows"))
-			for row in list(self.xml_new_rows):
-				assert row.tag == "row"
-				r_row = r_new_rows.pop(0)
-				assert r_row.tag == "row"
-				id = r_row.get('id')
-				self.debug(1, "New row received id: %s" % id)
-				child = ET.SubElement(self.xml_rows, "row")
-				child.attrib = {'id':id, 'version':'1'}
-				child.text = row.text
-				child.tail = "\n"
-				self.xml_new_rows.remove(row)
-				count_changes_accepted += 1
-
-			count_conflicts = int(resp.find("conflict_count").text)
-
-			# Make sure all changes are accounted for.
-			# count_changes -- the number we submitted
-			# count_changes_accepted -- number for which server return new version
-			# count_conflicts -- number of conflicts which server claimed
-			self.debug(1, "count_changes: %d" % count_changes)
-			self.debug(1, "count_changes_accepted: %d" % count_changes_accepted)
-			self.debug(1, "count_conflicts: %d" % count_conflicts)
-			assert count_changes == (count_changes_accepted + count_conflicts)
+			if self.accept_schema(resp) > 0 and resp.find('result').text == "FORMAT_CONFLICT":
+				return self.push()
+			count_changes_accepted, count_conflicts = self.accept_push_response(resp, count_changes)
 	
 			# An optimization to (most of the time) prevent the changes we push
 			# from coming right back at us the next time we pull.
@@ -365,3 +929,258 @@ class SharedTable:
 		assert count_changes >= count_conflicts, "count_changes=%d, count_conflicts=%d" % (count_changes, count_conflicts)
 		return count_changes, count_conflicts
 
+	#====================================================
+	# Push our changes and pull everyone else's in a
+	# single request. The server leaves out of the
+	# pulled rows those which our push has just written,
+	# so they do not come back to us even if others
+	# have pushed since our last pull.
+	#
+	# Returns the (count_changes, count_conflicts) which
+	# push() and pull() would have returned.
+	#
+	# If the server answers with a <reset> in place of
+	# the pulled rows, the push has still been applied
+	# and we pull everything again with pull().
+	#
+	# As with push(), a sync refused because the server
+	# has changed the columns is made again once we have
+	# applied the changes.
+	#====================================================
+	def sync(self):
+		self.debug(1, "SharedTable.sync()")
+		top, count_push_changes = self.sync_request()
+		return self.accept_sync(self.post_xml(top), count_push_changes)
+
+	# Build the request for sync(). Returns it and the number of
+	# changes it pushes.
+	def sync_request(self):
+		top = ET.Element('request')
+		top.text = '\n'
+		child = ET.SubElement(top, 'type')
+		child.text = 'sync'
+		child.tail = '\n'
+		child = ET.SubElement(top, 'pulled_version')
+		child.text = self.xml_pulled_version.text
+		child.tail = '\n'
+		self.add_schema_version(top)
+		self.add_filter(top)
+		self.add_client_id(top)
+		count_push_changes = self.add_push_rows(top)
+		return top, count_push_changes
+
+	# Apply the server's response to a sync request. Returns what
+	# sync() returns.
+	def accept_sync(self, resp, count_push_changes):
+		if self.accept_schema(resp) > 0 and resp.find('result').text == "FORMAT_CONFLICT":
+			return self.sync()
+		count_push_accepted, count_push_conflicts = self.accept_push_response(resp, count_push_changes)
+		if resp.find('reset') is not None:
+			self.reset_local_store()
+			return (count_push_changes, count_push_conflicts), self.pull()
+		count_pull_changes, count_pull_conflicts = self.merge_rows(resp.find('rows'))
+
+		# We now have everything up to the server's current version. Any
+		# paged pull which was interrupted has therefore been completed.
+		self.xml_pulled_version.text = resp.find('version').text
+		continuation = self.xml_repository.find('continuation')
+		if continuation is not None:
+			self.xml_repository.remove(continuation)
+		self.finish_reset()
+
+		return (count_push_changes, count_push_conflicts), (count_pull_changes, count_pull_conflicts)
+
+	#====================================================
+	# Sync several stbcsv tables of the same database
+	# in one request to its batch URL (/<db>/batch, see
+	# server/batch.py), which is posted with the wire
+	# format and credentials of the first of them.
+	#
+	# Returns a list of what sync() returned for each
+	# table. Each table's response is applied even if
+	# that of another failed, whatever the exception;
+	# the failures are then raised together as a
+	# SharedTableError.
+	#====================================================
+	@staticmethod
+	def sync_batch(tables):
+		if len(tables) == 0:
+			return []
+		first = tables[0]
+		first.debug(1, "SharedTable.sync_batch()")
+
+		# Every table must live under the same /<db>/
+		prefix = first.url.rsplit('/', 1)[0]
+		names = []
+		for table in tables:
+			table_prefix, filename = table.url.rsplit('/', 1)
+			if table.table_format != 'stbcsv' or table_prefix != prefix or not filename.endswith('.stbcsv'):
+				raise SharedTableError("Cannot batch %s with %s" % (table.url, first.url))
+			names.append(filename[:-len('.stbcsv')])
+
+		batch_url = prefix + '/batch'
+		batch_transport = transport.get_transport(batch_url,
+			first.xml.find("repository/realm").text,
+			first.xml.find("repository/username").text,
+			first.xml.find("repository/password").text
+			)
+
+		top = ET.Element('batch')
+		top.text = '\n'
+		counts = []
+		for table, name in zip(tables, names):
+			request, count_push_changes = table.sync_request()
+			child = ET.SubElement(top, 'table', name=name)
+			child.tail = '\n'
+			child.append(request)
+			counts.append(count_push_changes)
+
+		resp = first.post_xml(top, batch_transport)
+		parts = resp.findall('table')
+		if len(parts) != len(tables):
+			raise SharedTableError("Batch response has %d tables rather than %d" % (len(parts), len(tables)))
+
+		results = []
+		errors = []
+		for table, name, part, count_push_changes in zip(tables, names, parts, counts):
+			try:
+				if part.get('name') != name:
+					raise SharedTableError("expected response for %s, got %s" % (name, part.get('name')))
+				if part.get('error') is not None:
+					raise SharedTableError(part.get('error'))
+				results.append(table.accept_sync(part.find('response'), count_push_changes))
+			except Exception as e:
+				errors.append("%s: %s" % (name, str(e) or type(e).__name__))
+				results.append(None)
+		if len(errors) > 0:
+			raise SharedTableError("Batch sync failed for %s" % "; ".join(errors))
+		return results
+
+	# Add the <rows>, <new_rows> and (if we have deleted any rows)
+	# <deleted_rows> of a push to a request. Returns the number of
+	# changes added.
+	#
+	# If delta_encoding is set, modified rows of which we have kept the
+	# base are sent in <delta_rows> with only the cells which have changed.
+	def add_push_rows(self, top):
+		count_changes = 0
+
+		# Push any changes to existing rows
+		req_rows = ET.SubElement(top, 'rows')
+		req_rows.text = '\n'
+		req_rows.tail = '\n'
+		self.load_indexes()
+		if self.table_format == 'stbcsv' and self.rows_by_id.has_key(0):
+			row = self.rows_by_id[0]
+			assert int(row.get('version')) == 1, "Row with ID 0 must never be modified."
+			self.add_row(req_rows, row.get('id'), 1, row.text)
+		deleted = []
+		deltas = []
+		for id in sorted(self.modified_ids):
+			if id == 0 and self.table_format == 'stbcsv':
+				continue
+			row = self.rows_by_id[id]
+			if row.get('deleted') is not None:
+				deleted.append(row)
+				continue
+			self.debug(2, "Row %s is modified: %s" % (row.get('id'), row.text))
+			count_changes += 1
+			if self.delta_encoding and self.table_format == 'stbcsv':
+				delta = csvdelta.make_delta(row.get('base'), row.text)
+				if delta is not None:
+					deltas.append((row, delta))
+					continue
+			self.add_row(req_rows, row.get('id'), int(row.get('version')) + 1, row.text)
+
+		# Push new rows
+		req_new_rows = ET.SubElement(top, 'new_rows')
+		req_new_rows.text = '\n'
+		req_new_rows.tail = '\n'
+		for row in list(self.xml_new_rows):
+			self.debug(2, "New row: %s" % row.text)
+			count_changes += 1
+			child = ET.SubElement(req_new_rows, 'row')
+			child.text = row.text
+			child.tail = '\n'
+
+		# Push deletions. Servers which cannot delete rows would
+		# ignore these, so they are sent only if there are any.
+		if len(deleted) > 0:
+			req_deleted_rows = ET.SubElement(top, 'deleted_rows')
+			req_deleted_rows.text = '\n'
+			req_deleted_rows.tail = '\n'
+			for row in deleted:
+				self.debug(2, "Row %s is deleted" % row.get('id'))
+				count_changes += 1
+				self.add_row(req_deleted_rows, row.get('id'), int(row.get('version')) + 1, None)
+
+		# Push deltas, likewise only if there are any
+		if len(deltas) > 0:
+			req_delta_rows = ET.SubElement(top, 'delta_rows')
+			req_delta_rows.text = '\n'
+			req_delta_rows.tail = '\n'
+			for row, delta in deltas:
+				self.add_row(req_delta_rows, row.get('id'), int(row.get('version')) + 1, delta)
+
+		return count_changes
+
+	# Apply the server's response to a push to the local store.
+	# Returns the number of changes accepted and the number of
+	# conflicts.
+	def accept_push_response(self, resp, count_changes):
+		count_changes_accepted = 0
+
+		result = resp.find('result').text
+		if result == "FORMAT_CONFLICT":
+			raise SharedTableFormatError
+		elif result != "OK":
+			raise SharedTableError
+
+		# Remove the modified attribute from rows for which the change
+		# was accepted and bump the version number. Rows whose deletion
+		# was accepted are removed.
+		rows_by_id = self.rows_by_id
+		for r_row in list(resp.find("modified_rows")):
+			assert r_row.tag == "row"
+			id = int(r_row.get('id'))
+			row = rows_by_id[id]
+			if row.get('deleted') is not None:
+				self.debug(1, "Row successfully deleted: %d" % id)
+				self.remove_local_row(row)
+				count_changes_accepted += 1
+				continue
+			self.debug(1, "Row successfully modified: %d" % id)
+			del row.attrib['modified']
+			if row.get('base') is not None:
+				del row.attrib['base']
+			if row.get('reset') is not None:		# evidently still on the server
+				del row.attrib['reset']
+			self.modified_ids.discard(id)
+			row.attrib['version'] = str(int(row.get('version')) + 1)
+			count_changes_accepted += 1
+
+		# Accept the IDs which the server has assigned to the new rows
+		# and move them to the end of the main list of rows.
+		r_new_rows = list(resp.find("new_rows"))
+		for row in list(self.xml_new_rows):
+			assert row.tag == "row"
+			r_row = r_new_rows.pop(0)
+			assert r_row.tag == "row"
+			id = r_row.get('id')
+			self.debug(1, "New row received id: %s" % id)
+			self.add_local_row({'id':id, 'version':'1'}, row.text)
+			self.xml_new_rows.remove(row)
+			count_changes_accepted += 1
+
+		count_conflicts = int(resp.find("conflict_count").text)
+
+		# Make sure all changes are accounted for.
+		# count_changes -- the number we submitted
+		# count_changes_accepted -- number for which server return new version
+		# count_conflicts -- number of conflicts which server claimed
+		self.debug(1, "count_changes: %d" % count_changes)
+		self.debug(1, "count_changes_accepted: %d" % count_changes_accepted)
+		self.debug(1, "count_conflicts: %d" % count_conflicts)
+		assert count_changes == (count_changes_accepted + count_conflicts)
+
+		return count_changes_accepted, count_conflicts
@@ -1,11 +1,14 @@
 #! /usr/bin/python
 # pycoact/client/table.py
 # Copyright 2013, 2014, 2015, Trinity College Computing Center
-# Last modified: 2 January 2015
+# Last modified: 17 October 2026
 
-import xml.etree.cElementTree as ET
+import array
+import bisect
+import heapq
 import pyapp.csv_unicode as csv
-from pycoact.client.table import SharedTable, SharedTableError, SharedTableFormatError
+from pycoact.client.table import SharedTable, SharedTableError
+from pycoact.csvschema import field_value, apply_ops
 
 class SharedTableCSVConflict:
 	def __init__(self, index, obj):
@@ -28,12 +31,102 @@ class SharedTableCSVConflict:
 		assert self.resolved
 		self.resolved = False
 
+# An index of the values in one column of the rows of <rows> (see
+# SharedTableCSV.add_index()). A hash index can find the rows with a
+# given value. A sorted one can also find those with values in a range,
+# in order of value.
+class SharedTableCSVIndex:
+	def __init__(self, column, sorted, convert):
+		self.column = column
+		self.sorted = sorted
+		self.convert = convert
+		self.position = None
+		self.values = None		# id -> value, None until built
+		self.ids = {}			# hash: value -> set of ids
+		self.keys = []			# sorted: (value, id) in order
+
+	# The value of a cell as it is indexed, or None if it cannot
+	# be converted
+	def value(self, cell):
+		if self.convert is None:
+			return cell
+		try:
+			return self.convert(cell)
+		except ValueError:
+			return None
+
+	# Index all rows at once, given as (id, cell).
+	def build(self, cells):
+		self.values = {}
+		for id, cell in cells:
+			value = self.value(cell)
+			if value is not None:
+				self.values[id] = value
+		if self.sorted:
+			self.keys = sorted([(value, id) for id, value in self.values.iteritems()])
+		else:
+			self.ids = {}
+			for id, value in self.values.iteritems():
+				self.ids.setdefault(value, set()).add(id)
+
+	def add(self, id, cell):
+		value = self.value(cell)
+		if value is None:
+			return
+		self.values[id] = value
+		if self.sorted:
+			bisect.insort(self.keys, (value, id))
+		else:
+			self.ids.setdefault(value, set()).add(id)
+
+	def remove(self, id):
+		value = self.values.pop(id, None)
+		if value is None:
+			return
+		if self.sorted:
+			del self.keys[bisect.bisect_left(self.keys, (value, id))]
+		else:
+			ids = self.ids[value]
+			ids.discard(id)
+			if len(ids) == 0:
+				del self.ids[value]
+
+	# The ids of the rows with the given value, in order
+	def lookup(self, value):
+		if self.sorted:
+			found = []
+			keys = self.keys
+			i = bisect.bisect_left(keys, (value,))
+			while i < len(keys) and keys[i][0] == value:
+				found.append(keys[i][1])
+				i += 1
+			return found
+		return sorted(self.ids.get(value, ()))
+
+	# (value, id) of the rows with values from low up to but not
+	# including high, in order of value
+	def range(self, low, high):
+		start = 0 if low is None else bisect.bisect_left(self.keys, (low,))
+		end = len(self.keys) if high is None else bisect.bisect_left(self.keys, (high,))
+		return self.keys[start:end]
+
 class SharedTableCSV(SharedTable):
 	def __init__(self, local_filename, debug=0):
 		SharedTable.__init__(self, local_filename, "stbcsv", debug=debug)
 		self.csv_rows = None
 		self.csv_conflicts = None
 
+		# The cells of the rows of <rows> which have been parsed, by id,
+		# as (version, text, cells). See parse_rows().
+		self.parsed_rows = {}
+
+		# SharedTableCSVIndex of the columns named, by name. See add_index().
+		self.column_indexes = {}
+
+		# Positions of the rows of <rows> in what csv_reader() returns,
+		# by id, or None until they are needed again. See lookup().
+		self.row_positions = None
+
 	#====================================================
 	# Return an object which will return all of the rows
 	# in id order.
@@ -41,27 +134,34 @@ class SharedTableCSV(SharedTable):
 	# not receive them. Also remember which of the rows
 	# have conflicts, since the caller may ask later by
 	# calling get_conflicts().
+	#
+	# Rows which have been deleted (see delete_row()) are
+	# left out, even before the deletion has been pushed.
+	#
+	# Rows already on the server are parsed only if they
+	# have changed since they were last parsed (see
+	# parse_rows()). The caller gets copies of the lists
+	# of cells, so it may change them.
 	#====================================================
 	def csv_reader(self):
 		self.debug(1, "SharedTable.csv_reader()")
 
-		rows = self.index_rows(self.xml_rows)
-		conflict_rows = self.index_rows(self.xml_conflict_rows)
+		self.load_indexes()
+		rows = self.rows_by_id
+		conflict_rows = self.conflict_rows_by_id
 		self.csv_rows = []
 		self.csv_conflicts = []
 		self.csv_new_rows = []
 
-		# CSV data that will need to be parsed
-		data = []
-
-		# Add those rows which are already on the server to data[].
+		# Add those rows which are already on the server to csv_rows[].
 		# Take special note of any that are in conflict with the server
 		# versions.
 		index = 0
-		for key in sorted(rows.keys()):
+		for key in self.row_ids:
+			if rows[key].get('deleted') is not None:
+				continue
 			self.debug(1, "CSV server row: %s" % rows[key].text)
 			self.csv_rows.append(rows[key])
-			data.append(rows[key].text)
 			if conflict_rows.has_key(key):
 				self.csv_conflicts.append(SharedTableCSVConflict(index, conflict_rows[key]))
 			index += 1
@@ -70,9 +170,265 @@ class SharedTableCSV(SharedTable):
 		for row in list(self.xml_new_rows):
 			self.debug(2, "CSV new row: %s" % row.text)
 			self.csv_new_rows.append(row)
-			data.append(row.text)
 
-		return csv.reader(data)
+		data = self.parse_rows(self.csv_rows)
+		data.extend(csv.reader([row.text for row in self.csv_new_rows]))
+		return (list(cells) for cells in data)
+
+	#====================================================
+	# Parse rows of <rows> as CSV and return a list of
+	# their lists of cells, which must not be changed.
+	#
+	# The cells are kept in parsed_rows along with the
+	# version and text of the row from which they came.
+	# A row is parsed again only once a pull or an edit
+	# has changed it. Edits made with csv_writer() and
+	# schema operations drop the rows they change from
+	# parsed_rows. A pull gives the rows it changes new
+	# versions, which no longer match.
+	#====================================================
+	def parse_rows(self, rows):
+		parsed_rows = self.parsed_rows
+		result = []
+		misses = []
+		for row in rows:
+			parsed = parsed_rows.get(row.get('id'))
+			if parsed is not None and parsed[0] == row.get('version') and parsed[1] == row.text:
+				result.append(parsed[2])
+			else:
+				misses.append(len(result))
+				result.append(None)
+
+		if len(misses) > 0:
+			self.debug(1, "Parsing %d of %d rows" % (len(misses), len(rows)))
+			for i, cells in zip(misses, csv.reader([rows[i].text for i in misses])):
+				row = rows[i]
+				parsed_rows[row.get('id')] = (row.get('version'), row.text, cells)
+				result[i] = cells
+
+		# Forget rows which have been removed.
+		if len(parsed_rows) > len(self.rows_by_id):
+			self.parsed_rows = dict([(id, parsed) for id, parsed in parsed_rows.items() if self.rows_by_id.has_key(int(id))])
+
+		return result
+
+	def apply_schema_ops(self, operations):
+		self.parsed_rows = {}
+		if len(self.column_indexes) > 0:
+			self.alter_column_indexes(operations)
+		SharedTable.apply_schema_ops(self, operations)
+
+	#====================================================
+	# Return the cells of one column, given by its name
+	# in the first row or by its index, for the rows
+	# which csv_reader() returns after the first, in the
+	# same order.
+	#
+	# The cells of rows which have already been parsed
+	# (see parse_rows()) are taken from parsed_rows. Of
+	# the others only the one cell is unquoted. Nothing
+	# else is parsed and nothing is added to parsed_rows.
+	#
+	# If typecode is given, the cells are converted to
+	# numbers and returned in an array.array of that type.
+	# Empty cells become missing, or raise ValueError if
+	# missing is None.
+	#====================================================
+	def column(self, col, typecode=None, missing=None):
+		self.debug(1, "SharedTable.column(%s)" % str(col))
+		self.load_indexes()
+		rows = self.rows_by_id
+		if not isinstance(col, (int, long)):
+			if not rows.has_key(0):
+				raise SharedTableError("The table has no first row.")
+			col = self.parse_rows([rows[0]])[0].index(col)
+
+		parsed_rows = self.parsed_rows
+		values = []
+		for key in self.row_ids:
+			row = rows[key]
+			if key == 0 or row.get('deleted') is not None:
+				continue
+			values.append(self.row_cell(row, col))
+		for row in self.xml_new_rows:
+			values.append(field_value(row.text, col))
+
+		if typecode is None:
+			return values
+		convert = float if typecode in ('f', 'd') else int
+		result = array.array(typecode)
+		for value in values:
+			if value != "":
+				result.append(convert(value))
+			elif missing is not None:
+				result.append(missing)
+			else:
+				raise ValueError("empty cell in column %d" % col)
+		return result
+
+	# The cell at position col of a row of <rows>, from parsed_rows if
+	# it is there
+	def row_cell(self, row, col):
+		parsed = self.parsed_rows.get(row.get('id'))
+		if parsed is not None and parsed[0] == row.get('version') and parsed[1] == row.text:
+			cells = parsed[2]
+			return cells[col] if col < len(cells) else u""
+		return field_value(row.text, col)
+
+	#====================================================
+	# Indexes of the values in columns
+	#
+	# add_index() declares an index of the column with
+	# the given name. It is built the first time that
+	# it is used and is kept up to date from then on as
+	# rows are pulled, written, deleted, and pushed. A
+	# sorted index can also find rows by range.
+	#
+	# If convert is given, it is applied to the cells
+	# before they are indexed (float, for instance, so
+	# that they are compared as numbers), and values to
+	# look up must be given as it would return them.
+	# Cells which it cannot convert are not indexed.
+	#
+	# lookup() and lookup_range() return the positions
+	# of the rows in what csv_reader() would return now
+	# (the header row being 0), or, if ids is true, the
+	# ids of the rows (leaving out new rows, which have
+	# none yet). New rows are few, so they are not
+	# indexed but checked at each lookup.
+	#====================================================
+	def add_index(self, column, sorted=False, convert=None):
+		self.debug(1, "SharedTable.add_index(%s)" % column)
+		index = self.column_indexes.get(column)
+		if index is None or index.sorted != sorted or index.convert != convert:
+			self.column_indexes[column] = SharedTableCSVIndex(column, sorted, convert)
+
+	def drop_index(self, column):
+		self.column_indexes.pop(column, None)
+
+	# Return the index of a column, building it if need be.
+	def column_index(self, column):
+		index = self.column_indexes.get(column)
+		if index is None:
+			raise SharedTableError("Column %s has no index." % column)
+		if index.values is None:
+			self.load_indexes()
+			rows = self.rows_by_id
+			if not rows.has_key(0):
+				raise SharedTableError("The table has no first row.")
+			index.position = self.parse_rows([rows[0]])[0].index(column)
+			self.debug(1, "Building index of column %s" % column)
+			index.build([(id, self.row_cell(rows[id], index.position)) for id in self.row_ids
+				if id != 0 and rows[id].get('deleted') is None])
+		return index
+
+	# Bring the indexes up to date for a row of <rows> which has been
+	# added or changed (indexed is true) or deleted or removed.
+	def index_row(self, row, indexed):
+		id = int(row.get('id'))
+		if id == 0:
+			return
+		for index in self.column_indexes.values():
+			if index.values is not None:
+				index.remove(id)
+				if indexed:
+					index.add(id, field_value(row.text, index.position))
+
+	def lookup(self, column, value, ids=False):
+		index = self.column_index(column)
+		found = index.lookup(value)
+		if ids:
+			return found
+		new_found = [i for i, cell in self.new_row_cells(index.position) if index.value(cell) == value]
+		return self.positions(found, new_found)
+
+	def lookup_range(self, column, low=None, high=None, ids=False):
+		index = self.column_index(column)
+		if not index.sorted:
+			raise SharedTableError("Column %s has no sorted index." % column)
+		found = index.range(low, high)
+		if ids:
+			return [id for value, id in found]
+		positions = self.row_positions_by_id()
+		new_found = []
+		for i, cell in self.new_row_cells(index.position):
+			value = index.value(cell)
+			if value is not None and (low is None or value >= low) and (high is None or value < high):
+				new_found.append((value, len(positions) + i))
+		if len(new_found) == 0:
+			return [positions[id] for value, id in found]
+		return [i for value, i in heapq.merge([(value, positions[id]) for value, id in found], sorted(new_found))]
+
+	# (i, cell) for each new row, where i is its position among them
+	def new_row_cells(self, position):
+		return [(i, field_value(row.text, position)) for i, row in enumerate(self.xml_new_rows)]
+
+	# Turn the ids of rows of <rows> and the positions of new rows among
+	# them into the positions of the rows in what csv_reader() returns.
+	def positions(self, found, new_found):
+		positions = self.row_positions_by_id()
+		return [positions[id] for id in found] + [len(positions) + i for i in new_found]
+
+	def row_positions_by_id(self):
+		if self.row_positions is None:
+			rows = self.rows_by_id
+			self.row_positions = dict([(id, i) for i, id in enumerate([id for id in self.row_ids if rows[id].get('deleted') is None])])
+		return self.row_positions
+
+	# Keep the indexes in step with schema operations, given as (tver,
+	# op, position, name), which are about to be applied. The index of
+	# a renamed column goes with it. That of a dropped one is dropped.
+	def alter_column_indexes(self, operations):
+		self.load_indexes()
+		header = self.rows_by_id[0].text if self.rows_by_id.has_key(0) else ""
+		for operation in operations:
+			tver, op, position, name = operation
+			names = csv.reader([header]).next()
+			if op in ("drop", "rename") and position < len(names) and names[position] in self.column_indexes:
+				index = self.column_indexes.pop(names[position])
+				if op == "rename":
+					index.column = name
+					self.column_indexes[name] = index
+			header = apply_ops(header, [operation], header=True)
+		names = csv.reader([header]).next()
+		for index in self.column_indexes.values():
+			index.position = names.index(index.column)
+
+	# The functions of SharedTable which change the rows of <rows>,
+	# which must also bring the indexes up to date
+
+	def add_local_row(self, attrib, text):
+		row = SharedTable.add_local_row(self, attrib, text)
+		if self.rows_by_id is not None:
+			self.row_positions = None
+			self.index_row(row, True)
+		return row
+
+	def update_local_row(self, row, version, text):
+		SharedTable.update_local_row(self, row, version, text)
+		self.row_positions = None		# if it was deleted
+		self.index_row(row, True)
+
+	def modify_row(self, row, text):
+		SharedTable.modify_row(self, row, text)
+		self.index_row(row, True)
+
+	def mark_deleted(self, row):
+		SharedTable.mark_deleted(self, row)
+		self.row_positions = None
+		self.index_row(row, False)
+
+	def remove_local_row(self, row):
+		if self.rows_by_id is not None:
+			self.row_positions = None
+			self.index_row(row, False)
+		SharedTable.remove_local_row(self, row)
+
+	def clear_local_store(self):
+		SharedTable.clear_local_store(self)
+		self.row_positions = None
+		for index in self.column_indexes.values():
+			index.values = None
 
 	#====================================================
 	# Return an object to which the caller can writerow()
@@ -95,8 +451,7 @@ class SharedTableCSV(SharedTable):
 				# Change the version number of our copy of the row in order to indicate
 				# that it is a modified copy of the conflicting row. (The modifictions
 				# resolve the conflict.)
-				self.csv_rows[conflict.index].attrib['version'] = conflict.obj.attrib['version']
-				self.xml_conflict_rows.remove(conflict.obj)
+				self.take_conflict_version(self.csv_rows[conflict.index], conflict.obj)
 			else:
 				self.debug(2, "Conflict %d not resolved" % index)
 				remain.append(conflict)
@@ -122,8 +477,8 @@ class SharedTableCSV(SharedTable):
 			existing = self.csv_rows[self.csv_rows_index]
 			if existing.text != text:
 				self.debug(2, "    modified")
-				existing.text = text
-				existing.set('modified', '1')
+				self.modify_row(existing, text)
+				self.parsed_rows.pop(existing.get('id'), None)
 			self.csv_rows_index += 1
 		elif self.csv_new_rows_index < len(self.csv_new_rows):		# Not on server, but was already in local store
 			self.debug(2, "  row exists in local store")
@@ -135,15 +490,10 @@ class SharedTableCSV(SharedTable):
 			# The first row of the table always specifies the column headings.
 			# This special case prevents it from becoming a new row before we
 			# can pull it from the repository. 
-			child = ET.SubElement(self.xml_rows, 'row')
-			child.attrib = {'id':'0', 'version':'1'}
-			child.text = text
-			child.tail = "\n"
+			self.add_local_row({'id':'0', 'version':'1'}, text)
 		else:														# Entirely new
 			self.debug(2, "  new row added to local store")
-			child = ET.SubElement(self.xml_new_rows, 'row')
-			child.text = text
-			child.tail = "\n"
+			child = self.new_row(self.xml_new_rows, {}, text)
 			# It is important to do this since there is no guarantee that the
 			# user of this library will call csv_reader() before calling
 			# csv_writer() again.
@@ -152,6 +502,34 @@ class SharedTableCSV(SharedTable):
 
 		self.csv_overall_index += 1
 
+	#====================================================
+	# Delete the row at the given index (counting from
+	# the header row as 0) in the rows returned by the
+	# last call to csv_reader(). The deletion is sent to
+	# the server by the next push. Rows after it move up
+	# one, so csv_reader() must be called again before
+	# csv_writer() or another delete_row().
+	#====================================================
+	def delete_row(self, index):
+		self.debug(1, "SharedTable.delete_row(%d)" % index)
+		assert self.csv_rows is not None, "delete_row() must be called after csv_reader()"
+		assert index > 0, "The header row may not be deleted."
+
+		if index < len(self.csv_rows):
+			row = self.csv_rows[index]
+
+			# If the row is in conflict, deleting it resolves the conflict.
+			for conflict in self.csv_conflicts:
+				if conflict.index == index:
+					self.take_conflict_version(row, conflict.obj)
+			self.mark_deleted(row)
+		else:
+			# Not yet on the server, so simply drop it
+			self.xml_new_rows.remove(self.csv_new_rows[index - len(self.csv_rows)])
+
+		self.csv_rows = None
+		self.csv_conflicts = None
+
 	#====================================================
 	# Return the list of conflicts which were noted
 	# when csv_reader() was preparing the data.
@@ -162,41 +540,58 @@ class SharedTableCSV(SharedTable):
 		return self.csv_conflicts
 
 	#====================================================
-	# Add a column to the local copy of the shared table
+	# Change the columns of the shared table. Each of
+	# these is done by the server (see csvschema.py)
+	# and comes back to us like changes made by others,
+	# so they must be called before csv_reader(). If
+	# another client has changed the columns first, we
+	# find the column again and try again.
 	#====================================================
-	def add_column(self, col_after, col_new):
-		import StringIO
-		
-		def csv_split(line):
-			return csv.reader([line]).next()
 
-		def csv_join(row):
-			f = StringIO.StringIO()
-			csv.writer(f).writerow(row)
-			return f.getvalue().strip()
+	# The names of the columns as given by the first row
+	def column_names(self):
+		self.load_indexes()
+		if not self.rows_by_id.has_key(0):
+			raise SharedTableError("The table must be pulled before its columns are changed.")
+		return csv.reader([self.rows_by_id[0].text]).next()
 
+	def alter_columns(self, make_operations):
 		if self.csv_rows is not None:
-			raise SharedTableError("add_column() must be called before csv_reader()")
-	
-		print "Adding new column %s after column %s..." % (col_new, col_after)
-		xml_rows = list(self.xml.find("rows")) \
-			+ list(self.xml.find("conflict_rows")) \
-			+ list(self.xml.find("new_rows"))
-		
-		print " Existing first row:", xml_rows[0].text
-		row = csv_split(xml_rows[0].text)
-		pos = row.index(col_after) + 1
-
-		if pos < len(row) and row[pos] == col_new:
-			print " Column %s already exists at position %d." % (col_new, pos)
-		else:
-			print " Adding column %s at position %d..." % (col_new, pos)
-			value = col_new
-			for xml_row in xml_rows:
-				row = csv_split(xml_row.text)
-				row.insert(pos, value)
-				xml_row.text = csv_join(row)
-				value = ""
+			raise SharedTableError("Columns must be changed before csv_reader() is called.")
+		while True:
+			operations = make_operations(self.column_names())
+			if len(operations) == 0 or self.alter(operations):
+				break
+
+	# Add a column named col_new after the column named col_after
+	# unless it is already there.
+	def add_column(self, col_after, col_new):
+		def operations(columns):
+			pos = columns.index(col_after) + 1
+			if pos < len(columns) and columns[pos] == col_new:
+				print "Column %s already exists at position %d." % (col_new, pos)
+				return []
+			print "Adding column %s at position %d..." % (col_new, pos)
+			return [("add", pos, col_new)]
+		self.alter_columns(operations)
+
+	def drop_column(self, col):
+		def operations(columns):
+			if not col in columns:
+				print "Column %s does not exist." % col
+				return []
+			print "Dropping column %s..." % col
+			return [("drop", columns.index(col), None)]
+		self.alter_columns(operations)
+
+	def rename_column(self, col, col_new):
+		def operations(columns):
+			if not col in columns:
+				print "Column %s does not exist." % col
+				return []
+			print "Renaming column %s to %s..." % (col, col_new)
+			return [("rename", columns.index(col), col_new)]
+		self.alter_columns(operations)
 
 #=============================================================================
 # Command line client which demonstrates use of above client library
@@ -0,0 +1,242 @@
+# pycoact/client/transport.py
+# Copyright 2026, Trinity College Computing Center
+# Last modified: 17 October 2026
+#
+# HTTP transport for SharedTable.
+#
+# urllib2 opens a new connection for each request and its digest
+# authentication handler waits to be challenged before it sends any
+# credentials, so each request costs two connections and two exchanges.
+# This transport keeps one HTTP/1.1 connection open for each repository
+# URL and remembers the digest challenge, so that later requests carry
+# an Authorization header the first time they are sent. If the server
+# decides the nonce is stale it challenges again and we answer once
+# more as before.
+#
+
+import httplib
+import urlparse
+import urllib2
+import hashlib
+import socket
+import errno
+import os
+import StringIO
+
+# Round trips which a request cost when sent through urllib2: a new
+# connection and a request which is refused with a 401, then another
+# new connection and the request again with credentials.
+urllib2_round_trips = 4
+
+# Transports already created, by URL and username
+transports = {}
+
+# Return the transport for a repository, creating it if necessary.
+def get_transport(url, realm, username, password):
+	key = (url, username)
+	transport = transports.get(key)
+	if transport is None:
+		transport = Transport(url, realm, username, password)
+		transports[key] = transport
+	else:
+		transport.set_password(realm, password)
+	return transport
+
+# Response to a request sent through a Transport. This has enough of the
+# interface of the object returned by urllib2.urlopen() for post_xml().
+class TransportResponse(object):
+	def __init__(self, response, body, round_trips):
+		self.code = response.status
+		self.msg = response.msg
+		self.body = body
+		self.round_trips = round_trips
+		self.round_trips_saved = max(0, urllib2_round_trips - round_trips)
+
+	def info(self):
+		return self.msg
+
+	def read(self):
+		return self.body
+
+class Transport(object):
+	def __init__(self, url, realm, username, password):
+		self.url = url
+		(scheme, netloc, path, params, query, fragment) = urlparse.urlparse(url)
+		if scheme == "https":
+			self.connection_class = httplib.HTTPSConnection
+		elif scheme == "http":
+			self.connection_class = httplib.HTTPConnection
+		else:
+			raise ValueError("Unsupported URL scheme: %s" % scheme)
+		self.netloc = netloc
+		self.path = urlparse.urlunparse(('', '', path or '/', params, query, ''))
+		self.username = username
+		self.set_password(realm, password)
+
+		self.connection = None
+
+		# The last digest challenge received, the number of times we
+		# have used its nonce, and the client nonce we are using with it.
+		self.challenge = None
+		self.nonce_count = 0
+		self.cnonce = None
+
+		# Totals for all of the requests sent through this transport
+		self.stats = {
+			'requests': 0,
+			'round_trips': 0,
+			'round_trips_saved': 0,
+			'connections': 0,
+			'challenges': 0,
+			}
+
+	def set_password(self, realm, password):
+		self.realm = realm
+		self.password = password
+
+	def close(self):
+		if self.connection is not None:
+			self.connection.close()
+			self.connection = None
+
+	#====================================================
+	# Send a POST request to the repository URL and
+	# return a TransportResponse. Raises
+	# urllib2.HTTPError if the server does not answer
+	# with a 2xx status.
+	#====================================================
+	def post(self, body, headers):
+		round_trips = 0
+		challenged = False
+		while True:
+			request_headers = dict(headers)
+			if self.challenge is not None:
+				request_headers['Authorization'] = self.authorization("POST")
+			response, response_body, exchange_round_trips = self.exchange(body, request_headers)
+			round_trips += exchange_round_trips
+
+			# Take a challenge only once per request so that a wrong
+			# password does not send us round in circles.
+			if response.status == 401 and not challenged:
+				challenge = self.parse_challenge(response.getheader('WWW-Authenticate'))
+				if challenge is not None:
+					self.stats['challenges'] += 1
+					self.challenge = challenge
+					self.nonce_count = 0
+					self.cnonce = os.urandom(8).encode('hex')
+					challenged = True
+					continue
+			break
+
+		result = TransportResponse(response, response_body, round_trips)
+		self.stats['requests'] += 1
+		self.stats['round_trips'] += result.round_trips
+		self.stats['round_trips_saved'] += result.round_trips_saved
+
+		if response.status < 200 or response.status > 299:
+			raise urllib2.HTTPError(self.url, response.status, response.reason, response.msg, StringIO.StringIO(response_body))
+
+		return result
+
+	# Send the request over the persistent connection, opening it first
+	# if necessary, and read the whole response.
+	#
+	# A connection which we left open may since have been closed by the
+	# server. We find that out when the request cannot be sent or when
+	# the connection is closed without a byte of response, and only then
+	# do we open a new one and send the request again. Any other failure
+	# is raised, since the server may already have applied the request,
+	# and a push sent twice would add its new rows twice.
+	def exchange(self, body, headers):
+		round_trips = 0
+		for attempt in (1, 2):
+			reused = self.connection is not None
+			if not reused:
+				self.connection = self.connection_class(self.netloc)
+				self.stats['connections'] += 1
+				round_trips += 1
+			try:
+				self.connection.request("POST", self.path, body, headers)
+			except (httplib.HTTPException, socket.error):
+				self.close()
+				if not reused:
+					raise
+				continue
+			try:
+				response = self.connection.getresponse()
+			except (httplib.HTTPException, socket.error) as e:
+				self.close()
+				if not reused or not self.closed_unanswered(e):
+					raise
+				continue
+			try:
+				response_body = response.read()
+			except:
+				self.close()
+				raise
+			round_trips += 1
+			if response.will_close:
+				self.close()
+			return (response, response_body, round_trips)
+
+	# Was this error from getresponse() the server closing the connection
+	# before it sent anything, as it does with connections left idle?
+	@staticmethod
+	def closed_unanswered(e):
+		if isinstance(e, httplib.BadStatusLine):
+			return e.line in ("", "''") or e.line.startswith("No status line received")
+		return isinstance(e, socket.error) and e.errno in (errno.ECONNRESET, errno.EPIPE)
+
+	#====================================================
+	# Digest authentication (RFC 2617)
+	#====================================================
+
+	@staticmethod
+	def parse_challenge(header):
+		if header is None:
+			return None
+		scheme, _, rest = header.strip().partition(' ')
+		if scheme.lower() != 'digest':
+			return None
+		challenge = urllib2.parse_keqv_list(urllib2.parse_http_list(rest))
+		if not 'nonce' in challenge:
+			return None
+		return challenge
+
+	def authorization(self, method):
+		challenge = self.challenge
+		realm = challenge.get('realm', self.realm)
+		nonce = challenge['nonce']
+		algorithm = challenge.get('algorithm', 'MD5')
+		qop_options = [i.strip() for i in challenge.get('qop', '').split(',')]
+
+		def H(data):
+			return hashlib.md5(data).hexdigest()
+
+		self.nonce_count += 1
+		nc = "%08x" % self.nonce_count
+
+		ha1 = H("%s:%s:%s" % (self.username, realm, self.password))
+		if algorithm.upper() == 'MD5-SESS':
+			ha1 = H("%s:%s:%s" % (ha1, nonce, self.cnonce))
+		ha2 = H("%s:%s" % (method, self.path))
+		if 'auth' in qop_options:
+			response = H("%s:%s:%s:%s:auth:%s" % (ha1, nonce, nc, self.cnonce, ha2))
+		else:
+			response = H("%s:%s:%s" % (ha1, nonce, ha2))
+
+		fields = [
+			('username', self.username),
+			('realm', realm),
+			('nonce', nonce),
+			('uri', self.path),
+			('response', response),
+			]
+		if 'opaque' in challenge:
+			fields.append(('opaque', challenge['opaque']))
+		if 'algorithm' in challenge:
+			fields.append(('algorithm', algorithm))
+		value = 'Digest ' + ', '.join(['%s="%s"' % field for field in fields])
+		if 'auth' in qop_options:
+			value += ', qop=auth, nc=%s, cnonce="%s"' % (nc, self.cnonce)
+		return value
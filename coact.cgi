@@ -1,30 +1,61 @@
 #! /usr/bin/python
 # CGI frontend for the shared table server
-# Last modified: 17 August 2013
+# Last modified: 17 October 2026
 
 import sys
 import os
 import codecs
 import re
+import mmap
 
 sys.path.insert(0, '..')	# above public_html/
 from pycoact.server.table import SharedTableServer
 from pycoact.server.geojson import GeojsonServer
+from pycoact.server.meta import connect
+from pycoact.server.compress import request_reader, response_encoding, compress_chunks, response_headers
+from pycoact.server.snapshot import SnapshotManager, SnapshotResponse
+from pycoact.server.batch import handle_batch
+
+# Responses may be compressed, so they bypass the UTF-8 writer.
+raw_stdout = sys.stdout
+
+# Send a snapshot (see snapshot.py) by mapping the whole file into
+# memory and writing it out in one piece.
+def mapped_file(response):
+	if os.fstat(response.fh.fileno()).st_size > 0:
+		data = mmap.mmap(response.fh.fileno(), 0, access=mmap.ACCESS_READ)
+		yield data
+		data.close()
+	response.close()
 
 try:
 	sys.stdout = codecs.getwriter('utf-8')(sys.stdout)
 	sys.stderr = codecs.getwriter('utf-8')(sys.stderr)
 	
+	# PATH_INFO is /<db>/<table>.<type>, or /<db>/batch for a batch
+	# of requests to several tables (see batch.py).
 	m = re.match('/([a-z0-9_]+)/([a-z0-9_]+)\.([a-z0-9]+)$', os.environ['PATH_INFO'])
-	assert m, "Invalid PATH_INFO"
-	db_name = m.group(1)
-	tablename = m.group(2)
-	tabletype = m.group(3)
+	if m:
+		db_name = m.group(1)
+		tablename = m.group(2)
+		tabletype = m.group(3)
+	else:
+		m = re.match('/([a-z0-9_]+)/batch$', os.environ['PATH_INFO'])
+		assert m, "Invalid PATH_INFO"
+		db_name = m.group(1)
+		tabletype = "batch"
 
-	if tabletype == "stbcsv":
+	if tabletype == "batch":
+		conn = connect("../shared_tables/%s.db" % db_name)
+		def table(name):
+			server = SharedTableServer("../shared_tables/%s.db" % db_name, name, "stbcsv", conn=conn)
+			server.debug_level = 1
+			return server
+		mime_type = SharedTableServer.response_content_type(os.environ.get('CONTENT_TYPE'))
+	elif tabletype == "stbcsv":
 		table = SharedTableServer("../shared_tables/%s.db" % db_name, tablename, tabletype)
 		table.debug_level = 1
-		mime_type = "application/xml"
+		mime_type = SharedTableServer.response_content_type(os.environ.get('CONTENT_TYPE'))
 	elif tabletype == "geojson":
 		table = GeojsonServer("../shared_tables/%s.db" % db_name, tablename)
 		table.debug_level = 1
@@ -32,11 +63,43 @@ try:
 	else:
 		raise ValueError("invalid table type: %s" % tabletype)
 
-	response = table.handle_request(sys.stdin, os.environ['REMOTE_USER'])
+	# Existing snapshots are sent to cold pulls, but new ones are written
+	# only by the WSGI frontend or from the command line (snapshot.py).
+	if tabletype != "batch":
+		table.snapshots = SnapshotManager(background=False)
 
-	sys.stdout.write("Content-Type: %s\n" % mime_type)
-	sys.stdout.write("\n")
-	sys.stdout.write(response)
+	encoding = response_encoding(os.environ.get('HTTP_ACCEPT_ENCODING'))
+
+	request_body = request_reader(sys.stdin, os.environ.get('HTTP_CONTENT_ENCODING'))
+	if tabletype == "batch":
+		response = handle_batch(request_body, os.environ['REMOTE_USER'], table, os.environ.get('CONTENT_TYPE'))
+	elif tabletype == "stbcsv":
+		response = table.handle_request(request_body, os.environ['REMOTE_USER'], os.environ.get('CONTENT_TYPE'), encoding == "gzip")
+	else:
+		response = table.handle_request(request_body, os.environ['REMOTE_USER'], accept_gzip=(encoding == "gzip"))
+	if isinstance(response, basestring):
+		response = [response]
+
+	# A snapshot is already compressed.
+	if isinstance(response, SnapshotResponse):
+		encoding = response.content_encoding
+		response = mapped_file(response)
+	elif encoding is not None:
+		response = compress_chunks(response, encoding, None if tabletype == "batch" else lambda message: table.debug(1, message))
+
+	# Pull responses are generated as they are sent. Get the first
+	# piece before sending the headers so that errors in setting up
+	# the response are still reported as such.
+	response = iter(response)
+	first = next(response, "")
+
+	raw_stdout.write("Content-Type: %s\n" % mime_type)
+	for name, value in response_headers(encoding):
+		raw_stdout.write("%s: %s\n" % (name, value))
+	raw_stdout.write("\n")
+	raw_stdout.write(first)
+	for chunk in response:
+		raw_stdout.write(chunk)
 
 except Exception as e:
 	import traceback
@@ -0,0 +1,72 @@
+#! /usr/bin/python
+# pycoact/csvdelta.py
+# Copyright 2026, Trinity College Computing Center
+# Last modified: 17 October 2026
+#
+# Cell-level deltas between two versions of a row of an stbcsv table.
+#
+# When only a few cells of a wide row have changed, SharedTable and
+# SharedTableServer can send a delta in place of the whole CSV line.
+# A delta is a JSON list of the number of fields in the row followed
+# by a [column index, field] pair for each cell which differs.
+#
+# The fields are taken from the CSV lines as they are, quotes and all,
+# without being parsed, and a delta is applied by splicing them into
+# the line in place of the old ones. The line which results is therefore
+# exactly the line from which the delta was made, no matter how the CSV
+# writer at either end quotes its fields.
+#
+
+import json
+
+# Split a CSV line into its fields, leaving each as it appears in the
+# line. A comma inside a quoted field does not end it, so where a piece
+# between commas leaves a quote open, the pieces which follow are joined
+# to it until one closes it. (A doubled quote inside a quoted field
+# leaves it open.)
+def split_fields(line):
+	pieces = line.split(',')
+	if '"' not in line:
+		return pieces
+	fields = []
+	field = None
+	for piece in pieces:
+		if field is None:
+			field = piece
+		else:
+			field += ',' + piece
+		if field.count('"') % 2 == 0:
+			fields.append(field)
+			field = None
+	if field is not None:
+		fields.append(field)
+	return fields
+
+# Return the delta which turns base into text, or None if they do not
+# have the same number of columns or the delta would be no shorter
+# than text itself.
+def make_delta(base, text):
+	if base is None or text is None:
+		return None
+	base_fields = split_fields(base)
+	text_fields = split_fields(text)
+	if len(base_fields) != len(text_fields):
+		return None
+	changes = [[i, field] for i, (old, field) in enumerate(zip(base_fields, text_fields)) if field != old]
+	delta = json.dumps([len(text_fields)] + changes, separators=(',',':'))
+	if len(delta) >= len(text):
+		return None
+	return delta
+
+# Apply a delta made by make_delta() to base. Raises ValueError if it
+# was not made from a row with the same number of fields.
+def apply_delta(base, delta):
+	fields = split_fields(base if base is not None else "")
+	changes = json.loads(delta)
+	if changes[0] != len(fields):
+		raise ValueError("delta is for a row of %d fields, not %d" % (changes[0], len(fields)))
+	for i, field in changes[1:]:
+		if not 0 <= i < len(fields):
+			raise ValueError("delta has no column %d" % i)
+		fields[i] = field
+	return ",".join(fields)
@@ -0,0 +1,97 @@
+#! /usr/bin/python
+# pycoact/csvschema.py
+# Copyright 2026, Trinity College Computing Center
+# Last modified: 17 October 2026
+#
+# Changes to the columns of an stbcsv table.
+#
+# Adding, dropping, or renaming a column is recorded on the server as a
+# schema operation stamped with a table version of its own, rather than
+# as a new version of every row (see SharedTableServer.alter() and
+# server/table_modify.py). Clients are sent the operations which they
+# have yet to apply and apply them to their local copies of the rows.
+#
+# An operation is a tuple (tver, op, position, name):
+#
+#   ("add", position, name)     insert a column named name before the
+#                               column now at position (or at the end)
+#   ("drop", position, None)    remove the column at position
+#   ("rename", position, name)  give the column at position a new name
+#
+# Like the deltas of csvdelta.py, the operations work on the fields of
+# the CSV lines as they are, so that the server and the clients arrive
+# at exactly the same lines.
+#
+
+from pycoact.csvdelta import split_fields
+
+ops = ("add", "drop", "rename")
+
+# Quote a value for use as a field of a CSV line as the csv module
+# would (with the default dialect).
+def quote_field(value):
+	for c in (',', '"', '\r', '\n'):
+		if c in value:
+			return '"%s"' % value.replace('"', '""')
+	return value
+
+# The value of a field of a CSV line, unquoted as csv.reader() would
+# leave it
+def unquote_field(field):
+	if field.startswith('"') and field.endswith('"') and len(field) > 1:
+		field = field[1:-1].replace('""', '"')
+	if not isinstance(field, unicode):
+		field = field.decode('utf-8')
+	return field
+
+# Return the value of the field at index in a CSV line without parsing
+# the rest of the line, or an empty string if the line is too short.
+def field_value(line, index):
+	line = line or ""
+	if '"' in line:
+		fields = split_fields(line)
+	else:
+		fields = line.split(',', index + 1)
+	if index >= len(fields):
+		return u""
+	return unquote_field(fields[index])
+
+# Apply a list of operations to a CSV line. The header row (header=True)
+# gets the names of added and renamed columns. The other rows get an
+# empty cell in each added column. Rows which are shorter than the
+# header are padded as needed.
+def apply_ops(line, operations, header=False):
+	fields = split_fields(line or "")
+	for tver, op, position, name in operations:
+		if op == "add":
+			if position > len(fields):
+				fields.extend([""] * (position - len(fields)))
+			fields.insert(position, quote_field(name) if header else "")
+		elif op == "drop":
+			if position < len(fields):
+				del fields[position]
+		elif op == "rename":
+			if header:
+				fields[position] = quote_field(name)
+		else:
+			raise ValueError("unknown schema operation: %s" % op)
+	return ",".join(fields)
+
+# Check a list of operations against the header row to which they are
+# to be applied. Raises ValueError if one of them cannot be.
+def check_ops(header, operations):
+	count = len(split_fields(header))
+	for tver, op, position, name in operations:
+		if op == "add":
+			if not 0 <= position <= count or not name:
+				raise ValueError("cannot add a column at position %d of %d" % (position, count))
+			count += 1
+		elif op == "drop":
+			if not 0 <= position < count or count == 1:
+				raise ValueError("cannot drop column %d of %d" % (position, count))
+			count -= 1
+		elif op == "rename":
+			if not 0 <= position < count or not name:
+				raise ValueError("cannot rename column %d of %d" % (position, count))
+		else:
+			raise ValueError("unknown schema operation: %s" % op)
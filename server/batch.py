@@ -0,0 +1,131 @@
+#! /usr/bin/python
+# pycoact/server/batch.py
+# Copyright 2026, Trinity College Computing Center
+# Last modified: 17 October 2026
+#
+# Requests to several stbcsv tables of the same database in one HTTP
+# request. A client which syncs a dozen tables would otherwise make a
+# dozen requests, each with its own CGI process, connection, and
+# authentication.
+#
+# The batch is posted to /<db>/batch (see coact.cgi and wsgi.py):
+#
+#   <batch>
+#     <table name="..."><request>...</request></table>
+#     ...
+#   </batch>
+#
+# Each <request> is an ordinary pull, push, sync, or alter request and
+# is handled by SharedTableServer.handle_request() as it would be if it
+# had been posted alone, one after another on the same connection. The
+# response holds the responses in the same order:
+#
+#   <batch>
+#     <table name="..."><response>...</response></table>
+#     ...
+#   </batch>
+#
+# The requests are applied one at a time, each in its own transaction,
+# so one which fails does not undo the others. A table whose request
+# failed gets <table name="..." error="..." /> in place of its response.
+#
+# The batch is parsed as it is read, and each response is sent as it is
+# made, so neither the batch nor the responses are ever held in full.
+# Only the first piece of each response is made before any of it is
+# sent. An error by then, which is when almost all errors happen, is
+# reported in place of the response. One later on ends the response of
+# the batch there, as it would that of a request posted alone.
+#
+# If the batch is posted with the content type of stbbin.py, the
+# requests and responses are in that format and the batch is framed as
+# described there.
+#
+
+import re
+import StringIO
+import traceback
+from itertools import chain
+import xml.etree.cElementTree as ET
+
+from pycoact import stbbin
+from pycoact.server.table import BadRequest, XMLRequestReader, XMLResponseWriter, xml_attrib
+
+tablename_re = re.compile(r'[a-z0-9_]+$')
+
+# Handle a batch of requests, read from in_fh, for user username. The
+# server object for each table is got by calling table() with its name.
+# Returns the response as an iterable of strings.
+def handle_batch(in_fh, username, table, content_type=None):
+	if content_type == stbbin.content_type:
+		count, parts = stbbin.open_batch(in_fh)
+		yield stbbin.batch_start(count)
+		for name, error, message in parts:
+			response, error = handle_part(table, name, username,
+				lambda: stbbin.BinaryRequestReader(StringIO.StringIO(message)), stbbin.BinaryResponseWriter())
+			yield stbbin.batch_part_start(name)
+			if response is not None:
+				for piece in response:
+					yield stbbin.batch_piece(piece)
+			yield stbbin.batch_part_end(error or "")
+	else:
+		events = iter(ET.iterparse(in_fh, events=('start', 'end')))
+		event, top = events.next()
+		if top.tag != 'batch':
+			raise BadRequest("not a batch")
+		yield "<batch>\n"
+		for name, req in xml_tables(events, top):
+			if req is None:
+				response, error = None, "no request"
+			else:
+				response, error = handle_part(table, name, username, lambda: req, XMLResponseWriter())
+			if error is not None:
+				yield '<table name="%s" error="%s" />\n' % (xml_attrib(name or ""), xml_attrib(error))
+			else:
+				yield '<table name="%s">' % xml_attrib(name)
+				for piece in response:
+					yield piece
+				yield '</table>\n'
+		yield "</batch>"
+
+# Generate (name, reader) for each <table> of a batch in XML as it is
+# parsed from events, where reader is an XMLRequestReader for its
+# <request>, or None if it has none. The caller must be done with each
+# table before asking for the next.
+def xml_tables(events, top):
+	for event, elem in events:
+		if event == 'end':
+			if elem is top:
+				return
+		elif elem.tag == 'table':
+			event, request = events.next()
+			if event == 'start' and request.tag == 'request':
+				req = XMLRequestReader(None, chain([(event, request)], events))
+				yield (elem.get('name'), req)
+				req.finish()
+			else:
+				yield (elem.get('name'), None)
+			top.clear()
+
+# Handle the request for one table, got by calling read_request(), and
+# write its response with writer. Returns the pieces of the response
+# and None, or None and an error message if the request failed before
+# the first piece was made.
+def handle_part(table, name, username, read_request, writer):
+	if name is None or not tablename_re.match(name):
+		return (None, "invalid table name")
+	server = table(name)
+	try:
+		response = iter(server.dispatch_request(read_request(), writer, username))
+		first = next(response, "")
+	except Exception as e:
+		server.conn.rollback()
+		server.debug(1, "Request for table %s failed:\n%s" % (name, traceback.format_exc()))
+		return (None, "%s: %s" % (type(e).__name__, str(e)))
+	return (part_response(server, chain([first], response)), None)
+
+# The pieces of the response to one request of a batch, after which the
+# transaction in which they were read from the database is ended
+def part_response(server, pieces):
+	for piece in pieces:
+		yield piece
+	server.conn.commit()
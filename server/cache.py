@@ -0,0 +1,93 @@
+#! /usr/bin/python
+# pycoact/server/cache.py
+# Copyright 2026, Trinity College Computing Center
+# Last modified: 17 October 2026
+#
+# Cache of pull responses for the long-running WSGI frontend (see wsgi.py).
+#
+# Many clients are often at the same pulled_version, so many pulls get the
+# same response. Each response is stored under a key which includes the
+# table version at which it was generated, so an entry can never be given
+# out once the table has moved on. Entries for a table are nevertheless
+# dropped as soon as it changes so that they do not take up room until
+# they are pushed out by newer ones.
+#
+# The size of the cache is limited by the total length of the responses
+# in it. The least recently used responses are discarded first.
+#
+
+import threading
+import collections
+
+class ResponseCache(object):
+	def __init__(self, max_bytes=32*1024*1024):
+		self.max_bytes = max_bytes
+
+		# Responses longer than this are not stored, so that a few
+		# full pulls of large tables do not push out everything else.
+		self.max_entry_bytes = max_bytes / 4
+
+		self.lock = threading.Lock()
+		self.entries = collections.OrderedDict()	# least recently used first
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	# Keys are tuples which begin with the database filename and the
+	# table name and end with the table version.
+	def get(self, key):
+		with self.lock:
+			response = self.entries.pop(key, None)
+			if response is None:
+				self.misses += 1
+				return None
+			self.entries[key] = response
+			self.hits += 1
+			return response
+
+	def put(self, key, response):
+		if len(response) > self.max_entry_bytes:
+			return
+		with self.lock:
+			old = self.entries.pop(key, None)
+			if old is not None:
+				self.size -= len(old)
+			self.entries[key] = response
+			self.size += len(response)
+			while self.size > self.max_bytes:
+				old_key, old = self.entries.popitem(last=False)
+				self.size -= len(old)
+				self.evictions += 1
+
+	# Pass on the pieces of a response, keeping a copy which is stored
+	# under key once the response is complete. Responses which grow too
+	# large to be stored are not copied beyond that point.
+	def collect(self, key, pieces):
+		copy = []
+		length = 0
+		for piece in pieces:
+			if copy is not None:
+				copy.append(piece)
+				length += len(piece)
+				if length > self.max_entry_bytes:
+					copy = None
+			yield piece
+		if copy is not None:
+			self.put(key, "".join(copy))
+
+	# Drop all of the responses for a table which has changed.
+	def invalidate(self, filename, tablename):
+		with self.lock:
+			for key in [key for key in self.entries if key[0] == filename and key[1] == tablename]:
+				self.size -= len(self.entries.pop(key))
+
+	def stats(self):
+		with self.lock:
+			return {
+				'entries': len(self.entries),
+				'bytes': self.size,
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+				}
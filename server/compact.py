@@ -0,0 +1,83 @@
+#! /usr/bin/python
+# pycoact/server/compact.py
+# Copyright 2026, Trinity College Computing Center
+# Last modified: 17 October 2026
+#
+# Purge the tombstones of deleted rows which every active client has
+# already pulled.
+#
+# SharedTableServer and GeojsonServer keep a deleted row as a tombstone
+# so that clients hear of the deletion in their next pulls. Each pull
+# records the version which the client has pulled (see meta.py). A client
+# which has not pulled for max_age days is no longer counted as active.
+# The tombstones no newer than the version which every active client has
+# pulled are deleted. If a client we stopped counting comes back, its
+# pulls get a reset and it pulls the whole table again.
+#
+# Clients which have pulled nothing yet do not hold compaction back,
+# since they have nothing to delete. Nor do those part way through their
+# first pull, whether paged or from a snapshot, but the rows they hold
+# may since have been deleted, so if tombstones newer than their place
+# in the pull are purged, they are sent back for a reset (see
+# SharedTableServer.needs_reset()), and snapshots older than the purge
+# are no longer sent.
+#
+# Usage: compact.py <filename> <tablename> [<max_age_days>]
+#
+
+import sys
+import time
+
+from pycoact.server.meta import connect, create_meta, get_table_version, get_purged_version, set_purged_version, get_last_id, set_last_id
+
+# Purge the tombstones of a table. Returns the number purged and the
+# version up to which the table has now been purged.
+def compact(conn, tablename, max_age_days=30):
+	create_meta(conn)
+	cursor = conn.cursor()
+	cursor.execute("begin immediate transaction")
+	try:
+		table_version = get_table_version(conn, tablename)
+
+		cursor.execute("delete from coact_clients where tablename = ? and last_seen < ?",
+			(tablename, int(time.time()) - max_age_days * 86400))
+		cursor.execute("select min(pulled_version) from coact_clients where tablename = ? and pulled_version > 0", (tablename,))
+		horizon = cursor.fetchone()[0]
+		if horizon is None or horizon > table_version:
+			horizon = table_version
+
+		purged_version = get_purged_version(conn, tablename)
+		columns = [row[1] for row in conn.execute("pragma table_info(%s)" % tablename)]
+		count = 0
+		if "deleted" in columns:
+			cursor.execute("select count(*), max(tver) from %s where deleted = 1 and tver <= ?" % tablename, (horizon,))
+			count, max_tver = cursor.fetchone()
+			if count > 0:
+				# The highest id may be among those purged. It must
+				# never be given out again.
+				set_last_id(conn, tablename, get_last_id(conn, tablename))
+
+				cursor.execute("select 1 from sqlite_master where name = ?", ("%s_rtree" % tablename,))
+				if cursor.fetchone() is not None:
+					cursor.execute("delete from %s_rtree where id in (select id from %s where deleted = 1 and tver <= ?)" % (tablename, tablename), (horizon,))
+				cursor.execute("delete from %s where deleted = 1 and tver <= ?" % tablename, (horizon,))
+
+				# Only clients which have pulled less than the newest of
+				# these tombstones can have missed any of them.
+				purged_version = max(purged_version, max_tver)
+				set_purged_version(conn, tablename, purged_version)
+
+		conn.commit()
+	except:
+		conn.rollback()
+		raise
+
+	return (count, purged_version)
+
+if __name__ == "__main__":
+	if len(sys.argv) not in (3, 4):
+		sys.stderr.write("Usage: %s <filename> <tablename> [<max_age_days>]\n" % sys.argv[0])
+		sys.exit(1)
+	conn = connect(sys.argv[1])
+	count, purged_version = compact(conn, sys.argv[2], *[int(arg) for arg in sys.argv[3:]])
+	print "%d tombstones purged, table purged up to version %d" % (count, purged_version)
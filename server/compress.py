@@ -0,0 +1,101 @@
+#! /usr/bin/python
+# pycoact/server/compress.py
+# Copyright 2026, Trinity College Computing Center
+# Last modified: 17 October 2026
+#
+# Content-Encoding support for the CGI and WSGI frontends: compressed
+# request bodies are decompressed as they are read and responses are
+# compressed as they are sent if the client says that it can take them.
+#
+
+import re
+import zlib
+
+# Content codings which we can both decompress and produce. We tell
+# the clients about these in an Accept-Encoding response header
+# (RFC 7694) so that they know they can compress their requests.
+supported_encodings = ("gzip", "deflate")
+
+# File-like reader which decompresses a gzip or deflate request body
+# as it is read.
+class DecompressingReader(object):
+	def __init__(self, fh, encoding):
+		if encoding not in supported_encodings:
+			raise ValueError("unsupported Content-Encoding: %s" % encoding)
+		self.fh = fh
+		self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)	# gzip or zlib header
+		self.buffer = ""
+		self.eof = False
+		self.raw_bytes = 0
+		self.bytes = 0
+
+	def read(self, size=-1):
+		while not self.eof and (size < 0 or len(self.buffer) < size):
+			data = self.fh.read(65536)
+			if data:
+				self.raw_bytes += len(data)
+				self.buffer += self.decompressor.decompress(data)
+			else:
+				self.buffer += self.decompressor.flush()
+				self.eof = True
+		if size < 0:
+			size = len(self.buffer)
+		data = self.buffer[:size]
+		self.buffer = self.buffer[size:]
+		self.bytes += len(data)
+		return data
+
+# Wrap the request body so that it is read decompressed, if the
+# Content-Encoding says that it is compressed.
+def request_reader(fh, content_encoding):
+	content_encoding = (content_encoding or "").strip().lower()
+	if content_encoding in ("", "identity"):
+		return fh
+	return DecompressingReader(fh, content_encoding)
+
+# Pick the content coding for the response from the request's
+# Accept-Encoding header. Returns None if it should not be compressed.
+def response_encoding(accept_encoding):
+	accepted = {}
+	for item in (accept_encoding or "").split(","):
+		m = re.match(r'\s*([a-z0-9*-]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?\s*$', item.lower())
+		if m:
+			accepted[m.group(1)] = float(m.group(2)) if m.group(2) else 1.0
+	for encoding in supported_encodings:
+		if accepted.get(encoding, accepted.get("*", 0)) > 0:
+			return encoding
+	return None
+
+# Compress the chunks of a response as they are sent. If log is given,
+# it is called at the end with the number of bytes before and after
+# compression.
+def compress_chunks(chunks, encoding, log=None, level=6):
+	if encoding == "gzip":
+		compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	elif encoding == "deflate":
+		compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+	else:
+		raise ValueError("unsupported Content-Encoding: %s" % encoding)
+	raw_bytes = 0
+	compressed_bytes = 0
+	for chunk in chunks:
+		raw_bytes += len(chunk)
+		data = compressor.compress(chunk)
+		if data:
+			compressed_bytes += len(data)
+			yield data
+	data = compressor.flush()
+	compressed_bytes += len(data)
+	yield data
+	if log is not None:
+		log("Response %d bytes, %d bytes %s" % (raw_bytes, compressed_bytes, encoding))
+
+# Headers to send along with a response in the given encoding.
+def response_headers(encoding):
+	headers = [
+		('Vary', 'Accept-Encoding'),
+		('Accept-Encoding', ", ".join(supported_encodings)),
+		]
+	if encoding is not None:
+		headers.append(('Content-Encoding', encoding))
+	return headers
@@ -1,7 +1,7 @@
 #! /usr/bin/python
 # pycoact/server/geojson.py
 # Copyright 2013, Trinity College Computing Center
-# Last modified: 22 August 2013
+# Last modified: 17 October 2026
 
 import json
 import sqlite3
@@ -9,92 +9,495 @@ import re
 import os
 import sys
 
+from pycoact.server.meta import connect, create_meta, register_table, get_table_version, set_table_version, record_client, get_purged_version, \
+	get_last_id, set_last_id
+from pycoact.server.table import chunked
+
+# Generate the first piece of a response at once, so that errors in
+# setting it up, such as a missing table, are raised here rather than
+# once the response is being sent (compare PooledResponse.first() in
+# wsgi.py). Returns a generator of the same pieces.
+def started(pieces):
+	pieces = iter(pieces)
+	first = next(pieces, None)
+	def generate():
+		try:
+			if first is not None:
+				yield first
+			for piece in pieces:
+				yield piece
+		finally:
+			close = getattr(pieces, 'close', None)
+			if close is not None:
+				close()
+	return generate()
+
 class GeojsonServer(object):
-	def __init__(self, filename, tablename):
-		self.conn = sqlite3.connect(filename)
+	def __init__(self, filename, tablename, conn=None):
+		self.conn = conn if conn is not None else connect(filename)
 		self.conn.row_factory = sqlite3.Row
+		self.filename = filename
 		self.tablename = tablename
 		self.debug_level = 0
+		self.notifier = None		# see SharedTableServer.__init__()
+		self.cache = None
+		self.snapshots = None
+
+		# The columns of the table. See has_column().
+		self.columns = None
+
+		# Does the table have a spatial index? See has_spatial_index().
+		self.spatial_index = None
 
 	def debug(self, level, message):
 		if self.debug_level >= level:
 			sys.stderr.write("GeojsonServer: %s\n" % message)
 
+	# See SharedTableServer.table_version()
 	def table_version(self):
-		cursor = self.conn.cursor()
-		cursor.execute("select max(tver) from %s" % self.tablename)
-		version = cursor.fetchone()[0]
-		version = 0 if version is None else int(version)
+		version = get_table_version(self.conn, self.tablename)
 		self.debug(1, "Current table version: %d" % version)
 		return version
 
+	# See SharedTableServer.wait_for_change()
+	def wait_for_change(self, pulled_version, timeout):
+		if self.notifier is None or timeout <= 0:
+			return
+		current = self.table_version()
+		if current <= pulled_version:
+			self.debug(1, "Waiting up to %s seconds for a change" % timeout)
+			if not self.notifier.wait(self.filename, self.tablename, pulled_version, current, timeout):
+				self.debug(1, "Wait timed out")
+
+	# See SharedTableServer.notify_change()
+	def notify_change(self, tver):
+		if self.cache is not None:
+			self.cache.invalidate(self.filename, self.tablename)
+		if self.notifier is not None:
+			self.notifier.notify(self.filename, self.tablename, tver)
+		if self.snapshots is not None:
+			self.snapshots.table_changed(self, tver)
+
+	def reopen(self):
+		return GeojsonServer(self.filename, self.tablename)
+
 	# Create the database table
+	#
+	# The data column holds each feature as the client sent it, less its
+	# id and version. The feature column holds it as load() sends it,
+	# with the id and version, so that it can be sent without being
+	# parsed. Rows saved before there was a feature column do not have it.
+	#
+	# A deleted feature is kept as a tombstone with deleted set to 1, as
+	# in SharedTableServer.create().
+	#
+	# The bounding box of each feature's geometry is kept in an R-tree
+	# (see create_spatial_index()) for loads limited to a bounding box.
 	def create(self):
 		cursor = self.conn.cursor()
-		cursor.execute("create table %s (id integer primary key, version integer, tver integer, user varchar, data text)" % self.tablename)
+		cursor.execute("create table %s (id integer primary key, version integer, tver integer, user varchar, data text, feature text, deleted integer not null default 0)" % self.tablename)
 		cursor.execute("create index %s_idx on %s (tver)" % (self.tablename, self.tablename))
+		self.create_spatial_index()
+		register_table(self.conn, self.tablename)
+
+	# Tables created by earlier versions lack some of the columns. They
+	# are added by upgrade(), perhaps in another process, so as in
+	# SharedTableServer.has_column() a missing one is looked for again.
+	def has_column(self, name):
+		if self.columns is None or name not in self.columns:
+			self.columns = set([row[1] for row in self.conn.execute("pragma table_info(%s)" % self.tablename)])
+		return name in self.columns
+
+	# Add whatever an older table lacks. This cannot be done inside
+	# a transaction. Whatever another process adds first is left as
+	# it is.
+	def upgrade(self):
+		for column, definition in (("feature", "text"), ("deleted", "integer not null default 0")):
+			if not self.has_column(column):
+				try:
+					self.conn.execute("alter table %s add column %s %s" % (self.tablename, column, definition))
+				except sqlite3.OperationalError as e:
+					if "duplicate column name" not in str(e):
+						raise
+				self.columns.add(column)
+		if not self.has_spatial_index():
+			try:
+				self.create_spatial_index()
+				self.conn.commit()
+			except sqlite3.OperationalError as e:
+				self.conn.rollback()
+				if "already exists" not in str(e):
+					raise
+				self.spatial_index = True
+
+	# See SharedTableServer.needs_reset()
+	def needs_reset(self, pulled_version):
+		return pulled_version > 0 and pulled_version < get_purged_version(self.conn, self.tablename)
+
+	def has_spatial_index(self):
+		if not self.spatial_index:
+			cursor = self.conn.cursor()
+			cursor.execute("select 1 from sqlite_master where name = ?", ("%s_rtree" % self.tablename,))
+			self.spatial_index = cursor.fetchone() is not None
+		return self.spatial_index
 
-	def handle_request(self, data_handle, username):
+	# Create the R-tree of the bounding boxes of the features and fill it
+	# from the features already in the table. Features without a geometry
+	# are left out of it.
+	def create_spatial_index(self):
+		cursor = self.conn.cursor()
+		cursor.execute("create virtual table %s_rtree using rtree (id, minx, maxx, miny, maxy)" % self.tablename)
+		cursor.execute("select id, data from %s" % self.tablename)
+		self.index_features(cursor, [(row['id'], self.geometry_bbox(json.loads(row['data']).get('geometry'))) for row in cursor.fetchall()])
+		self.spatial_index = True
+
+	# Put features into the spatial index, given (id, bbox) for each,
+	# replacing their old bounding boxes.
+	def index_features(self, cursor, features):
+		cursor.executemany("insert or replace into %s_rtree (id, minx, maxx, miny, maxy) values (?, ?, ?, ?, ?)" % self.tablename,
+			[(id,) + bbox for id, bbox in features if bbox is not None])
+		cursor.executemany("delete from %s_rtree where id = ?" % self.tablename,
+			[(id,) for id, bbox in features if bbox is None])
+
+	# Return the bounding box of a GeoJSON geometry as (minx, maxx, miny,
+	# maxy), the order of the columns of the R-tree, or None if it has no
+	# coordinates.
+	@staticmethod
+	def geometry_bbox(geometry):
+		xs = []
+		ys = []
+		def walk(geometry):
+			if geometry is None:
+				return
+			if geometry.get('type') == 'GeometryCollection':
+				for member in geometry.get('geometries', []):
+					walk(member)
+				return
+			stack = [geometry.get('coordinates')]
+			while stack:
+				coordinates = stack.pop()
+				if not isinstance(coordinates, list) or len(coordinates) == 0:
+					continue
+				if isinstance(coordinates[0], list):
+					stack.extend(coordinates)
+				elif len(coordinates) >= 2:
+					xs.append(coordinates[0])
+					ys.append(coordinates[1])
+		walk(geometry)
+		if not xs:
+			return None
+		return (min(xs), max(xs), min(ys), max(ys))
+
+	# Return a feature (given as the JSON in the data column) as load()
+	# sends it. It is put together exactly as load() once did it, so the
+	# bytes are the same.
+	@staticmethod
+	def feature_json(data, id, version):
+		feature = json.loads(data)
+		feature['id'] = id
+		feature['version'] = version
+		return json.dumps(feature, separators=(',',':'))
+
+	# The CGI frontend leaves environ as None so that the request
+	# method and query string are taken from the process environment.
+	#
+	# See SharedTableServer.handle_request() for accept_gzip.
+	def handle_request(self, data_handle, username, environ=None, accept_gzip=False):
+		if environ is None:
+			environ = os.environ
 		try:
-			if os.environ["REQUEST_METHOD"] == "GET":
-				result = self.load(os.environ["QUERY_STRING"])
-			elif os.environ["REQUEST_METHOD"] == "POST":
+			if environ["REQUEST_METHOD"] == "GET":
+				response = self.load_response(environ["QUERY_STRING"], accept_gzip, username)
+				if getattr(response, 'content_encoding', None) is not None:
+					return response		# a snapshot
+				return started(response)
+			elif environ["REQUEST_METHOD"] == "POST":
 				data = json.load(data_handle)
 				result = self.save(data, username)
 			else:
 				raise AssertionError
 			return json.dumps(result, separators=(',',':'))
 		except Exception as e:
+			self.conn.rollback()
 			import traceback, sys
 			sys.stderr.write(traceback.format_exc(sys.exc_info()[2]))
 			return json.dumps({"error":str(e)})
 
-	def load(self, query_string):
-		self.debug(1, "load(%s)" % query_string)
+	# Answer a GET. The query string is pulled_version=<tver>, optionally
+	# followed by &bbox=<west>,<south>,<east>,<north> to load only the
+	# features whose bounding boxes intersect that one, and then by
+	# &wait=<seconds> to wait for changes if there are none yet, and then
+	# by &client_id=<id> to tell this client apart from the user's others
+	# (see meta.py). If there
+	# is a cache or a snapshot (see SharedTableServer.__init__()), the
+	# response may come from it.
+	#
+	# If the tombstones which the client has yet to see have been purged
+	# (see compact.py), it is sent everything from version 0 with a reset
+	# in the repository member and should drop the features it has.
+	def load_response(self, query_string, accept_gzip=False, username=None):
+		self.debug(1, "load_response(%s)" % query_string)
 
-		m = re.match("^pulled_version=([-\d]+)$", query_string)
+		m = re.match("^pulled_version=([-\d]+)(?:&bbox=([-\d.eE]+),([-\d.eE]+),([-\d.eE]+),([-\d.eE]+))?(?:&wait=([\d.]+))?(?:&client_id=([0-9A-Za-z_-]+))?$", query_string)
 		if not m:
 			raise AssertionError
 		tver = int(m.group(1))
+		bbox = None
+		if m.group(2) is not None:
+			west, south, east, north = [float(m.group(i)) for i in range(2, 6)]
+			bbox = (west, east, south, north)
+		if username is not None:
+			record_client(self.conn, self.tablename, username, m.group(7), tver)
+		if m.group(6) is not None:
+			self.wait_for_change(tver, float(m.group(6)))
+
+		if tver == 0 and bbox is None and accept_gzip and self.snapshots is not None:
+			response = self.snapshots.response(self, "geojson", self.table_version())
+			if response is not None:
+				return response
+
+		return chunked(self.load_transaction(tver, bbox))
+
+	# Generate the response to a load in a read transaction of its own,
+	# getting it from the cache if it is there.
+	def load_transaction(self, tver, bbox=None):
+		cursor = self.conn.cursor()
+		cursor.execute("begin transaction")
+		try:
+			reset = self.needs_reset(tver)
+			if reset:
+				tver = 0
+			response = self.load(tver, bbox, reset)
+			if self.cache is not None:
+				# The response is cached under the version read
+				# in the same transaction as the rows.
+				key = (self.filename, self.tablename, "geojson", tver, bbox, reset, self.table_version())
+				cached = self.cache.get(key)
+				if cached is not None:
+					self.debug(1, "Response found in cache")
+					yield cached
+					return
+				response = self.cache.collect(key, response)
+			for piece in response:
+				yield piece
+		finally:
+			self.conn.rollback()		# nothing to commit, just release the lock
+
+	# Write the response to a load from version 0 to fh for a snapshot
+	# (see snapshot.py). Returns the table version or None if the
+	# table is empty.
+	def write_snapshot(self, fh, format):
+		cursor = self.conn.cursor()
+		cursor.execute("begin transaction")
+		try:
+			table_version = self.table_version()
+			if table_version == 0:
+				return None
+			for piece in self.load(0):
+				fh.write(piece)
+			return table_version
+		finally:
+			self.conn.rollback()
+
+	# Generate the pieces of the JSON FeatureCollection of the features
+	# changed after version tver. The stored JSON of each feature is sent
+	# as it is, so the features are never held in memory all at once.
+	# Deleted features are sent as tombstones: features with no geometry
+	# or properties and "deleted":true.
+	#
+	# If bbox is given as (minx, maxx, miny, maxy), only the features
+	# whose bounding boxes intersect it are sent in full. The
+	# pulled_version is still that of the latest change to the whole
+	# table, so a feature changed since the client's last load which is
+	# now outside the box may be one which the client has and which has
+	# moved out of it. Such features are sent, like tombstones, with no
+	# geometry or properties but with "filtered":true, and the client
+	# should drop them if it has them. (A load from version 0 sends only
+	# the features inside the box, since the client has nothing to drop.)
+	# Tombstones keep the bounding boxes of the features they replace
+	# and are sent only if they are inside the box.
+	#
+	# The caller should have a read transaction open so that the rows
+	# and the pulled_version agree.
+	def load(self, tver, bbox=None, reset=False):
+		self.debug(1, "load(%d, %s)" % (tver, str(bbox)))
 
 		cursor = self.conn.cursor()
-		qres = cursor.execute("select * from %s where tver > ?" % self.tablename, (tver,))
-		features = []
-		for row in qres:
-			feature = json.loads(row['data'])
-			feature['id'] = row['id']
-			feature['version'] = row['version']
-			features.append(feature)
-			tver = max(tver, row['tver'])
-		return {"type":"FeatureCollection","features":features,"repository":{"pulled_version":tver}}
+		cursor.execute("select max(tver) from %s where tver > ?" % self.tablename, (tver,))
+		pulled_version = cursor.fetchone()[0]
+		if pulled_version is None:
+			pulled_version = tver
+
+		# The newest changes may have been tombstones which have since
+		# been purged. The client has nonetheless seen everything up to
+		# them and must not be sent back for a reset.
+		pulled_version = max(pulled_version, get_purged_version(self.conn, self.tablename))
+
+		# Let json.dumps() lay out everything but the features, so that
+		# the keys come out in the same order as they always have.
+		repository = {"pulled_version":pulled_version}
+		if reset:
+			repository["reset"] = True
+		envelope = json.dumps({"type":"FeatureCollection","features":[],"repository":repository}, separators=(',',':'))
+		split = envelope.index('"features":[') + len('"features":[')
+		yield envelope[:split]
 
+		# Rows as (row, whether it is inside the box)
+		if bbox is None:
+			rows = ((row, True) for row in cursor.execute("select * from %s where tver > ?" % self.tablename, (tver,)))
+		elif self.has_spatial_index():
+			minx, maxx, miny, maxy = bbox
+			inside = "r.minx <= ? and r.maxx >= ? and r.miny <= ? and r.maxy >= ?"
+			if tver == 0:
+				rows = ((row, True) for row in cursor.execute("select t.* from %s as t, %s_rtree as r where r.id = t.id and %s and t.tver > ?"
+					% (self.tablename, self.tablename, inside), (maxx, minx, maxy, miny, tver)))
+			else:
+				rows = ((row, row['inside']) for row in cursor.execute("select t.*, r.id is not null and %s as inside from %s as t left join %s_rtree as r on r.id = t.id where t.tver > ?"
+					% (inside, self.tablename, self.tablename), (maxx, minx, maxy, miny, tver)))
+		else:
+			# Not yet indexed (see save()), so check each feature here.
+			# The boxes of tombstones are not known, so they are all sent.
+			has_deleted_column = self.has_column("deleted")
+			rows = ((row, (has_deleted_column and row['deleted']) or self.bbox_intersects(self.geometry_bbox(json.loads(row['data']).get('geometry')), bbox))
+				for row in cursor.execute("select * from %s where tver > ?" % self.tablename, (tver,)))
+
+		has_feature_column = self.has_column("feature")
+		has_deleted_column = self.has_column("deleted")
+		separator = ""
+		for row, inside in rows:
+			if not inside:
+				if tver == 0 or (has_deleted_column and row['deleted']):
+					continue
+				feature = json.dumps(dict(self.filtered, id=row['id'], version=row['version']), separators=(',',':'))
+			else:
+				feature = row['feature'] if has_feature_column else None
+				if feature is None:
+					feature = self.feature_json(row['data'], row['id'], row['version'])
+			yield separator + str(feature)
+			separator = ","
+
+		yield envelope[split:]
+
+	# What a feature outside the bounding box of a load is sent as
+	filtered = {"type":"Feature","geometry":None,"properties":None,"filtered":True}
+
+	@staticmethod
+	def bbox_intersects(a, b):
+		return a is not None and a[0] <= b[1] and a[1] >= b[0] and a[2] <= b[3] and a[3] >= b[2]
+
+	# Save the features of a FeatureCollection. Features with an id and a
+	# version are changes to existing features. They are accepted only if
+	# the feature is still at the version which the client sent, that is,
+	# if nobody else has changed it since the client loaded it. Features
+	# with an id, a version and "deleted":true are deletions, which are
+	# accepted on the same terms. Features without an id are new.
+	#
+	# Clients written before versions were checked send features with an
+	# id but no version. Those changes are applied to whatever version the
+	# feature is now at, as they always were, so the last save wins.
+	#
+	# Returns a list with an [id, version, status] for each feature in
+	# the order in which they were sent. The status is "ok" if the change
+	# was accepted (version is then the new version), "conflict" if it
+	# was not (version is the feature's current version, or None if it
+	# no longer exists), or "new" for new features.
 	def save(self, data, username):
 		self.debug(1, "save(-, %s)" % username)
 
+		# Take the write lock before reading the table version so that
+		# no other save can be given the same one.
+		create_meta(self.conn)
+		self.upgrade()
 		cursor = self.conn.cursor()
+		cursor.execute("begin immediate transaction")
 		tver = self.table_version()
 		tver += 1
-		result = []
+
 		assert data['type'] == 'FeatureCollection', data['type']
-		for feature in data['features']:
+		modified = []
+		new = []
+		for seq, feature in enumerate(data['features']):
 			id = feature.get('id')
 			version = feature.get('version')
-			if id is not None:
+			deleted = id is not None and feature.get('deleted') is True
+			if deleted:
+				feature = self.tombstone
+			elif id is not None:
 				del feature['id']
-				del feature['version']
+				feature.pop('version', None)
 			as_json = json.dumps(feature,separators=(',',':'))
-
+			bbox = self.geometry_bbox(feature.get('geometry'))
 			if id is not None:
-				cursor.execute("update %s set version=version+1, tver=?, user=?, data=? where id=?" % self.tablename, (tver, username, as_json, id))
-				cursor.execute("select version from %s where id = ?" % self.tablename, (id,))
-				version = cursor.fetchone()[0]
-				result.append((id, version))
+				modified.append((seq, id, version, as_json, bbox, deleted))
 			else:
-				cursor.execute("insert into %s (version, tver, user, data) values (1,?,?,?)" % self.tablename, (tver, username, as_json))
-				result.append((cursor.lastrowid, 1))
+				new.append((seq, as_json, bbox))
+
+		results = self.update_features(modified, tver, username)
+		results.extend(self.insert_features(new, tver, username))
 
+		self.debug(1, "Features submitted: %d" % len(results))
+		changed = len([result for result in results if result[1][2] != "conflict"])
+		self.debug(1, "Features accepted: %d" % changed)
+
+		if changed > 0:
+			set_table_version(self.conn, self.tablename, tver)
 		self.conn.commit()
-		return result
+		if changed > 0:
+			self.notify_change(tver)
+
+		results.sort()
+		return [result for seq, result in results]
+
+	# What a deleted feature is replaced with
+	tombstone = {"type":"Feature","geometry":None,"properties":None,"deleted":True}
+
+	# Apply changes to existing features. Takes (seq, id, version, data,
+	# bbox, deleted) for each and returns (seq, [id, version, status]).
+	#
+	# They are applied one at a time. Doing it with set-based statements
+	# through a temporary table was tried, but for saves of thousands of
+	# features it was no quicker, since most of the time goes on the
+	# JSON of each feature and its place in the R-tree either way.
+	#
+	# Deleted features are left in the spatial index so that loads limited
+	# to a bounding box send their tombstones. Tombstones cannot be changed.
+	def update_features(self, features, tver, username):
+		cursor = self.conn.cursor()
+		results = []
+		for seq, id, version, as_json, bbox, deleted in features:
+			if version is None:
+				cursor.execute("select version from %s where id = ? and deleted = 0" % self.tablename, (id,))
+				row = cursor.fetchone()
+				if row is not None:
+					version = row[0]
+			feature = self.feature_json(as_json, id, version + 1) if version is not None else None
+			cursor.execute("update %s set version=version+1, tver=?, user=?, data=?, feature=?, deleted=? where id=? and version=? and deleted=0" % self.tablename, (tver, username, as_json, feature, int(deleted), id, version))
+			if cursor.rowcount > 0:
+				if not deleted:
+					self.index_features(cursor, [(id, bbox)])
+				results.append((seq, [id, version + 1, "ok"]))
+			else:
+				self.debug(1, "conflict on feature %s" % id)
+				cursor.execute("select version from %s where id = ?" % self.tablename, (id,))
+				row = cursor.fetchone()
+				results.append((seq, [id, row[0] if row is not None else None, "conflict"]))
+		return results
+
+	# Insert new features, giving them the ids which follow the highest
+	# one ever given out (see meta.py). Takes (seq, data, bbox) for each
+	# and returns (seq, [id, 1, "new"]).
+	def insert_features(self, features, tver, username):
+		if len(features) == 0:
+			return []
+		cursor = self.conn.cursor()
+		id = get_last_id(self.conn, self.tablename)
+		id = 0 if id is None else id
+		ids = range(id + 1, id + 1 + len(features))
+		set_last_id(self.conn, self.tablename, ids[-1])
+		cursor.executemany("insert into %s (id, version, tver, user, data, feature) values (?, 1, ?, ?, ?, ?)" % self.tablename,
+			[(id, tver, username, as_json, self.feature_json(as_json, id, 1)) for id, (seq, as_json, bbox) in zip(ids, features)])
+		self.index_features(cursor, [(id, bbox) for id, (seq, as_json, bbox) in zip(ids, features)])
+		return [(seq, [id, 1, "new"]) for id, (seq, as_json, bbox) in zip(ids, features)]
 
 if __name__ == "__main__":
 	import sys
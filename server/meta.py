@@ -0,0 +1,244 @@
+#! /usr/bin/python
+# pycoact/server/meta.py
+# Copyright 2026, Trinity College Computing Center
+# Last modified: 17 October 2026
+#
+# Per-table bookkeeping which SharedTableServer and GeojsonServer keep
+# in the coact_tables table of each database.
+#
+# Deleted rows are kept as tombstones so that clients learn of the
+# deletions when they pull. coact_clients records the version each
+# client last pulled, so that compact.py can tell which tombstones every
+# client has seen, and coact_purges the version up to which they have
+# been purged. A client which has pulled less than that must pull the
+# table again from the start. A user may have the table on several
+# devices, each of which has pulled as far as it has, so clients are
+# told apart by the client_id which they send with their pulls. Those
+# which send none are recorded under an empty client_id.
+#
+# coact_ids records the highest row id ever given out in each table.
+# New rows cannot be numbered from the highest id in the table, since
+# that may have belonged to a tombstone which has been purged, and a
+# client with a change to the old row would then overwrite the new one.
+#
+# coact_schema_ops is the log of the changes to the columns of stbcsv
+# tables (see csvschema.py). Each operation is stamped with the table
+# version at which it was made.
+#
+# coact_filter_columns lists the columns of stbcsv tables on which pulls
+# may be filtered, each with the column of the table's side table (see
+# SharedTableServer.add_filter_column()) which holds its values.
+#
+
+import sys
+import time
+import sqlite3
+
+# Open a database. It is put into write-ahead logging mode, which sticks
+# to the file, so that the read transaction of a pull being streamed to
+# a slow client does not hold off pushes as the shared lock of the
+# rollback journal would. If the database is busy, the mode is left for
+# a later connection to set.
+def connect(filename, **kwargs):
+	conn = sqlite3.connect(filename, **kwargs)
+	try:
+		conn.execute("pragma journal_mode=wal")
+	except sqlite3.OperationalError:
+		pass
+	return conn
+
+# Create the metadata tables if this database does not have them yet.
+def create_meta(conn):
+	cursor = conn.cursor()
+	cursor.execute("create table if not exists coact_tables (tablename varchar primary key, tver integer not null)")
+	columns = [row[1] for row in cursor.execute("pragma table_info(coact_clients)")]
+	if len(columns) > 0 and "client_id" not in columns:
+		upgrade_clients(conn)
+	cursor.execute("create table if not exists coact_clients (tablename varchar, username varchar, client_id varchar not null default '', pulled_version integer not null, last_seen integer not null, primary key (tablename, username, client_id))")
+	cursor.execute("create table if not exists coact_purges (tablename varchar primary key, tver integer not null)")
+	cursor.execute("create table if not exists coact_ids (tablename varchar primary key, last_id integer not null)")
+	cursor.execute("create table if not exists coact_schema_ops (tablename varchar, tver integer not null, seq integer not null, op varchar not null, position integer not null, name varchar, primary key (tablename, tver, seq))")
+	cursor.execute("create table if not exists coact_filter_columns (tablename varchar, name varchar not null, field varchar not null, primary key (tablename, field))")
+
+# coact_clients was once kept by user alone. Its primary key cannot be
+# changed in place, so the table is copied into a new one. If another
+# process does this at the same time, one of them finds it done.
+def upgrade_clients(conn):
+	cursor = conn.cursor()
+	try:
+		cursor.execute("alter table coact_clients rename to coact_clients_old")
+	except sqlite3.OperationalError:
+		conn.rollback()
+		return
+	cursor.execute("create table coact_clients (tablename varchar, username varchar, client_id varchar not null default '', pulled_version integer not null, last_seen integer not null, primary key (tablename, username, client_id))")
+	cursor.execute("insert into coact_clients (tablename, username, client_id, pulled_version, last_seen) select tablename, username, '', pulled_version, last_seen from coact_clients_old")
+	cursor.execute("drop table coact_clients_old")
+	conn.commit()
+
+# Add a newly-created table to the metadata table at version 0.
+def register_table(conn, tablename):
+	create_meta(conn)
+	set_table_version(conn, tablename, 0)
+	conn.commit()
+
+# Return the current version of the named table. Tables created before
+# the metadata table existed fall back to the highest tver in any of their
+# rows until the first push records a version for them (or until migrate()
+# is run).
+def get_table_version(conn, tablename):
+	cursor = conn.cursor()
+	try:
+		cursor.execute("select tver from coact_tables where tablename = ?", (tablename,))
+		row = cursor.fetchone()
+	except sqlite3.OperationalError:		# no coact_tables yet
+		row = None
+	if row is not None:
+		return int(row[0])
+	return rows_table_version(conn, tablename)
+
+# Record a new current version for the named table. This must be done
+# in the same transaction as the changes which are stamped with it.
+def set_table_version(conn, tablename, tver):
+	cursor = conn.cursor()
+	cursor.execute("insert or replace into coact_tables (tablename, tver) values (?, ?)", (tablename, tver))
+
+# Find the version of the named table from the highest tver in any of
+# its rows. This is how the version was determined before it was stored.
+def rows_table_version(conn, tablename):
+	cursor = conn.cursor()
+	cursor.execute("select max(tver) from %s" % tablename)
+	tver = cursor.fetchone()[0]
+	return 0 if tver is None else int(tver)
+
+# Record that a client of a user has pulled the named table up to
+# pulled_version. This commits. It is only bookkeeping, so if the
+# database is locked by a push, we do without rather than wait.
+def record_client(conn, tablename, username, client_id, pulled_version):
+	now = int(time.time())
+	client_id = client_id or ""
+	try:
+		cursor = conn.cursor()
+		cursor.execute("select pulled_version, last_seen from coact_clients where tablename = ? and username = ? and client_id = ?", (tablename, username, client_id))
+		row = cursor.fetchone()
+		# Leave it alone if it is up to date and was checked within the hour
+		if row is not None and row[0] == pulled_version and now - row[1] < 3600:
+			return
+		cursor.execute("insert or replace into coact_clients (tablename, username, client_id, pulled_version, last_seen) values (?, ?, ?, ?, ?)",
+			(tablename, username, client_id, pulled_version, now))
+		conn.commit()
+	except sqlite3.OperationalError:		# locked, or no metadata tables yet
+		conn.rollback()
+
+# Return the version up to which the tombstones of the named table have
+# been purged, or 0 if they never have been.
+def get_purged_version(conn, tablename):
+	cursor = conn.cursor()
+	try:
+		cursor.execute("select tver from coact_purges where tablename = ?", (tablename,))
+		row = cursor.fetchone()
+	except sqlite3.OperationalError:		# no coact_purges yet
+		row = None
+	return 0 if row is None else int(row[0])
+
+def set_purged_version(conn, tablename, tver):
+	cursor = conn.cursor()
+	cursor.execute("insert or replace into coact_purges (tablename, tver) values (?, ?)", (tablename, tver))
+
+# Return the highest row id ever given out in the named table, or None
+# if there has never been a row. For tables which have no entry yet this
+# is the highest id in the table, which compact.py records before it
+# purges anything.
+def get_last_id(conn, tablename):
+	cursor = conn.cursor()
+	try:
+		cursor.execute("select last_id from coact_ids where tablename = ?", (tablename,))
+		row = cursor.fetchone()
+	except sqlite3.OperationalError:		# no coact_ids yet
+		row = None
+	cursor.execute("select max(id) from %s" % tablename)
+	max_id = cursor.fetchone()[0]
+	ids = [int(id) for id in (row[0] if row is not None else None, max_id) if id is not None]
+	return max(ids) if len(ids) > 0 else None
+
+# Record the highest row id given out. This must be done in the same
+# transaction as the insertion of the rows.
+def set_last_id(conn, tablename, last_id):
+	cursor = conn.cursor()
+	cursor.execute("insert or replace into coact_ids (tablename, last_id) values (?, ?)", (tablename, last_id))
+
+# Return the schema operations made on the named table after version
+# tver as a list of (tver, op, position, name) in the order in which
+# they were made.
+def get_schema_ops(conn, tablename, tver=0):
+	cursor = conn.cursor()
+	try:
+		cursor.execute("select tver, op, position, name from coact_schema_ops where tablename = ? and tver > ? order by tver, seq", (tablename, tver))
+		return [tuple(row) for row in cursor]
+	except sqlite3.OperationalError:		# no coact_schema_ops yet
+		return []
+
+# The version at which the last schema operation was made on the named
+# table, or 0 if none ever has been
+def get_schema_version(conn, tablename):
+	cursor = conn.cursor()
+	try:
+		cursor.execute("select max(tver) from coact_schema_ops where tablename = ?", (tablename,))
+		tver = cursor.fetchone()[0]
+	except sqlite3.OperationalError:		# no coact_schema_ops yet
+		tver = None
+	return 0 if tver is None else int(tver)
+
+# Record schema operations, given as (op, position, name), made at
+# version tver. This must be done in the same transaction as the
+# changes to the rows.
+def add_schema_ops(conn, tablename, tver, operations):
+	cursor = conn.cursor()
+	cursor.executemany("insert into coact_schema_ops (tablename, tver, seq, op, position, name) values (?, ?, ?, ?, ?, ?)",
+		[(tablename, tver, seq, op, position, name) for seq, (op, position, name) in enumerate(operations)])
+
+# Return the columns of the named table on which pulls may be filtered
+# as a dict of column names to the fields of the side table which hold
+# their values.
+def get_filter_columns(conn, tablename):
+	cursor = conn.cursor()
+	try:
+		cursor.execute("select name, field from coact_filter_columns where tablename = ?", (tablename,))
+		return dict([(name, field) for name, field in cursor])
+	except sqlite3.OperationalError:		# no coact_filter_columns yet
+		return {}
+
+def register_filter_column(conn, tablename, name, field):
+	cursor = conn.cursor()
+	cursor.execute("insert into coact_filter_columns (tablename, name, field) values (?, ?, ?)", (tablename, name, field))
+
+# Give a filter column a new name when its column is renamed, or forget
+# it when its column is dropped (name None).
+def rename_filter_column(conn, tablename, field, name):
+	cursor = conn.cursor()
+	if name is None:
+		cursor.execute("delete from coact_filter_columns where tablename = ? and field = ?", (tablename, field))
+	else:
+		cursor.execute("update coact_filter_columns set name = ? where tablename = ? and field = ?", (name, tablename, field))
+
+# Bring an existing database file up to date by creating the metadata
+# table and backfilling the version of every shared table which is not
+# yet listed in it.
+def migrate(filename):
+	conn = connect(filename)
+	create_meta(conn)
+	cursor = conn.cursor()
+	cursor.execute("select name from sqlite_master where type = 'table' and name not like 'coact_%' and name not like 'sqlite_%'")
+	for (tablename,) in cursor.fetchall():
+		columns = [row[1] for row in conn.execute("pragma table_info(%s)" % tablename)]
+		if "tver" in columns:
+			tver = get_table_version(conn, tablename)
+			set_table_version(conn, tablename, tver)
+			print "%s: version %d" % (tablename, tver)
+	conn.commit()
+	conn.close()
+
+if __name__ == "__main__":
+	if len(sys.argv) != 2:
+		sys.stderr.write("Usage: %s <filename>\n" % sys.argv[0])
+		sys.exit(1)
+	migrate(sys.argv[1])
@@ -0,0 +1,58 @@
+#! /usr/bin/python
+# pycoact/server/notify.py
+# Copyright 2026, Trinity College Computing Center
+# Last modified: 17 October 2026
+#
+# Lets pulls wait for a table to change. A pull which asks to wait and
+# finds nothing new waits on a VersionNotifier until a push to the same
+# table tells it the new version, or until the wait times out.
+#
+# Only pushes made through the same process (the long-running WSGI
+# frontend in wsgi.py) can wake a waiting pull. Changes made through
+# coact.cgi are found when the wait times out.
+#
+
+import threading
+import time
+
+class VersionNotifier(object):
+	def __init__(self, max_wait=120):
+		self.condition = threading.Condition()
+		self.versions = {}			# (filename, tablename) -> latest version known
+		self.max_wait = max_wait
+		self.waiting = 0
+		self.woken = 0
+		self.timeouts = 0
+
+	# Record that a table has been changed and wake any pulls waiting on
+	# it. This should be called once the change has been committed.
+	def notify(self, filename, tablename, tver):
+		with self.condition:
+			key = (filename, tablename)
+			if tver > self.versions.get(key, -1):
+				self.versions[key] = tver
+				self.condition.notify_all()
+
+	# Wait until the version of a table is greater than tver. The caller
+	# supplies the current version as read from the database (so that
+	# waits are not started needlessly on tables which nobody has pushed
+	# to since this process started). Returns True if the table has
+	# changed, False if the wait timed out.
+	def wait(self, filename, tablename, tver, current, timeout):
+		key = (filename, tablename)
+		deadline = time.time() + min(timeout, self.max_wait)
+		with self.condition:
+			if current > self.versions.get(key, -1):
+				self.versions[key] = current
+			self.waiting += 1
+			try:
+				while self.versions[key] <= tver:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						self.timeouts += 1
+						return False
+					self.condition.wait(remaining)
+				self.woken += 1
+				return True
+			finally:
+				self.waiting -= 1
@@ -0,0 +1,245 @@
+#! /usr/bin/python
+# pycoact/server/snapshot.py
+# Copyright 2026, Trinity College Computing Center
+# Last modified: 17 October 2026
+#
+# Precompressed snapshots for cold pulls.
+#
+# A client with an empty local store pulls from version 0 and so gets
+# the whole table. Rather than read and serialize every row for each
+# such pull, we keep a gzip-compressed copy of the response to a pull
+# from version 0 as it was at some table version S and send the file
+# as it is.
+#
+# For stbcsv tables the snapshot ends with a <continuation> (see
+# SharedTableServer.handle_request_pull()) which brings the client back
+# for the rows changed after S. For GeoJSON tables the snapshot is simply
+# the response at S. The client's next pull picks up the changes since.
+#
+# Snapshots are kept in a directory next to the database file, with
+# names of the form <table>-<S>.<format>.gz. A snapshot is written
+# in the background once the table has moved on by interval versions
+# since the last one (or, if there is none, once it has reached version
+# interval and a cold pull has asked for it). They can also be written
+# from the command line.
+#
+# Usage: snapshot.py <filename> <tablename> <tabletype>
+#
+
+import os
+import re
+import sys
+import gzip
+import tempfile
+import threading
+
+from pycoact.server.meta import get_purged_version
+
+# Format names for the content types of the responses
+formats = {
+	"application/xml": "xml",
+	"application/x-coact-stbbin": "stbbin",
+	"application/json": "geojson",
+	}
+
+snapshot_name_re = re.compile(r'^(?P<tablename>[a-z0-9_]+)-(?P<tver>[0-9]+)\.(?P<format>[a-z]+)\.gz$')
+
+def snapshot_directory(filename):
+	return "%s.snapshots" % filename
+
+# Return (tver, path) of the newest snapshot of a table in the given
+# format, or None if there is none.
+def find_snapshot(filename, tablename, format):
+	try:
+		names = os.listdir(snapshot_directory(filename))
+	except OSError:
+		return None
+	best = None
+	for name in names:
+		m = snapshot_name_re.match(name)
+		if m and m.group('tablename') == tablename and m.group('format') == format:
+			tver = int(m.group('tver'))
+			if best is None or tver > best[0]:
+				best = (tver, os.path.join(snapshot_directory(filename), name))
+	return best
+
+# Write a new snapshot of the table served by server (a SharedTableServer
+# or GeojsonServer with a connection of its own) and remove the older
+# ones. Returns (tver, path) or None if the table is still empty.
+def write_snapshot(server, format):
+	directory = snapshot_directory(server.filename)
+	if not os.path.isdir(directory):
+		try:
+			os.mkdir(directory)
+		except OSError:		# another process got there first
+			pass
+
+	# Write to a temporary file and give it its proper name only once
+	# it is complete, so that a partial snapshot is never sent.
+	fd, temp = tempfile.mkstemp(dir=directory, prefix=".%s-" % server.tablename)
+	try:
+		with os.fdopen(fd, "wb") as fh:
+			gz = gzip.GzipFile(filename="", mode="wb", fileobj=fh)
+			tver = server.write_snapshot(gz, format)
+			gz.close()
+		if tver is None:
+			os.unlink(temp)
+			return None
+		path = os.path.join(directory, "%s-%d.%s.gz" % (server.tablename, tver, format))
+		os.rename(temp, path)
+	except:
+		if os.path.exists(temp):
+			os.unlink(temp)
+		raise
+
+	# Remove the snapshots which this one replaces. Any which are
+	# being sent at this moment are already open.
+	for name in os.listdir(directory):
+		m = snapshot_name_re.match(name)
+		if m and m.group('tablename') == server.tablename and m.group('format') == format and int(m.group('tver')) < tver:
+			try:
+				os.unlink(os.path.join(directory, name))
+			except OSError:
+				pass
+
+	return (tver, path)
+
+# A snapshot on its way to the client. It is already gzip-compressed, so
+# the frontends must send it as it is with Content-Encoding: gzip rather
+# than compress it again. They may send the open file (fh) directly.
+class SnapshotResponse(object):
+	content_encoding = "gzip"
+
+	def __init__(self, path, tver):
+		self.path = path
+		self.tver = tver
+		self.fh = open(path, "rb")
+
+	def __iter__(self):
+		while True:
+			data = self.fh.read(65536)
+			if not data:
+				break
+			yield data
+
+	def close(self):
+		self.fh.close()
+
+# Decides when snapshots should be sent and when they should be written.
+# SharedTableServer and GeojsonServer consult it if their snapshots
+# attribute is set. If background is False, snapshots which exist are
+# sent but no new ones are written.
+class SnapshotManager(object):
+	def __init__(self, interval=100, background=True):
+		self.interval = interval
+		self.background = background
+		self.lock = threading.Lock()
+		self.latest = {}		# (filename, tablename, format) -> (tver, path)
+		self.running = set()	# (filename, tablename, format) being written
+		self.sent = 0
+		self.written = 0
+
+	def find(self, filename, tablename, format):
+		key = (filename, tablename, format)
+		with self.lock:
+			snapshot = self.latest.get(key)
+		if snapshot is None or not os.path.exists(snapshot[1]):
+			snapshot = find_snapshot(filename, tablename, format)
+			with self.lock:
+				if snapshot is not None:
+					self.latest[key] = snapshot
+				else:
+					self.latest.pop(key, None)
+		return snapshot
+
+	# Return a SnapshotResponse for a cold pull of the table served by
+	# server in the given format, or None if there is no snapshot and
+	# the pull should be answered in the usual way. current is the
+	# current version of the table.
+	def response(self, server, format, current):
+		snapshot = self.find(server.filename, server.tablename, format)
+		if snapshot is None:
+			if current >= self.interval:
+				self.refresh(server, format)
+			return None
+		tver, path = snapshot
+		if current - tver >= self.interval:
+			self.refresh(server, format)
+
+		# A client which got a snapshot made before tombstones which it
+		# does not hold were purged (see compact.py) would only be sent
+		# back for a reset, and then to the same snapshot.
+		if tver <= get_purged_version(server.conn, server.tablename):
+			server.debug(1, "Snapshot at version %d predates purged tombstones" % tver)
+			self.refresh(server, format)
+			return None
+		try:
+			response = SnapshotResponse(path, tver)
+		except IOError:		# replaced in the meantime
+			return None
+		self.sent += 1
+		server.debug(1, "Sending snapshot at version %d to a cold pull at version %d" % (tver, current))
+		return response
+
+	# Called when a table has changed to start writing new snapshots
+	# of those formats in which it has one if they are now too old.
+	def table_changed(self, server, tver):
+		with self.lock:
+			stale = [key[2] for key, snapshot in self.latest.items()
+				if key[0] == server.filename and key[1] == server.tablename and tver - snapshot[0] >= self.interval]
+		for format in stale:
+			self.refresh(server, format)
+
+	# Write a new snapshot in a background thread unless one is already
+	# being written.
+	def refresh(self, server, format):
+		if not self.background:
+			return
+		key = (server.filename, server.tablename, format)
+		with self.lock:
+			if key in self.running:
+				return
+			self.running.add(key)
+		thread = threading.Thread(target=self.write, args=(server, format, key))
+		thread.daemon = True
+		thread.start()
+
+	# Runs in the background thread. The snapshot is read through a
+	# connection of its own, since sqlite3 connections stay in the
+	# thread which opened them.
+	def write(self, server, format, key):
+		debug_level = server.debug_level
+		server = server.reopen()
+		server.debug_level = debug_level
+		try:
+			snapshot = write_snapshot(server, format)
+			if snapshot is not None:
+				server.debug(1, "Wrote snapshot %s" % snapshot[1])
+				with self.lock:
+					self.latest[key] = snapshot
+					self.written += 1
+		except Exception as e:
+			server.debug(1, "Failed to write snapshot: %s" % str(e))
+		finally:
+			server.conn.close()
+			with self.lock:
+				self.running.discard(key)
+
+if __name__ == "__main__":
+	from pycoact.server.table import SharedTableServer
+	from pycoact.server.geojson import GeojsonServer
+
+	if len(sys.argv) != 4:
+		sys.stderr.write("Usage: %s <filename> <tablename> <tabletype>\n" % sys.argv[0])
+		sys.exit(1)
+	filename, tablename, tabletype = sys.argv[1:]
+	if tabletype == "geojson":
+		snapshots = [(GeojsonServer(filename, tablename), "geojson")]
+	else:
+		snapshots = [(SharedTableServer(filename, tablename, tabletype), format) for format in ("xml", "stbbin")]
+	for server, format in snapshots:
+		snapshot = write_snapshot(server, format)
+		if snapshot is None:
+			print "%s: table is empty" % format
+		else:
+			print "%s: version %d in %s" % (format, snapshot[0], snapshot[1])
@@ -1,25 +1,56 @@
 #! /usr/bin/python
 # pycoact/server/table.py
 # Copyright 2013, 2014, 2015, Trinity College Computing Center
-# Last modified: 15 February 2015
+# Last modified: 17 October 2026
 #
 
 import sqlite3
 import xml.etree.cElementTree as ET
 import StringIO
 import sys
+import tempfile
+
+from pycoact import stbbin
+from pycoact import csvdelta
+from pycoact import csvschema
+from pycoact.server.meta import connect, create_meta, register_table, get_table_version, set_table_version, record_client, get_purged_version, \
+	get_last_id, set_last_id, get_schema_ops, get_schema_version, add_schema_ops, get_filter_columns, register_filter_column, rename_filter_column
+from pycoact.server.snapshot import formats as snapshot_formats
 
 class BadRequest(Exception):
 	pass
 
 class SharedTableServer:
 
-	def __init__(self, filename, tablename, tabletype):
-		self.conn = sqlite3.connect(filename)
+	# If conn is supplied, it is an already-open connection to filename
+	# (as kept by the connection pool in wsgi.py) and is used instead of
+	# opening a new one.
+	#
+	# If notifier is set (as it is by wsgi.py) to a VersionNotifier (see
+	# notify.py), pulls can wait for the table to change and pushes wake
+	# them when it does. If cache is set to a ResponseCache (see cache.py),
+	# pull responses are kept there and reused. If snapshots is set to a
+	# SnapshotManager (see snapshot.py), cold pulls may be answered with
+	# a precompressed snapshot.
+	def __init__(self, filename, tablename, tabletype, conn=None):
+		self.conn = conn if conn is not None else connect(filename)
 		#self.conn.row_factory = sqlite3.Row	# not used yet
+		self.filename = filename
 		self.tablename = tablename
 		self.tabletype = tabletype
 		self.debug_level = 0
+		self.notifier = None
+		self.cache = None
+		self.snapshots = None
+
+		# Pushes are applied in batches of batch_size rows. Batches of at
+		# least bulk_threshold modified rows are applied with update_rows_bulk()
+		# rather than update_rows().
+		self.batch_size = 1000
+		self.bulk_threshold = 50
+
+		# The columns of the table. See has_column().
+		self.columns = None
 
 	# Send debugging messages to the web server error log
 	def debug(self, level, message):
@@ -35,130 +66,606 @@ class SharedTableServer:
 	# rows which were modified in table versions later than the last one which
 	# they downloaded.
 	#
-	# We do not store the table version anywhere. Instead we use a SQL query
-	# to find the highest table version in any row.
+	# The current version is kept in the table's row in coact_tables (see
+	# meta.py) and is bumped in the same transaction as the rows which are
+	# stamped with it.
 	#
 	def table_version(self):
-		cursor = self.conn.cursor()
-		cursor.execute("select max(tver) from %s" % self.tablename)
-		version = cursor.fetchone()[0]
-		version = 0 if version is None else int(version)
+		version = get_table_version(self.conn, self.tablename)
 		self.debug(1, "Current table version: %d" % version)
 		return version
 
+	# If the table has not changed since pulled_version, wait up to
+	# timeout seconds for a push to change it. Without a notifier
+	# there is nothing to wait on, so we return at once.
+	#
+	# If release is given, it is called before waiting so that the
+	# caller can give up its database connection in the meantime (see
+	# wsgi.py). This server must not touch the database after that.
+	def wait_for_change(self, pulled_version, timeout, release=None):
+		if self.notifier is None or timeout <= 0:
+			return
+		current = self.table_version()
+		if current <= pulled_version:
+			if release is not None:
+				release()
+			self.debug(1, "Waiting up to %s seconds for a change" % timeout)
+			if self.notifier.wait(self.filename, self.tablename, pulled_version, current, timeout):
+				self.debug(1, "Table has changed")
+			else:
+				self.debug(1, "Wait timed out")
+
+	# Tell any pulls waiting on this table that it is now at version tver,
+	# drop the cached responses for the old version, and see whether the
+	# snapshots need to be brought up to date. This must be called only
+	# after the change has been committed.
+	def notify_change(self, tver):
+		if self.cache is not None:
+			self.cache.invalidate(self.filename, self.tablename)
+		if self.notifier is not None:
+			self.notifier.notify(self.filename, self.tablename, tver)
+		if self.snapshots is not None:
+			self.snapshots.table_changed(self, tver)
+
+	# Another server object for the same table with a connection of its own
+	def reopen(self):
+		return SharedTableServer(self.filename, self.tablename, self.tabletype)
+
 	# Create the database table
+	#
+	# A deleted row is kept as a tombstone, with deleted set to 1 and no
+	# data, so that it can be sent to clients in their next pulls. See
+	# compact.py for the removal of tombstones which every client has had.
+	#
+	# When a row is modified, its previous data and tver are kept in
+	# prev_data and prev_tver so that pulls can send a delta to clients
+	# which have the previous version (see pull_response()).
 	def create(self):
 		cursor = self.conn.cursor()
-		cursor.execute("create table %s (id integer primary key, version integer, tver integer, user varchar, data text)" % self.tablename)
+		cursor.execute("create table %s (id integer primary key, version integer, tver integer, user varchar, data text, deleted integer not null default 0, prev_tver integer, prev_data text)" % self.tablename)
 		cursor.execute("create index %s_idx on %s (tver)" % (self.tablename, self.tablename))
+		register_table(self.conn, self.tablename)
+
+	# Tables created by older versions lack some of the columns until
+	# their first push adds them (see upgrade()). Since that push may
+	# come through another process, a column found missing is looked
+	# for again the next time rather than taken to be missing for good.
+	def has_column(self, name):
+		if self.columns is None or name not in self.columns:
+			self.columns = set([row[1] for row in self.conn.execute("pragma table_info(%s)" % self.tablename)])
+		return name in self.columns
+
+	# Add whatever an older table lacks. This cannot be done inside
+	# a transaction. If another process adds a column first, we are
+	# told it is a duplicate.
+	def upgrade(self):
+		for column, definition in (("deleted", "integer not null default 0"), ("prev_tver", "integer"), ("prev_data", "text")):
+			if not self.has_column(column):
+				try:
+					self.conn.execute("alter table %s add column %s %s" % (self.tablename, column, definition))
+				except sqlite3.OperationalError as e:
+					if "duplicate column name" not in str(e):
+						raise
+				self.columns.add(column)
+
+	# The columns which pulls read, in order
+	def row_columns(self):
+		return "id, version, tver, data, %s, %s" % (
+			"deleted" if self.has_column("deleted") else "0",
+			"prev_tver, prev_data" if self.has_column("prev_tver") else "null, null",
+			)
+
+	# Has the client pulled so little that it has missed tombstones which
+	# have since been purged? If so, it must pull the whole table again.
+	# A client in the middle of a paged pull has seen only the changes
+	# made before the tver of its continuation (cont_tver), even if it
+	# started from version 0.
+	def needs_reset(self, pulled_version, cont_tver=None):
+		if cont_tver is not None:
+			pulled_version = cont_tver - 1
+		elif pulled_version <= 0:
+			return False
+		purged_version = get_purged_version(self.conn, self.tablename)
+		if pulled_version < purged_version:
+			self.debug(1, "Client at version %d has missed tombstones purged up to version %d" % (pulled_version, purged_version))
+			return True
+		return False
+
+	# Let pulls be filtered on the column of an stbcsv table called name
+	# (see client_filter()). Since that would otherwise mean parsing every
+	# row, the value of each filter column in each row is kept in a side
+	# table, <tablename>_filter, with an index on each column, and is
+	# brought up to date by every push (see index_filter_columns()).
+	# Returns False if the column could already be filtered on.
+	#
+	# Values are compared as numbers where they look like numbers and
+	# as text where they do not, as the numeric columns of SQLite do.
+	def add_filter_column(self, name):
+		assert self.tabletype == 'stbcsv', "Only stbcsv tables have columns"
+		create_meta(self.conn)
+		self.upgrade()
+		if name in get_filter_columns(self.conn, self.tablename):
+			return False
+		if name not in self.header_names():
+			raise BadRequest("table has no column %s" % name)
+
+		# The side table and its columns must be created outside of a
+		# transaction. Columns of dropped filter columns are left
+		# unused rather than reused.
+		cursor = self.conn.cursor()
+		cursor.execute("create table if not exists %s_filter (id integer primary key)" % self.tablename)
+		field = "f%d" % len(list(self.conn.execute("pragma table_info(%s_filter)" % self.tablename)))
+		cursor.execute("alter table %s_filter add column %s numeric" % (self.tablename, field))
+		cursor.execute("create index %s_filter_%s on %s_filter (%s)" % (self.tablename, field, self.tablename, field))
+
+		cursor.execute("begin immediate transaction")
+		try:
+			register_filter_column(self.conn, self.tablename, name, field)
+			last = -1
+			while True:
+				cursor.execute("select id, data, deleted from %s where id > ? and id != 0 order by id limit ?" % self.tablename, [last, self.batch_size])
+				rows = cursor.fetchall()
+				if len(rows) == 0:
+					break
+				self.index_rows(rows)
+				last = rows[-1][0]
+			self.conn.commit()
+		except:
+			self.conn.rollback()
+			raise
+		return True
+
+	# The names of the columns as given by the first row
+	def header_names(self):
+		cursor = self.conn.cursor()
+		cursor.execute("select data from %s where id = 0" % self.tablename)
+		header = cursor.fetchone()
+		if header is None:
+			return []
+		return [csvschema.unquote_field(field) for field in csvdelta.split_fields(header[0])]
+
+	# Bring the side table of the filter columns up to date for the rows
+	# with the given ids, which a push has just changed.
+	def index_filter_columns(self, ids):
+		if len(ids) == 0 or len(get_filter_columns(self.conn, self.tablename)) == 0:
+			return
+		cursor = self.conn.cursor()
+		for i in range(0, len(ids), 500):		# SQLite takes at most 999 parameters
+			batch = ids[i:i+500]
+			cursor.execute("select id, data, deleted from %s where id in (%s)" % (self.tablename, ",".join(["?"] * len(batch))), batch)
+			self.index_rows(cursor.fetchall())
+
+	# Put the values of the filter columns of rows, given as (id, data,
+	# deleted), into the side table. Tombstones are taken out of it.
+	def index_rows(self, rows):
+		names = self.header_names()
+		fields = []
+		positions = []
+		for name, field in get_filter_columns(self.conn, self.tablename).items():
+			fields.append(field)
+			positions.append(names.index(name) if name in names else None)
+		cursor = self.conn.cursor()
+		cursor.executemany("delete from %s_filter where id = ?" % self.tablename,
+			[(id,) for id, data, deleted in rows if deleted])
+		cursor.executemany("insert or replace into %s_filter (id, %s) values (?, %s)" % (self.tablename, ", ".join(fields), ", ".join(["?"] * len(fields))),
+			[[id] + [None if position is None else csvschema.field_value(data, position) for position in positions]
+				for id, data, deleted in rows if not deleted])
+
+	# Keep the filter columns in step with schema operations, given as
+	# (tver, op, position, name), which are about to be applied to the
+	# first row, header. A renamed filter column keeps its values under
+	# its new name. A dropped one is forgotten.
+	def alter_filter_columns(self, header, operations):
+		filter_columns = get_filter_columns(self.conn, self.tablename)
+		if len(filter_columns) == 0:
+			return
+		for operation in operations:
+			tver, op, position, name = operation
+			names = [csvschema.unquote_field(field) for field in csvdelta.split_fields(header)]
+			if op in ("drop", "rename") and names[position] in filter_columns:
+				field = filter_columns.pop(names[position])
+				if op == "drop":
+					rename_filter_column(self.conn, self.tablename, field, None)
+					self.conn.execute("update %s_filter set %s = null" % (self.tablename, field))
+				else:
+					rename_filter_column(self.conn, self.tablename, field, name)
+					filter_columns[name] = field
+			header = csvschema.apply_ops(header, [operation], header=True)
+
+	# The filter which the client sent with its pull, if any, as an SQL
+	# condition on the ids of the rows which pass it together with its
+	# parameters. The filter is one or more <filter column="..." op="..."
+	# value="..." />, all of which a row must pass. The columns are named
+	# as in the first row and must have been declared with add_filter_column().
+	# The op is one of filter_ops and defaults to "=".
+	filter_ops = ("=", "!=", "<", "<=", ">", ">=")
+	def client_filter(self, req):
+		filters = req.findall("filter")
+		if len(filters) == 0:
+			return None
+		filter_columns = get_filter_columns(self.conn, self.tablename)
+		conditions = []
+		params = []
+		for f in filters:
+			column = f.get("column")
+			op = f.get("op", "=")
+			if column not in filter_columns:
+				raise BadRequest("pulls cannot be filtered on column %s" % column)
+			if op not in self.filter_ops:
+				raise BadRequest("unknown filter operator: %s" % op)
+			conditions.append("%s %s ?" % (filter_columns[column], op))
+			params.append(f.get("value", ""))
+		return ("id in (select id from %s_filter where %s)" % (self.tablename, " and ".join(conditions)), params)
+
+	# The schema_version which the client sent with its request, that is
+	# the version of the last schema operation (see csvschema.py) which
+	# it has applied, or None if it sent none.
+	@staticmethod
+	def client_schema_version(req):
+		schema_version = req.find("schema_version")
+		if schema_version is None:
+			return None
+		return int(schema_version.text)
+
+	# Generate the part of a response which tells the client of changes
+	# to the columns of the table: the version of the last schema operation
+	# and, if the client sent its own schema_version, the operations which
+	# it has yet to apply as <schema_op tver="..." op="..." position="..."
+	# name="..." />.
+	def schema_response(self, writer, client_schema):
+		if self.tabletype != 'stbcsv':
+			return
+		yield writer.field('schema_version', get_schema_version(self.conn, self.tablename))
+		if client_schema is not None:
+			for tver, op, position, name in get_schema_ops(self.conn, self.tablename, client_schema):
+				if name is None:
+					yield writer.element('schema_op', None, tver=tver, op=op, position=position)
+				else:
+					yield writer.element('schema_op', None, tver=tver, op=op, position=position, name=name)
 
 	# Client is pulling down new changes made by other clients.
 	# Client will supply a version number. We will return the first row
 	# (so that the client can verify that the format has not changed)
 	# and all rows which have a version later than the one specified.
-	def handle_request_pull(self, req):
+	#
+	# If the client supplies a <page_size>, the rows are sent in order of
+	# (tver, id) and no more than page_size of them are sent. If more remain,
+	# the response ends with a <continuation tver="..." id="..." /> which the
+	# client sends back in its next pull in order to get the next page.
+	#
+	# If the client supplies a <wait> of some number of seconds and
+	# there are no changes after pulled_version, the response is held
+	# back until there are or until the time is up. See wait_for_change().
+	#
+	# Deleted rows are sent as tombstones: <row id="..." version="..."
+	# deleted="1" />. If the tombstones which the client has yet to see
+	# have been purged (see compact.py), the response is only a <reset>
+	# and the client must start over from version 0.
+	#
+	# The continuation also carries the pulled_version from which the
+	# series of pages started. Whichever that was, the client has so far
+	# seen only the changes made before the tver of the continuation, so
+	# it is that which is checked against the purges. A series which
+	# started from version 0, whether with a page or with a snapshot (see
+	# snapshot.py), holds rows which may since have been deleted, and the
+	# client would never hear of it if their tombstones had been purged.
+	#
+	# If the client sends <deltas>, rows of stbcsv tables which have been
+	# modified only once since the series started are sent as deltas
+	# against the version which the client has: <row id="..." version="..."
+	# delta="1">. See csvdelta.py.
+	#
+	# The rows are always sent with the columns they have now. The client
+	# is told of any changes to the columns by schema_response().
+	#
+	# If the client sends a filter (see client_filter()), a pull from
+	# version 0 gets only the rows which pass it. Later pulls get those
+	# of the changed rows which pass it and, in place of each of the rest,
+	# <row id="..." version="..." filtered="1" /> so that the client can
+	# drop its copy if it has one. Either way the rows are picked out
+	# by the side table of the filter columns without parsing any.
+	#
+	# This is a generator. The response is serialized a row at a time
+	# as the rows come out of the cursor, so the whole table is never
+	# held in memory, not even during a pull from version 0.
+	def handle_request_pull(self, req, writer, wait=True):
 
 		pulled_version = int(req.find("pulled_version").text)
 		self.debug(1, "Pull after version %d" % pulled_version)
 
+		page_size = req.find("page_size")
+		if page_size is not None:
+			page_size = int(page_size.text)
+			assert page_size > 0, "page_size must be positive"
+
+		# Rows after the position given by the continuation token or, if
+		# there is none, all rows changed after pulled_version.
+		continuation = req.find("continuation")
+		if continuation is not None:
+			cont_tver = int(continuation.get("tver"))
+			cont_id = int(continuation.get("id"))
+			start = continuation.get("start")
+			start = int(start) if start is not None else None
+			self.debug(1, "Continuing from tver %d, id %d" % (cont_tver, cont_id))
+			where = "tver >= ? and (tver > ? or id > ?)"
+			params = [cont_tver, cont_tver, cont_id]
+		else:
+			start = pulled_version
+			where = "tver > ?"
+			params = [pulled_version]
+
+		if wait:
+			wait = self.requested_wait(req)
+			if wait is not None:
+				self.wait_for_change(*wait)
+
+		deltas = req.find("deltas") is not None and self.tabletype == 'stbcsv' and start is not None
+		client_schema = self.client_schema_version(req)
+
+		# A client which started from nothing has nothing to drop, so
+		# it needs only the rows which pass the filter.
+		filter = self.client_filter(req)
+		if filter is not None and start == 0:
+			where += " and " + filter[0]
+			params.extend(filter[1])
+
+		if page_size is None:
+			order = "order by id"
+		else:
+			order = "order by tver, id limit ?"
+			params.append(page_size + 1)
+
+		# Read the version and the rows in the same read transaction
+		# so that they agree with one another.
 		cursor = self.conn.cursor()
-		cursor.execute("select * from %s where tver > ? or id = 0 order by id" % self.tablename, [pulled_version])
+		cursor.execute("begin transaction")
+		try:
+			table_version = self.table_version()
+			if self.needs_reset(pulled_version, cont_tver if continuation is not None else None):
+				yield writer.start()
+				yield writer.field('version', table_version)
+				yield writer.field('reset', 1)
+				yield writer.end()
+				return
 
-		# Create <response>
-		top = ET.Element('response')
-		top.text = '\n'
+			response = self.pull_response(writer, cursor, table_version, where, params, order, page_size, start=start, deltas=deltas, client_schema=client_schema,
+				filter=(filter if start != 0 else None))
+
+			# The same request at the same table version always gets the
+			# same response, so we may already have it.
+			if self.cache is not None:
+				key = (self.filename, self.tablename, writer.content_type,
+					pulled_version, page_size, continuation is not None and (cont_tver, cont_id, start),
+					deltas, client_schema, filter is not None and (filter[0], tuple(filter[1])), table_version)
+				cached = self.cache.get(key)
+				if cached is not None:
+					self.debug(1, "Response found in cache")
+					yield cached
+					return
+				response = self.cache.collect(key, response)
+
+			for piece in response:
+				yield piece
+		finally:
+			self.conn.rollback()		# nothing to commit, just release the lock
+
+	# Generate the pieces of the response to a pull. Called by
+	# handle_request_pull() and write_snapshot() with the transaction
+	# open. If continuation is given, it is the (tver, id) to end the
+	# response with when the page does not. start is the pulled_version
+	# from which the series of pages started, if known. If deltas is
+	# true, rows whose previous version is no newer than start are sent
+	# as deltas against it where that is shorter. client_schema is the
+	# client's schema_version (see schema_response()). If filter is given,
+	# as returned by client_filter(), rows which do not pass it are sent
+	# as filtered="1".
+	def pull_response(self, writer, cursor, table_version, where, params, order, page_size, continuation=None, start=None, deltas=False, client_schema=None, filter=None):
+		yield writer.start()
 
 		# Add a <version> child to <response> which holds the current tver.
-		child = ET.SubElement(top, 'version')
-		child.text = str(self.table_version())
-		child.tail = '\n'
+		yield writer.field('version', table_version)
 
-		# Add a <rows> container to the <response>.
-		xml_rows = ET.SubElement(top, 'rows')
-		xml_rows.text = '\n'
-		xml_rows.tail = '\n'
+		for piece in self.schema_response(writer, client_schema):
+			yield piece
 
-		# For each row returned by the SQL query, added a <row> to <rows>.
+		# Add a <rows> container to the <response> and put a <row> in it
+		# for the first row and for each row returned by the SQL query.
+		yield writer.start_rows('rows')
+		cursor.execute("select %s from %s where id = 0" % (self.row_columns(), self.tablename))
+		for id, version, tver, data, deleted, prev_tver, prev_data in cursor.fetchall():
+			yield writer.row(data, id=id, version=version)
+		passes, passes_params = filter if filter is not None else ("1", [])
+		cursor.execute("select %s, %s from %s where id != 0 and %s %s" % (self.row_columns(), passes, self.tablename, where, order), passes_params + params)
+		count = 0
+		last = None
 		for row in cursor:
-			id, version, tver, user, data = row
-			child = ET.SubElement(xml_rows, 'row')
-			child.attrib = {'id':str(id),
-							'version':str(version),
-							}
-			child.text = data
-			child.tail = '\n'
-
-		return ET.tostring(top)
-	
-	# Client is pushing up its own new changes.
-	def handle_request_push(self, req, req_username):
+			id, version, tver, data, deleted, prev_tver, prev_data, passed = row
+			count += 1
+			if page_size is not None and count > page_size:
+				break
+			last = (tver, id)
+			if deleted:
+				yield writer.row(None, id=id, version=version, deleted=1)
+				continue
+			if not passed:
+				yield writer.row(None, id=id, version=version, filtered=1)
+				continue
+			if deltas and prev_tver is not None and prev_tver <= start:
+				delta = csvdelta.make_delta(prev_data, data)
+				if delta is not None:
+					yield writer.row(delta, id=id, version=version, delta=1)
+					continue
+			yield writer.row(data, id=id, version=version)
+		yield writer.end_rows('rows')
+
+		# More rows remain after this page?
+		if page_size is not None and count > page_size:
+			continuation = last
+		if continuation is not None:
+			if start is not None:
+				yield writer.element('continuation', None, tver=continuation[0], id=continuation[1], start=start)
+			else:
+				yield writer.element('continuation', None, tver=continuation[0], id=continuation[1])
+
+		yield writer.end()
+
+	# Write to fh the response to a pull from version 0 in the given
+	# format (see snapshot.py), ending with a continuation which brings
+	# the client back for whatever has changed since. Returns the table
+	# version, or None if the table is empty and there is nothing worth
+	# writing.
+	def write_snapshot(self, fh, format):
+		if format == "stbbin":
+			writer = stbbin.BinaryResponseWriter()
+		else:
+			writer = XMLResponseWriter()
+		cursor = self.conn.cursor()
+		cursor.execute("begin transaction")
+		try:
+			table_version = self.table_version()
+			if table_version == 0:
+				return None
+			cursor.execute("select max(id) from %s" % self.tablename)
+			max_id = cursor.fetchone()[0]
+			for piece in self.pull_response(writer, cursor, table_version, "tver > ?", [0], "order by id", None, (table_version, max_id), start=0):
+				fh.write(piece)
+			return table_version
+		finally:
+			self.conn.rollback()
+
+	# Is this pull from an empty local store, one which a snapshot can answer?
+	# (Snapshots are of the whole table, so filtered pulls are not.)
+	@staticmethod
+	def is_cold_pull(req):
+		return int(req.find("pulled_version").text) == 0 \
+			and req.find("continuation") is None \
+			and req.find("page_size") is None \
+			and req.find("filter") is None
+
+	# Client is pushing up its own new changes. Rows which the client has
+	# deleted are sent in a <deleted_rows> container with the version
+	# they would have had as modified rows. Accepted deletions are
+	# listed with the modified rows in the response.
+	#
+	# Modified rows of stbcsv tables may instead be sent in a <delta_rows>
+	# container with only the cells which have changed (see csvdelta.py).
+	# These are accepted or rejected just as whole rows would be.
+	#
+	# A client which has yet to apply changes to the columns gets a
+	# FORMAT_CONFLICT, since its first row no longer matches ours, and
+	# the schema operations it needs (see schema_response()).
+	def handle_request_push(self, req, writer, req_username):
+		result, tver, conflict_count, mods, news = self.apply_push(req, req_username)
+		self.conn.commit()
+		if len(mods) > 0 or len(news) > 0:
+			self.notify_change(tver)
+		response = [writer.start()]
+		response.extend(self.push_response(writer, result, tver, conflict_count, mods, news))
+		response.extend(self.schema_response(writer, self.client_schema_version(req)))
+		response.append(writer.end())
+		return "".join(response)
+
+	# Apply the rows of a push request to the table. This leaves the
+	# transaction open. Returns the result ('OK' or 'FORMAT_CONFLICT'),
+	# the table version after the push, the number of conflicts, and the
+	# ids of the modified rows and of the new rows.
+	def apply_push(self, req, req_username):
 		mods = []
 		news = []
 		conflict_count = 0
 		result = 'OK'
 
+		# Take the write lock before reading the table version so that
+		# no other push can be given the same one. (Databases which predate
+		# coact_tables get it here, and the scratch table for bulk updates
+		# is created here, since neither can be created inside the
+		# transaction.)
+		create_meta(self.conn)
+		self.upgrade()
+		cursor = self.conn.cursor()
+		cursor.execute("create temp table if not exists coact_push (id integer primary key, version integer, data text, accepted integer)")
+		cursor.execute("begin immediate transaction")
+
 		tver = self.table_version()
 		tver += 1
 
-		cursor = self.conn.cursor()
-		cursor.execute("begin transaction")
+		# The rows are applied in batches as they are parsed, so a large push
+		# is never held in memory all at once.
+		submitted_count = 0
+		submitted_new_count = 0
+		batch = []
+		new_batch = []
+		delete_batch = []
+		delta_batch = []
+		for container, id, version, text in req.rows():
 
-		# Modification of existing rows
-		modified_rows = list(req.find('rows'))
-		for row in modified_rows:
-			assert row.tag == 'row'
-			id = int(row.get('id'))
-			version = int(row.get('version'))
-			text = row.text
-			self.debug(2, "%d, %d, %s" % (id, version, text))
+			# Modification of existing rows
+			if container == 'rows':
 
-			# In stbcsv tables, the first row is treated specially. It can never be altered
-			# due to a request from the client. The client always sends it as if it were
-			# modified so that we can make sure the formats are the same. The client
-			# always assumes we already have it, so if we don't we must quietly create it
-			# when first a client does a push.
-			if id == 0 and self.tabletype == 'stbcsv':
-				assert version == 1, "Row with ID 0 must remain at version 1"
-				cursor.execute("select data from %s where id = ?" % self.tablename, (0,))
-				data = cursor.fetchone()
-				if data is None:
-					cursor.execute("insert into %s (id, version, tver, user, data) values (?, ?, ?, ?, ?)" % self.tablename, [0, 1, tver, req_username, text])
+				# In stbcsv tables, the first row is treated specially. It can never be altered
+				# due to a request from the client. The client always sends it as if it were
+				# modified so that we can make sure the formats are the same. The client
+				# always assumes we already have it, so if we don't we must quietly create it
+				# when first a client does a push. If the formats are not the same, nothing
+				# in the push is applied.
+				if id == 0 and self.tabletype == 'stbcsv':
+					assert version == 1, "Row with ID 0 must remain at version 1"
+					cursor.execute("select data from %s where id = ?" % self.tablename, (0,))
+					data = cursor.fetchone()
+					if data is None:
+						cursor.execute("insert into %s (id, version, tver, user, data) values (?, ?, ?, ?, ?)" % self.tablename, [0, 1, tver, req_username, text])
+					else:
+						if text != data[0]:
+							result = "FORMAT_CONFLICT"
+							break
 				else:
-					if text != data[0]:
-						result = "FORMAT_CONFLICT"
-						break
-
-			# With other rows which the client claims to have modified, we try to updating them
-			# using a where clause which contains the number of the version on which the client
-			# claims to have based its modifications. If it has been changed since the client
-			# pulled, nothing will be modified and we will declare a conflict.
-			else:
+					assert version >= 1
+					batch.append((id, version, text))
+					submitted_count += 1
+					if len(batch) >= self.batch_size:
+						mods.extend(self.apply_batch(batch, tver, req_username))
+						batch = []
+
+			# Addition of new rows
+			elif container == 'new_rows':
+				new_batch.append(text)
+				submitted_new_count += 1
+				if len(new_batch) >= self.batch_size:
+					news.extend(self.insert_rows(new_batch, tver, req_username))
+					new_batch = []
+
+			# Deletion of existing rows
+			elif container == 'deleted_rows':
+				assert id != 0, "Row with ID 0 may not be deleted"
 				assert version >= 1
-				cursor.execute("update %s set version=?, tver=?, user=?, data=? where id=? and version=?" % self.tablename, [version, tver, req_username, text, id, version-1])
-				if cursor.rowcount == 0:		# version not as expected
-					self.debug(1, "conflict")
-					conflict_count += 1
-				else:
-					mods.append(id)
+				delete_batch.append((id, version))
+				submitted_count += 1
 
-		# Addition of new rows
-		new_rows = list(req.find('new_rows'))
-		if len(new_rows) > 0:
-			cursor.execute("select max(id) from %s" % self.tablename)
-			id = cursor.fetchone()[0]
-			id = -1 if id is None else int(id)
-			self.debug(1, "Last row was: %d" % id)
-
-			for row in new_rows:
-				assert row.tag == 'row'
-				id += 1
-				text = row.text
-				self.debug(2, "new row %d: %s" % (id, text))
-				cursor.execute("insert into %s (id, version, tver, user, data) values (?, ?, ?, ?, ?)" % self.tablename, [id, 1, tver, req_username, text])
-				news.append(id)
-
-		self.debug(1, "Submitted modified rows: %d" % len(modified_rows))
-		self.debug(1, "Submitted new rows: %d" % len(new_rows))
+			# Modification of existing rows by delta
+			elif container == 'delta_rows':
+				assert self.tabletype == 'stbcsv', "Deltas are only for stbcsv tables"
+				assert id != 0, "Row with ID 0 must remain at version 1"
+				assert version >= 1
+				delta_batch.append((id, version, text))
+				submitted_count += 1
+				if len(delta_batch) >= self.batch_size:
+					mods.extend(self.apply_batch(self.expand_deltas(delta_batch), tver, req_username))
+					delta_batch = []
+
+		if result != 'OK':
+			self.conn.rollback()
+			mods = []
+			news = []
+		else:
+			mods.extend(self.apply_batch(batch, tver, req_username))
+			news.extend(self.insert_rows(new_batch, tver, req_username))
+			mods.extend(self.apply_batch(self.expand_deltas(delta_batch), tver, req_username))
+			mods.extend(self.delete_rows(delete_batch, tver, req_username))
+			conflict_count = submitted_count - len(mods)
+			self.index_filter_columns(mods + news)
+
+		self.debug(1, "Submitted modified rows: %d" % submitted_count)
+		self.debug(1, "Submitted new rows: %d" % submitted_new_count)
 		self.debug(1, "Accepted modified rows: %d" % len(mods))
 		self.debug(1, "Accepted new rows: %d" % len(news))
 
@@ -166,56 +673,388 @@ class SharedTableServer:
 		# table version number back to what it was.
 		if len(mods) == 0 and len(news) == 0:
 			tver -= 1
+		else:
+			set_table_version(self.conn, self.tablename, tver)
+
+		return (result, tver, conflict_count, mods, news)
 
-		# Format XML response	
-		xml_top = ET.Element('response')
-		xml_top.text = '\n'
+	# Format the part of the response to a push which tells the client
+	# what became of its changes.
+	def push_response(self, writer, result, tver, conflict_count, mods, news):
+		response = []
 
 		# Error?
-		child = ET.SubElement(xml_top, 'result')
-		child.text = result
-		child.tail = '\n'
+		response.append(writer.field('result', result))
 
 		# What is the table version when this change has been committed?
-		child = ET.SubElement(xml_top, 'version')
-		child.text = str(tver)
-		child.tail = '\n'
+		response.append(writer.field('version', tver))
 
-		child = ET.SubElement(xml_top, 'conflict_count')
-		child.text = str(conflict_count)
-		child.tail = '\n'
+		response.append(writer.field('conflict_count', conflict_count))
 
-		child = ET.SubElement(xml_top, 'modified_rows')
-		child.text = '\n'
-		child.tail = '\n'
+		response.append(writer.start_rows('modified_rows'))
 		for id in mods:
-			gchild = ET.SubElement(child, 'row')
-			gchild.attrib['id'] = str(id)
-			gchild.tail = '\n'
+			response.append(writer.row(None, id=id))
+		response.append(writer.end_rows('modified_rows'))
 
-		child = ET.SubElement(xml_top, 'new_rows')
-		child.text = '\n'
-		child.tail = '\n'
+		response.append(writer.start_rows('new_rows'))
 		for id in news:
-			gchild = ET.SubElement(child, 'row')
-			gchild.attrib['id'] = str(id)
-			gchild.tail = '\n'
+			response.append(writer.row(None, id=id))
+		response.append(writer.end_rows('new_rows'))
+
+		return response
+
+	# Client is pushing its changes and pulling those of other clients
+	# in one request. The push is applied as by handle_request_push().
+	# Then, in the same transaction, all rows changed after the client's
+	# pulled_version are sent as by handle_request_pull(), except those
+	# which the push has just written, since the client already has them.
+	# The <version> in the response is then the version which the client
+	# has pulled.
+	#
+	# So that a slow client does not hold the write lock, and with it
+	# every other push and sync, the whole response is written to a
+	# spooled temporary file (kept in memory up to spool_size bytes)
+	# before the push is committed, and is sent from there afterwards.
+	#
+	# If the client needs to pull the whole table again (see needs_reset()),
+	# a <reset> is sent in place of the rows.
+	#
+	# A filter is applied to the rows pulled as by handle_request_pull().
+	spool_size = 1 << 20
+	def handle_request_sync(self, req, writer, req_username):
+		pulled_version = int(req.find("pulled_version").text)
+		self.debug(1, "Sync after version %d" % pulled_version)
+		filter = self.client_filter(req)
+
+		spool = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+		try:
+			try:
+				result, tver, conflict_count, mods, news = self.apply_push(req, req_username)
+				for piece in self.sync_response(req, writer, pulled_version, filter, result, tver, conflict_count, mods, news):
+					spool.write(piece)
+				self.conn.commit()
+			except:
+				self.conn.rollback()
+				raise
+			if len(mods) > 0 or len(news) > 0:
+				self.notify_change(tver)
+
+			spool.seek(0)
+			while True:
+				data = spool.read(65536)
+				if not data:
+					break
+				yield data
+		finally:
+			spool.close()
+
+	# Generate the pieces of the response to a sync once its push has
+	# been applied by apply_push(), whose results are passed on.
+	def sync_response(self, req, writer, pulled_version, filter, result, tver, conflict_count, mods, news):
+		yield writer.start()
+		for piece in self.push_response(writer, result, tver, conflict_count, mods, news):
+			yield piece
+		for piece in self.schema_response(writer, self.client_schema_version(req)):
+			yield piece
+
+		if result == 'OK' and self.needs_reset(pulled_version):
+			yield writer.field('reset', 1)
+		elif result == 'OK':
+			# If the push changed anything, its rows all have a tver of
+			# their own which no other row has.
+			where = "tver > ?"
+			params = [pulled_version]
+			if len(mods) > 0 or len(news) > 0:
+				where += " and tver != ?"
+				params.append(tver)
+			passes, passes_params = ("1", [])
+			if filter is not None and pulled_version == 0:
+				where += " and " + filter[0]
+				params.extend(filter[1])
+			elif filter is not None:
+				passes, passes_params = filter
+
+			cursor = self.conn.cursor()
+			yield writer.start_rows('rows')
+			cursor.execute("select %s from %s where id = 0" % (self.row_columns(), self.tablename))
+			for id, version, row_tver, data, deleted, prev_tver, prev_data in cursor.fetchall():
+				yield writer.row(data, id=id, version=version)
+			cursor.execute("select %s, %s from %s where id != 0 and %s order by id" % (self.row_columns(), passes, self.tablename, where), passes_params + params)
+			for id, version, row_tver, data, deleted, prev_tver, prev_data, passed in cursor:
+				if deleted:
+					yield writer.row(None, id=id, version=version, deleted=1)
+				elif not passed:
+					yield writer.row(None, id=id, version=version, filtered=1)
+				else:
+					yield writer.row(data, id=id, version=version)
+			yield writer.end_rows('rows')
+
+		yield writer.end()
+
+	# Change the columns of an stbcsv table. The operations, a list of
+	# (op, position, name) as described in csvschema.py, are recorded in
+	# coact_schema_ops at a new table version. Every row is rewritten
+	# with the new columns, but keeps its version and tver, so clients
+	# need only apply the operations to their own copies of the rows
+	# rather than pull them all again.
+	#
+	# The rows are read and rewritten batch_size at a time, but all in
+	# the same transaction as the log entry, so that no pull ever finds
+	# some rows with the old columns and some with the new.
+	#
+	# If schema_version is given and is not the version of the last schema
+	# operation, the caller has not seen all of them and may have got the
+	# positions wrong, so nothing is done and None is returned. Otherwise
+	# the new table version is returned.
+	def alter(self, operations, schema_version=None):
+		assert self.tabletype == 'stbcsv', "Only stbcsv tables have columns"
+		create_meta(self.conn)
+		self.upgrade()
+		cursor = self.conn.cursor()
+		cursor.execute("begin immediate transaction")
+		try:
+			if schema_version is not None and schema_version != get_schema_version(self.conn, self.tablename):
+				self.debug(1, "Schema operations made since version %d" % schema_version)
+				self.conn.rollback()
+				return None
+
+			tver = self.table_version() + 1
+			logged = [(tver, op, position, name) for op, position, name in operations]
+			cursor.execute("select data from %s where id = 0" % self.tablename)
+			header = cursor.fetchone()
+			if header is None:
+				raise BadRequest("table has no first row")
+			try:
+				csvschema.check_ops(header[0], logged)
+			except ValueError as e:
+				raise BadRequest(str(e))
+			add_schema_ops(self.conn, self.tablename, tver, operations)
+			self.alter_filter_columns(header[0], logged)
+			cursor.execute("update %s set data = ? where id = 0" % self.tablename, [csvschema.apply_ops(header[0], logged, header=True)])
+
+			last = 0
+			count = 0
+			while True:
+				cursor.execute("select id, data, prev_data from %s where id > ? and deleted = 0 order by id limit ?" % self.tablename, [last, self.batch_size])
+				rows = cursor.fetchall()
+				if len(rows) == 0:
+					break
+				cursor.executemany("update %s set data = ?, prev_data = ? where id = ?" % self.tablename,
+					[(csvschema.apply_ops(data, logged), prev_data if prev_data is None else csvschema.apply_ops(prev_data, logged), id)
+						for id, data, prev_data in rows])
+				last = rows[-1][0]
+				count += len(rows)
+
+			set_table_version(self.conn, self.tablename, tver)
+			self.conn.commit()
+		except:
+			self.conn.rollback()
+			raise
+
+		self.debug(1, "Schema operations at version %d applied to %d rows" % (tver, count))
+		self.notify_change(tver)
+		return tver
+
+	# Client is changing the columns of the table. The operations are
+	# sent as <schema_op op="..." position="..." name="..." /> along with
+	# the client's schema_version. If that is out of date, the result is
+	# FORMAT_CONFLICT. Either way, the response carries the operations
+	# which the client has yet to apply, including its own.
+	def handle_request_alter(self, req, writer, req_username):
+		operations = []
+		for op in req.findall("schema_op"):
+			if op.get("op") not in csvschema.ops:
+				raise BadRequest("unknown schema operation: %s" % op.get("op"))
+			operations.append((op.get("op"), int(op.get("position")), op.get("name")))
+		client_schema = self.client_schema_version(req)
+		if client_schema is None:
+			raise BadRequest("schema_version is required")
+		self.debug(1, "Alter by %s: %s" % (req_username, str(operations)))
+		tver = self.alter(operations, client_schema)
+		if tver is None:
+			result = 'FORMAT_CONFLICT'
+			tver = self.table_version()
+		else:
+			result = 'OK'
+		response = [writer.start()]
+		response.append(writer.field('result', result))
+		response.append(writer.field('version', tver))
+		response.extend(self.schema_response(writer, client_schema))
+		response.append(writer.end())
+		return "".join(response)
+
+	# Apply a batch of modified rows using whichever of the two methods
+	# below is faster for a batch of its size.
+	def apply_batch(self, rows, tver, req_username):
+		if len(rows) >= self.bulk_threshold:
+			return self.update_rows_bulk(rows, tver, req_username)
+		else:
+			return self.update_rows(rows, tver, req_username)
+
+	# With rows which the client claims to have modified, we try to updating them
+	# using a where clause which contains the number of the version on which the client
+	# claims to have based its modifications. If it has been changed since the client
+	# pulled, nothing will be modified and we will declare a conflict.
+	#
+	# This is done one row at a time, which is the quickest way when there
+	# are only a few of them. Returns the ids of the rows actually updated.
+	def update_rows(self, rows, tver, req_username):
+		cursor = self.conn.cursor()
+		mods = []
+		for id, version, text in rows:
+			self.debug(2, "%d, %d, %s" % (id, version, text))
+			cursor.execute("update %s set prev_tver=tver, prev_data=data, version=?, tver=?, user=?, data=? where id=? and version=?" % self.tablename, [version, tver, req_username, text, id, version-1])
+			if cursor.rowcount == 0:		# version not as expected
+				self.debug(1, "conflict")
+			else:
+				mods.append(id)
+		return mods
+
+	# The same as update_rows(), but for large pushes. The rows are loaded into
+	# a temporary table and then checked and applied with a few set-based
+	# statements rather than one statement per row. As in
+	# GeojsonServer.update_features_bulk(), any row sent more than once is
+	# applied by update_rows() after the first copy, so that each copy is
+	# checked against the version left by the one before it.
+	def update_rows_bulk(self, rows, tver, req_username):
+		self.debug(1, "Bulk update of %d rows" % len(rows))
+		first = []
+		repeats = []
+		seen = set()
+		for row in rows:
+			if row[0] in seen:
+				repeats.append(row)
+			else:
+				seen.add(row[0])
+				first.append(row)
+
+		cursor = self.conn.cursor()
+		cursor.execute("delete from coact_push")
+		cursor.executemany("insert into coact_push (id, version, data, accepted) values (?, ?, ?, 0)", first)
+
+		# Accept those rows whose server copy is still the version on which
+		# the client based its modifications. The rest are conflicts.
+		cursor.execute("update coact_push set accepted = 1 where exists"
+			" (select 1 from %s as t where t.id = coact_push.id and t.version = coact_push.version - 1)"
+			% self.tablename)
+		cursor.execute("update %s set prev_tver = tver, prev_data = data, version = version + 1, tver = ?, user = ?,"
+			" data = (select data from coact_push where coact_push.id = %s.id)"
+			" where id in (select id from coact_push where accepted = 1)"
+			% (self.tablename, self.tablename), [tver, req_username])
 
-		return ET.tostring(xml_top)
+		cursor.execute("select id from coact_push where accepted = 1")
+		mods = [row[0] for row in cursor]
+		cursor.execute("delete from coact_push")
+		mods.extend(self.update_rows(repeats, tver, req_username))
+		return mods
+
+	# Turn rows pushed as deltas into whole rows by applying each delta
+	# to the version on which the client based it. Rows of which the
+	# server no longer has that version are conflicts and are left out,
+	# as are those whose deltas do not fit. The rest are then applied
+	# with apply_batch() like any others, which checks the versions again.
+	def expand_deltas(self, rows):
+		cursor = self.conn.cursor()
+		expanded = []
+		for id, version, delta in rows:
+			cursor.execute("select data from %s where id=? and version=? and deleted=0" % self.tablename, [id, version-1])
+			base = cursor.fetchone()
+			if base is None:
+				self.debug(1, "conflict on delta for row %d" % id)
+				continue
+			try:
+				expanded.append((id, version, csvdelta.apply_delta(base[0], delta)))
+			except ValueError as e:
+				self.debug(1, "bad delta for row %d: %s" % (id, str(e)))
+		return expanded
+
+	# Turn rows which the client has deleted into tombstones, if the
+	# client had their latest versions, as update_rows() does with
+	# modified ones. Returns the ids of the rows deleted.
+	def delete_rows(self, rows, tver, req_username):
+		cursor = self.conn.cursor()
+		deleted = []
+		for id, version in rows:
+			cursor.execute("update %s set version=?, tver=?, user=?, data=null, deleted=1, prev_tver=null, prev_data=null where id=? and version=? and deleted=0" % self.tablename, [version, tver, req_username, id, version-1])
+			if cursor.rowcount == 0:
+				self.debug(1, "conflict on deletion of row %d" % id)
+			else:
+				deleted.append(id)
+		return deleted
+
+	# Insert new rows, giving them the ids which follow the highest one
+	# ever given out (see meta.py). Returns the ids assigned.
+	def insert_rows(self, texts, tver, req_username):
+		if len(texts) == 0:
+			return []
+		cursor = self.conn.cursor()
+		id = get_last_id(self.conn, self.tablename)
+		id = -1 if id is None else id
+		self.debug(1, "Last row was: %d" % id)
+
+		news = range(id + 1, id + 1 + len(texts))
+		cursor.executemany("insert into %s (id, version, tver, user, data) values (?, 1, ?, ?, ?)" % self.tablename,
+			[(id, tver, req_username, text) for id, text in zip(news, texts)])
+		set_last_id(self.conn, self.tablename, news[-1])
+		return news
 
 	# Parse the XML request, dispatch it to the proper handler,
 	# and send the handler's response back to the client.
-	def handle_request(self, in_fh, username):
-		assert username
+	#
+	# The request is parsed only as far as the first row container
+	# before it is dispatched. The handler gets the rows as they are
+	# parsed.
+	#
+	# The response is returned as an iterable of strings which should
+	# be written to the client one after another.
+	#
+	# If content_type is that of the binary format (see stbbin.py), the
+	# request is read and the response written in that format instead of
+	# XML. The response has the same content type as the request, as given
+	# by response_content_type().
+	#
+	# If accept_gzip is true, the response may be a SnapshotResponse (see
+	# snapshot.py) which is already gzip-compressed.
+	def handle_request(self, in_fh, username, content_type=None, accept_gzip=False):
+		req, writer = self.open_request(in_fh, content_type)
+		return self.dispatch_request(req, writer, username, accept_gzip)
 
-		req = ET.parse(in_fh)
-		action = req.find("type").text
+	# Start reading a request, as far as its first row container. Returns
+	# the reader and the writer for the response.
+	@staticmethod
+	def open_request(in_fh, content_type=None):
+		if content_type == stbbin.content_type:
+			return stbbin.BinaryRequestReader(in_fh), stbbin.BinaryResponseWriter()
+		return XMLRequestReader(in_fh), XMLResponseWriter()
+
+	# Handle a request which open_request() has started to read, as
+	# handle_request() does, writing the response with writer. A batch
+	# (see batch.py) calls this directly for each of the requests in it.
+	#
+	# If wait is false, a pull does not wait for changes even if it asks
+	# to, as when the caller has already waited (see wsgi.py).
+	def dispatch_request(self, req, writer, username, accept_gzip=False, wait=True):
+		assert username
+		action = req.type
 		self.debug(1, "Request: %s" % action)
 
+		# Note how far this client has pulled for compact.py
+		if action in ("pull", "sync"):
+			client_id = req.find("client_id")
+			record_client(self.conn, self.tablename, username, client_id.text if client_id is not None else None, int(req.find("pulled_version").text))
+
 		if action == "pull":
-			response = self.handle_request_pull(req)
+			response = None
+			if accept_gzip and self.snapshots is not None and self.is_cold_pull(req):
+				response = self.snapshots.response(self, snapshot_formats[writer.content_type], self.table_version())
+			if response is None:
+				response = chunked(self.handle_request_pull(req, writer, wait))
 		elif action == "push":
-			response = self.handle_request_push(req, username)
+			response = [self.handle_request_push(req, writer, username)]
+		elif action == "sync":
+			response = chunked(self.handle_request_sync(req, writer, username))
+		elif action == "alter":
+			response = [self.handle_request_alter(req, writer, username)]
 		else:
 			raise BadRequest("unrecognized request type")
 
@@ -223,6 +1062,155 @@ class SharedTableServer:
 
 		return response
 
+	# The (pulled_version, timeout) of a pull which asks to wait for a
+	# change (see wait_for_change()), or None if it does not. A pull
+	# which continues from a continuation never waits.
+	@staticmethod
+	def requested_wait(req):
+		if req.type != "pull" or req.find("continuation") is not None:
+			return None
+		wait = req.find("wait")
+		if wait is None:
+			return None
+		return int(req.find("pulled_version").text), float(wait.text)
+
+	@staticmethod
+	def response_content_type(content_type):
+		if content_type == stbbin.content_type:
+			return stbbin.content_type
+		return XMLResponseWriter.content_type
+
+# Reads a <request> incrementally. The simple elements at the start (<type>,
+# <pulled_version>, and the like) are parsed on creation and can be looked
+# up with find(). The <row>s in the <rows> and <new_rows> containers are
+# then handed out one at a time by rows() as they are parsed and are
+# discarded once the caller has moved on to the next one.
+#
+# BinaryRequestReader in stbbin.py does the same for requests in the
+# binary format.
+class XMLRequestReader:
+	row_containers = ('rows', 'new_rows', 'deleted_rows', 'delta_rows')
+
+	# If events is given, the request is read from it rather than from
+	# in_fh. It is an iterator of ElementTree.iterparse() events, the
+	# next of which is the start of the <request>, and is left at its end.
+	def __init__(self, in_fh, events=None):
+		if events is None:
+			events = ET.iterparse(in_fh, events=('start', 'end'))
+		self.events = iter(events)
+		event, self.root = self.events.next()
+		self.container = None
+		self.finished = False
+		for event, elem in self.events:
+			if event == 'start':
+				if elem.tag in self.row_containers:
+					self.container = elem
+					break
+			elif elem is self.root:
+				self.finished = True
+				break
+		self.type = self.root.findtext('type')
+
+	def find(self, path):
+		return self.root.find(path)
+
+	def findall(self, path):
+		return self.root.findall(path)
+
+	# Generate (container tag, id, version, text) for each row in the
+	# request. The id and version are None if the row does not have them.
+	def rows(self):
+		if self.finished:
+			return
+		for event, elem in self.events:
+			if event == 'start':
+				if elem.tag in self.row_containers:
+					self.container = elem
+			elif elem.tag == 'row' and self.container is not None:
+				id = elem.get('id')
+				version = elem.get('version')
+				yield (self.container.tag,
+					int(id) if id is not None else None,
+					int(version) if version is not None else None,
+					elem.text)
+				self.container.clear()
+			elif elem is self.container:
+				self.container = None
+			elif elem is self.root:
+				self.finished = True
+				return
+
+	# Skip whatever is left of the request.
+	def finish(self):
+		for row in self.rows():
+			pass
+
+# Serializes a <response> one piece at a time. The pieces, when joined,
+# are identical to what ET.tostring() produces for the equivalent tree
+# (same attribute order, same escaping, non-ASCII as character references).
+class XMLResponseWriter:
+	content_type = "application/xml"
+
+	def start(self):
+		return "<response>\n"
+
+	def end(self):
+		return "</response>"
+
+	def field(self, name, value):
+		return "<%s>%s</%s>\n" % (name, xml_text(value), name)
+
+	def start_rows(self, name):
+		return "<%s>\n" % name
+
+	def end_rows(self, name):
+		return "</%s>\n" % name
+
+	# Rows with just an id and a version are by far the most numerous,
+	# so they are formatted directly.
+	def row(self, text, id=None, version=None, **attrib):
+		if id is None or version is None or attrib:
+			if id is not None:
+				attrib['id'] = id
+			if version is not None:
+				attrib['version'] = version
+			return self.element('row', text, **attrib)
+		if text:
+			return '<row id="%d" version="%d">%s</row>\n' % (id, version, xml_text(text))
+		else:
+			return '<row id="%d" version="%d" />\n' % (id, version)
+
+	def element(self, tag, text, **attrib):
+		attrib = "".join([' %s="%s"' % (key, xml_attrib(attrib[key])) for key in sorted(attrib.keys())])
+		if text:
+			return "<%s%s>%s</%s>\n" % (tag, attrib, xml_text(text), tag)
+		else:
+			return "<%s%s />\n" % (tag, attrib)
+
+def xml_text(value):
+	if not isinstance(value, basestring):
+		value = str(value)
+	value = value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+	return value.encode("ascii", "xmlcharrefreplace")
+
+def xml_attrib(value):
+	return xml_text(value).replace("\"", "&quot;").replace("\n", "&#10;")
+
+# Join the many small pieces of a streamed response into chunks of a
+# reasonable size for writing to the client.
+def chunked(pieces, chunk_size=65536):
+	chunk = []
+	length = 0
+	for piece in pieces:
+		chunk.append(piece)
+		length += len(piece)
+		if length >= chunk_size:
+			yield "".join(chunk)
+			chunk = []
+			length = 0
+	if length > 0:
+		yield "".join(chunk)
+
 if __name__ == "__main__":
 	import sys
 	if len(sys.argv) != 4:
@@ -1,61 +1,76 @@
 #! /usr/bin/python
-# shared_table_modify.py
-# Last modified: 10 August 2013
+# pycoact/server/table_modify.py
+# Copyright 2013, 2026, Trinity College Computing Center
+# Last modified: 17 October 2026
+#
+# Change the columns of an stbcsv table from the command line. The
+# changes are made by SharedTableServer.alter(), which records them as
+# schema operations (see csvschema.py) for the clients to apply to their
+# own copies rather than giving every row a new version.
+#
+# It can also declare a column on which clients may filter their pulls
+# (see SharedTableServer.add_filter_column()).
+#
+# Usage: table_modify.py <filename> <tablename> add <col_after> <col_new>
+#        table_modify.py <filename> <tablename> drop <col>
+#        table_modify.py <filename> <tablename> rename <col> <col_new>
+#        table_modify.py <filename> <tablename> filter <col>
+#
 
 import sys
-import sqlite3
-
-import StringIO
 import csv
 
-# FIXME: untested
+from pycoact.server.table import SharedTableServer
+
 def csv_split(line):
-	r = csv.reader([line.encode('utf-8'))
+	r = csv.reader([line.encode('utf-8')])
 	return [unicode(cell, 'utf-8') for cell in r.next()]
 
-# FIXME: untested
-def csv_join(row):
-	f = StringIO.StringIO()
-	w = csv.writer(f)
-	w.writerow([cell.encode('utf-8') for cell in row])
-	w = None
-	return f.getvalue().decode('utf-8').strip()
+# The names of the columns as given by the first row
+def column_names(server):
+	cursor = server.conn.cursor()
+	cursor.execute("select data from %s where id = 0" % server.tablename)
+	row = cursor.fetchone()
+	assert row is not None, "Table has no first row"
+	return csv_split(row[0])
 
-# FIXME: untested
 def server_add_column(filename, tablename, col_after, col_new):
-	conn = sqlite3.connect(filename)
-	cursor = conn.cursor()
-	
-	cursor.execute("begin transaction")
-	
-	# Read table in
-	cursor.execute("select id, data from %s" % tablename)
-	rows = []
-	for id, data in cursor:
-		print id, data
-		r = csv.reader([data])
-		data_split = r.next()
-		rows.append([id, csv_split(data)])
-	
-	# Find position of new column and insert it
-	row1 = rows[0][1]
-	pos = row1.index(col_after) + 1
-	pos = find_pos(rows[0][1], col_after, col_new)
-	if pos < len(row1) and row1[pos] == col_new:
+	server = SharedTableServer(filename, tablename, "stbcsv")
+	columns = column_names(server)
+	pos = columns.index(col_after) + 1
+	if pos < len(columns) and columns[pos] == col_new:
 		print "Column was already added."
 		return
+	print "Table is now at version %d." % server.alter([("add", pos, col_new)])
+
+def server_drop_column(filename, tablename, col):
+	server = SharedTableServer(filename, tablename, "stbcsv")
+	print "Table is now at version %d." % server.alter([("drop", column_names(server).index(col), None)])
+
+def server_rename_column(filename, tablename, col, col_new):
+	server = SharedTableServer(filename, tablename, "stbcsv")
+	print "Table is now at version %d." % server.alter([("rename", column_names(server).index(col), col_new)])
 
-	value = col_new
-	for id, data_split in rows:
-		data_split.insert(pos, value)
-		value = ""
-	
-	# Write modified table out
-	for id, data_split in rows:
-		data = csv_join(data_split)
-		print id, data
-		cursor.execute("update %s set data = ? where id = ?" % tablename, (data, id))
-		print cursor.rowcount
-	
-	conn.commit()
+def server_filter_column(filename, tablename, col):
+	server = SharedTableServer(filename, tablename, "stbcsv")
+	if server.add_filter_column(col):
+		print "Pulls may now be filtered on %s." % col
+	else:
+		print "Column was already filterable."
 
+if __name__ == "__main__":
+	args = [arg.decode('utf-8') for arg in sys.argv[1:]]
+	if len(args) == 5 and args[2] == "add":
+		server_add_column(args[0], args[1], args[3], args[4])
+	elif len(args) == 4 and args[2] == "drop":
+		server_drop_column(args[0], args[1], args[3])
+	elif len(args) == 5 and args[2] == "rename":
+		server_rename_column(args[0], args[1], args[3], args[4])
+	elif len(args) == 4 and args[2] == "filter":
+		server_filter_column(args[0], args[1], args[3])
+	else:
+		sys.stderr.write("Usage: %s <filename> <tablename> add <col_after> <col_new>\n" % sys.argv[0])
+		sys.stderr.write("       %s <filename> <tablename> drop <col>\n" % sys.argv[0])
+		sys.stderr.write("       %s <filename> <tablename> rename <col> <col_new>\n" % sys.argv[0])
+		sys.stderr.write("       %s <filename> <tablename> filter <col>\n" % sys.argv[0])
+		sys.exit(1)
@@ -0,0 +1,302 @@
+#! /usr/bin/python
+# pycoact/server/wsgi.py
+# Copyright 2026, Trinity College Computing Center
+# Last modified: 17 October 2026
+#
+# Long-running WSGI frontend for the shared table servers. Requests are
+# routed exactly as in coact.cgi (PATH_INFO is /<db>/<table>.<type>, or
+# /<db>/batch for a batch of requests to several tables, see batch.py),
+# but the sqlite3 connections and the server objects built on them are
+# kept open between requests so that process startup and connection
+# setup are paid once per worker rather than once per request.
+#
+
+import sys
+import os
+import re
+import threading
+import traceback
+import SocketServer
+
+from pycoact.server.table import SharedTableServer
+from pycoact.server.geojson import GeojsonServer
+from pycoact.server.meta import connect
+from pycoact.server.notify import VersionNotifier
+from pycoact.server.cache import ResponseCache
+from pycoact.server.snapshot import SnapshotManager
+from pycoact.server.compress import request_reader, response_encoding, compress_chunks, response_headers
+from pycoact.server.batch import handle_batch
+
+path_info_re = re.compile(r'/([a-z0-9_]+)/([a-z0-9_]+)\.([a-z0-9]+)$')
+batch_path_re = re.compile(r'/([a-z0-9_]+)/batch$')
+
+# Wrapper for wsgi.input which will not read past the end of the
+# request body. Without it ET.parse() and json.load() would wait for
+# EOF on a keep-alive socket.
+class RequestBody(object):
+	def __init__(self, fh, length):
+		self.fh = fh
+		self.remaining = length
+
+	def read(self, size=-1):
+		if size < 0 or size > self.remaining:
+			size = self.remaining
+		if size == 0:
+			return ""
+		data = self.fh.read(size)
+		self.remaining -= len(data)
+		return data
+
+# An open connection to one database together with the server objects
+# for those of its tables which have been requested through it.
+class DatabaseHandle(object):
+	def __init__(self, filename):
+		self.filename = filename
+		# Handles are checked out by one request at a time, but not
+		# necessarily always by the same thread.
+		self.conn = connect(filename, check_same_thread=False)
+		self.tables = {}
+
+	def table(self, tablename, tabletype, debug_level, notifier=None, cache=None, snapshots=None):
+		key = (tablename, tabletype)
+		table = self.tables.get(key)
+		if table is None:
+			if tabletype == "stbcsv":
+				table = SharedTableServer(self.filename, tablename, tabletype, conn=self.conn)
+			elif tabletype == "geojson":
+				table = GeojsonServer(self.filename, tablename, conn=self.conn)
+			else:
+				raise ValueError("invalid table type: %s" % tabletype)
+			self.tables[key] = table
+		table.debug_level = debug_level
+		table.notifier = notifier
+		table.cache = cache
+		table.snapshots = snapshots
+		return table
+
+	# Throw away anything left uncommitted by a failed request so
+	# that the next user of this handle starts clean.
+	def reset(self):
+		self.conn.rollback()
+
+	def close(self):
+		self.tables = {}
+		self.conn.close()
+
+# Pool of idle database handles. A request takes a handle for its database
+# out of the pool (opening a new one if none is idle) and puts it back when
+# it is done, so no two requests ever share a connection. No more than
+# max_idle handles are kept. When there are more, the least recently
+# used are closed.
+class ConnectionPool(object):
+	def __init__(self, directory, max_idle=16):
+		self.directory = directory
+		self.max_idle = max_idle
+		self.lock = threading.Lock()
+		self.idle = []			# (db_name, handle), most recently used last
+		self.opened = 0
+		self.reused = 0
+
+	def acquire(self, db_name):
+		with self.lock:
+			for i in range(len(self.idle) - 1, -1, -1):
+				if self.idle[i][0] == db_name:
+					self.reused += 1
+					return self.idle.pop(i)[1]
+			self.opened += 1
+		return DatabaseHandle(os.path.join(self.directory, "%s.db" % db_name))
+
+	def release(self, db_name, handle):
+		with self.lock:
+			self.idle.append((db_name, handle))
+			expired = self.idle[:-self.max_idle]
+			del self.idle[:-self.max_idle]
+		for db_name, handle in expired:
+			handle.close()
+
+	def close(self):
+		with self.lock:
+			idle = self.idle
+			self.idle = []
+		for db_name, handle in idle:
+			handle.close()
+
+# Iterable response which puts the database handle back into the pool
+# once the server has finished sending it (or has given up on it).
+class PooledResponse(object):
+	def __init__(self, response, pool, db_name, handle):
+		self.response = iter(response)
+		self.pool = pool
+		self.db_name = db_name
+		self.handle = handle
+		self.pending = []
+
+	def first(self):
+		for chunk in self.response:
+			if isinstance(chunk, unicode):
+				chunk = chunk.encode('utf-8')
+			self.pending.append(chunk)
+			return chunk
+		return ""
+
+	def __iter__(self):
+		for chunk in self.pending:
+			yield chunk
+		self.pending = []
+		for chunk in self.response:
+			if isinstance(chunk, unicode):
+				chunk = chunk.encode('utf-8')
+			yield chunk
+
+	def close(self):
+		if self.handle is not None:
+			close = getattr(self.response, 'close', None)
+			if close is not None:
+				close()
+			self.handle.reset()
+			self.pool.release(self.db_name, self.handle)
+			self.handle = None
+
+# Pulls which ask to wait for changes (see SharedTableServer.wait_for_change())
+# are woken through notifier by pushes handled by this application. A pull
+# gives its database handle back to the pool while it waits, but keeps its
+# thread, so the server in front of this must handle requests in threads.
+#
+# Pull responses are kept in cache, which holds no more than cache_bytes
+# of them. Its hit and miss counts are in cache.stats().
+#
+# Cold pulls are answered from snapshots, which are rewritten every
+# snapshot_interval table versions. Snapshots are sent with the server's
+# wsgi.file_wrapper, if it has one, so that it can use sendfile().
+class CoactApplication(object):
+	def __init__(self, directory, max_idle=16, debug_level=1, cache_bytes=32*1024*1024, snapshot_interval=100):
+		self.pool = ConnectionPool(directory, max_idle)
+		self.notifier = VersionNotifier()
+		self.cache = ResponseCache(cache_bytes)
+		self.snapshots = SnapshotManager(snapshot_interval)
+		self.debug_level = debug_level
+
+	def __call__(self, environ, start_response):
+		try:
+			m = path_info_re.match(environ.get('PATH_INFO', ''))
+			if m:
+				db_name = m.group(1)
+				tablename = m.group(2)
+				tabletype = m.group(3)
+			else:
+				m = batch_path_re.match(environ.get('PATH_INFO', ''))
+				assert m, "Invalid PATH_INFO"
+				db_name = m.group(1)
+				tablename = None
+				tabletype = "batch"
+
+			body = RequestBody(environ['wsgi.input'], int(environ.get('CONTENT_LENGTH') or 0))
+			body = request_reader(body, environ.get('HTTP_CONTENT_ENCODING'))
+
+			encoding = response_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+			accept_gzip = encoding == "gzip"
+
+			if tabletype == "stbcsv":
+				req, writer = SharedTableServer.open_request(body, environ.get('CONTENT_TYPE'))
+				wait = SharedTableServer.requested_wait(req)
+				if wait is not None:
+					self.wait_for_change(db_name, tablename, *wait)
+
+			handle = self.pool.acquire(db_name)
+			try:
+				if tabletype == "batch":
+					def table(name):
+						return handle.table(name, "stbcsv", self.debug_level, self.notifier, self.cache, self.snapshots)
+					response = handle_batch(body, environ.get('REMOTE_USER'), table, environ.get('CONTENT_TYPE'))
+					mime_type = SharedTableServer.response_content_type(environ.get('CONTENT_TYPE'))
+					debug = None
+				elif tabletype == "stbcsv":
+					table = handle.table(tablename, tabletype, self.debug_level, self.notifier, self.cache, self.snapshots)
+					response = table.dispatch_request(req, writer, environ.get('REMOTE_USER'), accept_gzip, wait=False)
+					mime_type = table.response_content_type(environ.get('CONTENT_TYPE'))
+					debug = lambda message: table.debug(1, message)
+				else:
+					table = handle.table(tablename, tabletype, self.debug_level, self.notifier, self.cache, self.snapshots)
+					response = table.handle_request(body, environ.get('REMOTE_USER'), environ, accept_gzip)
+					mime_type = "application/json"
+					debug = lambda message: table.debug(1, message)
+				if isinstance(response, basestring):
+					response = [response]
+				snapshot = getattr(response, 'content_encoding', None) is not None
+				if encoding is not None and not snapshot:
+					response = compress_chunks(response, encoding, debug)
+			except:
+				handle.reset()
+				self.pool.release(db_name, handle)
+				raise
+
+			# A snapshot is sent straight from its file and does not
+			# need the database.
+			if snapshot:
+				handle.reset()
+				self.pool.release(db_name, handle)
+				start_response("200 OK", [('Content-Type', mime_type)] + response_headers(response.content_encoding))
+				file_wrapper = environ.get('wsgi.file_wrapper')
+				if file_wrapper is not None:
+					return file_wrapper(response.fh, 65536)
+				return response
+
+			# Pull responses are generated as they are sent. Get the
+			# first piece now so that errors in setting up the response
+			# are still reported as such.
+			response = PooledResponse(response, self.pool, db_name, handle)
+			try:
+				response.first()
+			except:
+				response.close()
+				raise
+
+			start_response("200 OK", [('Content-Type', mime_type)] + response_headers(encoding))
+			return response
+
+		except Exception as e:
+			message = traceback.format_exc()
+			environ['wsgi.errors'].write("%s\n" % message)
+			start_response("500 Request failed", [('Content-Type', 'text/plain')], sys.exc_info())
+			return [message]
+
+	# Wait as a pull has asked to for a change to a table. A handle is
+	# taken from the pool only to read the table version, and is given
+	# back before the wait begins.
+	def wait_for_change(self, db_name, tablename, pulled_version, timeout):
+		handle = self.pool.acquire(db_name)
+		released = []
+		def release():
+			handle.reset()
+			self.pool.release(db_name, handle)
+			released.append(handle)
+		try:
+			table = handle.table(tablename, "stbcsv", self.debug_level, self.notifier, self.cache, self.snapshots)
+			table.wait_for_change(pulled_version, timeout, release)
+		finally:
+			if not released:
+				release()
+
+if __name__ == "__main__":
+	from wsgiref.simple_server import make_server, WSGIServer
+	import getpass
+
+	# So that pulls waiting for changes do not hold up other requests
+	class ThreadingWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+		daemon_threads = True
+
+	if len(sys.argv) not in (2, 3):
+		sys.stderr.write("Usage: %s <shared_tables_directory> [<port>]\n" % sys.argv[0])
+		sys.exit(1)
+	application = CoactApplication(sys.argv[1])
+	port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
+
+	# There is no web server in front of wsgiref to do the authentication,
+	# so requests are attributed to the user running this server.
+	def local_application(environ, start_response):
+		environ.setdefault('REMOTE_USER', getpass.getuser())
+		return application(environ, start_response)
+
+	httpd = make_server('127.0.0.1', port, local_application, server_class=ThreadingWSGIServer)
+	sys.stderr.write("Serving %s on port %d...\n" % (sys.argv[1], port))
+	httpd.serve_forever()
@@ -0,0 +1,597 @@
+#! /usr/bin/python
+# pycoact/stbbin.py
+# Copyright 2026, Trinity College Computing Center
+# Last modified: 17 October 2026
+#
+# Compact binary alternative to the XML requests and responses exchanged
+# by SharedTable and SharedTableServer. It carries exactly the same
+# information as the XML and is selected by sending the request with a
+# Content-Type of application/x-coact-stbbin. The response comes back
+# in the same format.
+#
+# A message is the magic string "STB2" followed by records, each of which
+# begins with a one-byte record type:
+#
+#   F <name> <value>                   a simple element such as <type>
+#   A <name> <count> (<key> <value>)*  an empty element with attributes,
+#                                      such as <continuation>
+#   C <name>                           start of a row container such as <rows>
+#   B <count> <flags> [<ids>] [<versions>] [<row flags>] [<texts>]
+#                                      a block of <row>s in the current
+#                                      container
+#   Z                                  end of message
+#
+# Numbers (counts and lengths) are unsigned varints, 7 bits per byte,
+# least significant group first. Strings are a varint byte count
+# followed by that many bytes of UTF-8.
+#
+# Rows are sent in blocks of up to block_size, column by column, so that
+# each column of a block can be packed and unpacked in one go. The flags
+# of a block say which of the optional parts follow and how wide its ids
+# and versions are. They are packed little-endian, each as 2, 4, or 8
+# bytes. The row flags, a byte for each row, say whether the row is a
+# tombstone (a <row deleted="1"> in the XML), whether its text is a delta
+# (a <row delta="1">, see csvdelta.py), and whether it has left the
+# filter of a filtered pull (a <row filtered="1">). They are left out if
+# none are set. The texts are one string, with the rows' texts separated
+# by NUL characters, which XML cannot carry either. As in XML, empty and
+# missing text are the same.
+#
+# A batch of messages for several tables (see server/batch.py) is the
+# magic string "STBB" followed by the number of tables and then, for
+# each table, its name, its message as a series of strings ending with
+# an empty one, and an error message (empty if there was none). The
+# server sends each piece of a response as one of the strings as soon
+# as it has it, and if the request fails, sends the error with whatever
+# pieces it has sent already, which the client then ignores.
+#
+
+import re
+import struct
+import StringIO
+from itertools import izip, imap, repeat, groupby
+import xml.etree.cElementTree as ET
+
+content_type = "application/x-coact-stbbin"
+
+magic = "STB2"
+
+block_size = 1024
+
+BLOCK_ID = 1
+BLOCK_VERSION = 2
+BLOCK_FLAGS = 4
+BLOCK_TEXT = 8
+BLOCK_ID_WIDTH = 4			# shift of the 2 bits which give the width of the ids
+BLOCK_VERSION_WIDTH = 6		# and of the versions
+
+ROW_DELETED = 1
+ROW_DELTA = 2
+ROW_FILTERED = 4
+
+# struct format characters of the widths of ids and versions
+widths = "HIQ"
+
+row_containers = ('rows', 'new_rows', 'deleted_rows', 'delta_rows', 'modified_rows')
+
+#=============================================================================
+# Encoding
+#=============================================================================
+
+def varint(n):
+	assert n >= 0, "varints are unsigned"
+	if n < 0x80:
+		return chr(n)
+	out = []
+	while n >= 0x80:
+		out.append(chr((n & 0x7f) | 0x80))
+		n >>= 7
+	out.append(chr(n))
+	return "".join(out)
+
+def string(value):
+	if isinstance(value, unicode):
+		value = value.encode('utf-8')
+	elif not isinstance(value, str):
+		value = str(value)
+	return varint(len(value)) + value
+
+def field(name, value):
+	return "F" + string(name) + string(value)
+
+def element(name, attrib):
+	return "A" + string(name) + varint(len(attrib)) \
+		+ "".join([string(key) + string(attrib[key]) for key in sorted(attrib.keys())])
+
+def container(name):
+	return "C" + string(name)
+
+# Pack a column of ids or versions. Returns its width code and the data.
+def pack_numbers(numbers):
+	top = max(numbers)
+	if top < 0x10000:
+		width = 0
+	elif top < 0x100000000:
+		width = 1
+	else:
+		width = 2
+	return width, struct.pack("<%d%s" % (len(numbers), widths[width]), *numbers)
+
+# Encode rows, given as a list of (id, version, text, row flags), as
+# blocks. Rows all of which have ids and versions or all of which have
+# none go in the same block.
+def rows_blocks(rows):
+	out = []
+	for start in range(0, len(rows), block_size):
+		ids, versions, texts, flags = zip(*rows[start:start + block_size])
+		if (None in ids or None in versions) and not (ids.count(None) == len(ids) and versions.count(None) == len(versions)):
+			for shape, group in groupby(rows[start:start + block_size], lambda row: (row[0] is None, row[1] is None)):
+				group = list(group)
+				ids, versions, texts, flags = zip(*group)
+				out.append(rows_block(ids if not shape[0] else None, versions if not shape[1] else None, texts, flags))
+		else:
+			out.append(rows_block(ids if ids[0] is not None else None, versions if versions[0] is not None else None, texts, flags))
+	return "".join(out)
+
+def rows_block(ids, versions, texts, flags):
+	block_flags = 0
+	parts = []
+	if ids is not None:
+		width, data = pack_numbers(ids)
+		block_flags |= BLOCK_ID | (width << BLOCK_ID_WIDTH)
+		parts.append(data)
+	if versions is not None:
+		width, data = pack_numbers(versions)
+		block_flags |= BLOCK_VERSION | (width << BLOCK_VERSION_WIDTH)
+		parts.append(data)
+	if any(flags):
+		block_flags |= BLOCK_FLAGS
+		parts.append("".join(map(chr, flags)))
+	if texts.count(None) != len(texts):
+		if None in texts:
+			texts = [text or u"" for text in texts]
+		data = u"\0".join(texts).encode('utf-8')
+		if data.count("\0") != len(texts) - 1:
+			raise ValueError("row text contains a NUL character")
+		block_flags |= BLOCK_TEXT
+		parts.append(string(data))
+	return "B" + varint(len(texts)) + chr(block_flags) + "".join(parts)
+
+# Encode a request or response held as an ElementTree element.
+def encode_tree(top):
+	out = [magic]
+	for child in top:
+		if child.tag in row_containers:
+			out.append(container(child.tag))
+			rows = []
+			for r in child:
+				id = r.get('id')
+				version = r.get('version')
+				rows.append((int(id) if id is not None else None, int(version) if version is not None else None, r.text,
+					(r.get('deleted') is not None and ROW_DELETED) | (r.get('delta') is not None and ROW_DELTA) | (r.get('filtered') is not None and ROW_FILTERED)))
+			if len(rows) > 0:
+				out.append(rows_blocks(rows))
+		elif len(child.attrib) > 0:
+			out.append(element(child.tag, child.attrib))
+		else:
+			out.append(field(child.tag, child.text or ""))
+	out.append("Z")
+	return "".join(out)
+
+# Streaming counterpart to XMLResponseWriter in server/table.py. Rows are
+# held back until there are enough of them to fill a block or their
+# container ends, so row() mostly returns "".
+class BinaryResponseWriter:
+	content_type = content_type
+
+	def __init__(self):
+		self.rows = []
+
+	def start(self):
+		return magic
+
+	def end(self):
+		return "Z"
+
+	def field(self, name, value):
+		return field(name, value)
+
+	def start_rows(self, name):
+		return container(name)
+
+	def end_rows(self, name):
+		rows = self.rows
+		self.rows = []
+		return rows_blocks(rows)
+
+	def row(self, text, id=None, version=None, deleted=False, delta=False, filtered=False):
+		if deleted or delta or filtered:
+			self.rows.append((id, version, text, (deleted and ROW_DELETED) | (delta and ROW_DELTA) | (filtered and ROW_FILTERED)))
+		else:
+			self.rows.append((id, version, text, 0))
+		if len(self.rows) < block_size:
+			return ""
+		rows = self.rows
+		self.rows = []
+		return rows_blocks(rows)
+
+	def element(self, tag, text, **attrib):
+		return element(tag, attrib)
+
+#=============================================================================
+# Decoding
+#=============================================================================
+
+class DecodeError(Exception):
+	pass
+
+# Reads varints and strings from a file object, a block at a time.
+class Reader:
+	def __init__(self, fh, block_size=65536):
+		self.fh = fh
+		self.block_size = block_size
+		self.buffer = ""
+		self.pos = 0
+
+	# Make sure that there are at least count bytes in the buffer
+	# or, failing that, at least required bytes before the end of
+	# the message.
+	def fill(self, count, required=None):
+		if self.pos + count > len(self.buffer):
+			self.buffer = self.buffer[self.pos:]
+			self.pos = 0
+			while len(self.buffer) < count:
+				data = self.fh.read(max(self.block_size, count - len(self.buffer)))
+				if not data:
+					if len(self.buffer) < (count if required is None else required):
+						raise DecodeError("message is truncated")
+					break
+				self.buffer += data
+
+	def byte(self):
+		self.fill(1)
+		c = self.buffer[self.pos]
+		self.pos += 1
+		return c
+
+	def bytes(self, count):
+		self.fill(count)
+		data = self.buffer[self.pos:self.pos + count]
+		self.pos += count
+		return data
+
+	def varint(self):
+		self.fill(10, 1)		# 10 bytes is enough for any 64-bit value
+		buffer = self.buffer
+		pos = self.pos
+		try:
+			b = ord(buffer[pos])
+			pos += 1
+			n = b & 0x7f
+			shift = 7
+			while b & 0x80:
+				b = ord(buffer[pos])
+				pos += 1
+				n |= (b & 0x7f) << shift
+				shift += 7
+		except IndexError:
+			raise DecodeError("message is truncated")
+		self.pos = pos
+		return n
+
+	def string(self):
+		return self.bytes(self.varint()).decode('utf-8')
+
+	# Generate the records of the message as (kind, name, value). For
+	# blocks of rows, name is (ids, versions, texts), each a sequence
+	# with an item for each row, and value is the row flags, a string
+	# with a byte for each row, or None if there are none.
+	def records(self):
+		if self.bytes(len(magic)) != magic:
+			raise DecodeError("not an stbbin message")
+		while True:
+			kind = self.byte()
+			if kind == "B":
+				count = self.varint()
+				block_flags = ord(self.byte())
+				ids, versions, flags, texts = unpack_block(count, block_flags, self.bytes, self.string)
+				yield ("B", (ids, versions, texts), flags)
+			elif kind == "F":
+				name = self.string()
+				yield ("F", name, self.string())
+			elif kind == "A":
+				name = self.string()
+				attrib = {}
+				for i in range(self.varint()):
+					key = self.string()
+					attrib[key] = self.string()
+				yield ("A", name, attrib)
+			elif kind == "C":
+				yield ("C", self.string(), None)
+			elif kind == "Z":
+				return
+			else:
+				raise DecodeError("unknown record type %r" % kind)
+
+# Unpack the columns of a block of count rows with the given flags,
+# reading count bytes with bytes() and the texts with string(). Returns
+# the ids, versions, row flags, and texts. Missing columns are None,
+# except for the texts, which are then None for each row.
+def unpack_block(count, block_flags, bytes, string):
+	ids = versions = flags = None
+	try:
+		if block_flags & BLOCK_ID:
+			width = widths[(block_flags >> BLOCK_ID_WIDTH) & 3]
+			ids = struct.unpack("<%d%s" % (count, width), bytes(count * struct.calcsize(width)))
+		if block_flags & BLOCK_VERSION:
+			width = widths[(block_flags >> BLOCK_VERSION_WIDTH) & 3]
+			versions = struct.unpack("<%d%s" % (count, width), bytes(count * struct.calcsize(width)))
+	except (struct.error, IndexError):
+		raise DecodeError("bad block of rows")
+	if block_flags & BLOCK_FLAGS:
+		flags = bytes(count)
+	if block_flags & BLOCK_TEXT:
+		texts = string().split(u"\0")
+		if len(texts) != count:
+			raise DecodeError("block of %d rows has %d texts" % (count, len(texts)))
+		if u"" in texts:
+			texts = [text or None for text in texts]
+	else:
+		texts = [None] * count
+	return ids, versions, flags, texts
+
+# A decoded message or element other than a row container. It is a list of
+# its children and answers the subset of the ElementTree interface
+# which SharedTable uses (tag, attrib, text, get(), find(), findall(),
+# and findtext()), so that the client can read a binary response just
+# as it would read the XML.
+class Node(list):
+	def __init__(self, tag, attrib=None, text=None):
+		list.__init__(self)
+		self.tag = tag
+		self.attrib = attrib if attrib is not None else {}
+		self.text = text
+
+	def get(self, key, default=None):
+		return self.attrib.get(key, default)
+
+	def set(self, key, value):
+		self.attrib[key] = value
+
+	def find(self, tag):
+		for child in self:
+			if child.tag == tag:
+				return child
+		return None
+
+	def findall(self, tag):
+		return [child for child in self if child.tag == tag]
+
+	def findtext(self, tag, default=None):
+		child = self.find(tag)
+		if child is None:
+			return default
+		return child.text or ""
+
+# Read a varint or a string starting at pos in data. Return it and the
+# position after it.
+def read_varint(data, pos):
+	b = ord(data[pos])
+	pos += 1
+	n = b & 0x7f
+	shift = 7
+	while b & 0x80:
+		b = ord(data[pos])
+		pos += 1
+		n |= (b & 0x7f) << shift
+		shift += 7
+	return n, pos
+
+def read_string(data, pos):
+	n, pos = read_varint(data, pos)
+	if pos + n > len(data):
+		raise DecodeError("message is truncated")
+	return data[pos:pos + n].decode('utf-8'), pos + n
+
+# Reads the parts of a message held in a string for unpack_block().
+class StringReader:
+	def __init__(self, data, pos):
+		self.data = data
+		self.pos = pos
+
+	def bytes(self, count):
+		if self.pos + count > len(self.data):
+			raise DecodeError("message is truncated")
+		self.pos += count
+		return self.data[self.pos - count:self.pos]
+
+	def string(self):
+		n, self.pos = read_varint(self.data, self.pos)
+		return self.bytes(n).decode('utf-8')
+
+# The attributes which the row flags stand for
+flag_attributes = [(ROW_DELETED, 'deleted'), (ROW_DELTA, 'delta'), (ROW_FILTERED, 'filtered')]
+set_flag_re = re.compile("[^\0]")
+
+# Add the rows of a block to a row container as <row> elements. They
+# are made with SubElement() rather than as Nodes, which is quicker for
+# so many of them and gives the client the same rows as XML would.
+def add_block_rows(container, ids, versions, flags, texts):
+	start = len(container)
+	if ids is not None and versions is not None:
+		attribs = [{'id': id, 'version': version} for id, version in izip(imap(str, ids), imap(str, versions))]
+	elif ids is not None:
+		attribs = [{'id': id} for id in imap(str, ids)]
+	elif versions is not None:
+		attribs = [{'version': version} for version in imap(str, versions)]
+	else:
+		attribs = [{} for text in texts]
+	for row, text in izip(map(ET.SubElement, repeat(container, len(attribs)), repeat('row', len(attribs)), attribs), texts):
+		row.text = text
+	if flags is not None:
+		for match in set_flag_re.finditer(flags):
+			row = container[start + match.start()]
+			for flag, name in flag_attributes:
+				if ord(flags[match.start()]) & flag:
+					row.set(name, '1')
+
+# Decode a message into a tree of Nodes, with ElementTree elements for
+# the row containers, with the same structure as the XML would have had.
+#
+# The whole message is already in memory, so rather than going through
+# Reader this works straight from the string.
+def decode(data, tag="response"):
+	if data[:len(magic)] != magic:
+		raise DecodeError("not an stbbin message")
+	top = Node(tag)
+	rows = None
+	pos = len(magic)
+	try:
+		while True:
+			kind = data[pos]
+			pos += 1
+			if kind == "B":
+				if rows is None:
+					raise DecodeError("row outside of a container")
+				count, pos = read_varint(data, pos)
+				reader = StringReader(data, pos + 1)
+				ids, versions, flags, texts = unpack_block(count, ord(data[pos]), reader.bytes, reader.string)
+				pos = reader.pos
+				add_block_rows(rows, ids, versions, flags, texts)
+			elif kind == "F":
+				name, pos = read_string(data, pos)
+				text, pos = read_string(data, pos)
+				top.append(Node(name, text=text))
+			elif kind == "A":
+				name, pos = read_string(data, pos)
+				count, pos = read_varint(data, pos)
+				attrib = {}
+				for i in range(count):
+					key, pos = read_string(data, pos)
+					attrib[key], pos = read_string(data, pos)
+				top.append(Node(name, attrib))
+			elif kind == "C":
+				name, pos = read_string(data, pos)
+				rows = ET.Element(name)
+				top.append(rows)
+			elif kind == "Z":
+				return top
+			else:
+				raise DecodeError("unknown record type %r" % kind)
+	except IndexError:
+		raise DecodeError("message is truncated")
+
+# Convert a decoded message back to an ElementTree element, for
+# printing in debugging output.
+def to_element(node):
+	if not isinstance(node, Node):
+		return node
+	element = ET.Element(node.tag, dict(node.attrib))
+	element.text = node.text
+	element.tail = '\n'
+	for child in node:
+		element.append(to_element(child))
+	return element
+
+# Streaming counterpart to XMLRequestReader in server/table.py
+class BinaryRequestReader:
+	def __init__(self, in_fh):
+		self.root = ET.Element('request')
+		self.records = Reader(in_fh).records()
+		self.container = None
+		for kind, name, value in self.records:
+			if kind == "F":
+				ET.SubElement(self.root, name).text = value
+			elif kind == "A":
+				ET.SubElement(self.root, name, value)
+			elif kind == "C":
+				self.container = name
+				break
+			else:
+				raise DecodeError("row outside of a container")
+		self.type = self.root.findtext('type')
+
+	def find(self, path):
+		return self.root.find(path)
+
+	def findall(self, path):
+		return self.root.findall(path)
+
+	# Generate (container tag, id, version, text) for each row in the request.
+	def rows(self):
+		for kind, name, value in self.records:
+			if kind == "B":
+				if self.container is None:
+					raise DecodeError("row outside of a container")
+				ids, versions, texts = name
+				container = self.container
+				for id, version, text in izip(ids or repeat(None), versions or repeat(None), texts):
+					yield (container, id, version, text)
+			elif kind == "C":
+				self.container = name
+
+#=============================================================================
+# Batches
+#=============================================================================
+
+batch_magic = "STBB"
+
+def batch_start(count):
+	return batch_magic + varint(count)
+
+def batch_part_start(name):
+	return string(name)
+
+def batch_piece(data):
+	if data:
+		return string(data)
+	return ""
+
+def batch_part_end(error=""):
+	return varint(0) + string(error)
+
+def batch_part(name, message, error=""):
+	return batch_part_start(name) + batch_piece(message) + batch_part_end(error)
+
+# Encode a <batch> of <table name="..."> elements, each holding the
+# request for that table.
+def encode_batch(top):
+	tables = list(top)
+	return batch_start(len(tables)) + "".join([batch_part(table.get('name'), encode_tree(table[0])) for table in tables])
+
+# Read the start of a batch. Returns the number of tables and an
+# iterator of (name, error, message) for each table, which reads the
+# table's part of the batch when it is reached.
+def open_batch(fh):
+	reader = Reader(fh)
+	if reader.bytes(len(batch_magic)) != batch_magic:
+		raise DecodeError("not an stbbin batch")
+	count = reader.varint()
+	def parts():
+		for i in range(count):
+			name = reader.string()
+			pieces = []
+			while True:
+				length = reader.varint()
+				if length == 0:
+					break
+				pieces.append(reader.bytes(length))
+			yield (name, reader.string(), "".join(pieces))
+	return count, parts()
+
+# Generate (name, error, message) for each table in a batch.
+def read_batch(fh):
+	return open_batch(fh)[1]
+
+# Decode a batch of responses into a Node with the same structure
+# as the XML <batch> would have had.
+def decode_batch(data):
+	top = Node('batch')
+	for name, error, message in read_batch(StringIO.StringIO(data)):
+		child = Node('table', {'name':name})
+		if error:
+			child.set('error', error)
+		else:
+			child.append(decode(message))
+		top.append(child)
+	return top
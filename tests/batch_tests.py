@@ -0,0 +1,107 @@
+#! /usr/bin/python
+# coding=utf-8
+# pycoact/tests/batch_tests.py
+# Last modified: 17 October 2026
+#
+# Tests of batches, which sync several tables of a database in one
+# request and report the errors of each table on its own.
+#
+# Usage: batch_tests.py [-v] [<test name>...]
+#
+
+import sys
+import unittest
+import StringIO
+import xml.etree.cElementTree as ET
+
+sys.path.insert(1, "../..")
+from pycoact import stbbin
+from pycoact.server.table import SharedTableServer
+from pycoact.server.batch import handle_batch
+from pycoact.client.table import SharedTable, SharedTableError
+from harness import ServerTests, people
+
+class BatchTests(ServerTests):
+	def test_batch_sync_reports_errors_per_table(self):
+		alice_people = self.seed(people(3))
+		alice_places = self.seed([['Place'], ['Paris'], ['Rome']], "places")
+		bob_people = self.client("bob")
+		bob_places = self.client("bob", tablename="places")
+		results = SharedTable.sync_batch([bob_people, bob_places])
+		self.assertEqual([pull for push, pull in results], [(4, 0), (3, 0)])
+		self.assertEqual(self.read(bob_places), self.read(alice_places))
+
+		# A table which does not exist fails on its own. The others
+		# are synced all the same.
+		self.edit(bob_people, {(1, 2): '50'})
+		self.edit(bob_places, {(2, 0): 'Roma'})
+		missing = self.client("bob", tablename="missing")
+		try:
+			SharedTable.sync_batch([bob_people, missing, bob_places])
+			self.fail("sync_batch() should have failed")
+		except SharedTableError as e:
+			self.assertTrue("missing" in str(e))
+			self.assertFalse("people" in str(e) or "places" in str(e))
+		self.assertEqual(self.server_rows()[1], 'Person 1,London,50')
+		self.assertEqual(self.server_rows("places")[2], 'Roma')
+		alice_people.pull()
+		alice_places.pull()
+		self.assertEqual(self.read(alice_people), self.read(bob_people))
+		self.assertEqual(self.read(alice_places), self.read(bob_places))
+
+	# A response which a table cannot apply, for whatever reason, does
+	# not keep those of the tables after it from being applied.
+	def test_batch_sync_applies_every_response(self):
+		self.seed(people(3))
+		alice_places = self.seed([['Place'], ['Paris'], ['Rome']], "places")
+		bob_people = self.client("bob")
+		bob_places = self.client("bob", tablename="places")
+		def failing_accept_sync(resp, count_push_changes):
+			raise ValueError("cannot apply")
+		bob_people.accept_sync = failing_accept_sync
+		try:
+			SharedTable.sync_batch([bob_people, bob_places])
+			self.fail("sync_batch() should have failed")
+		except SharedTableError as e:
+			self.assertTrue("people: cannot apply" in str(e))
+		self.assertEqual(self.read(bob_places), self.read(alice_places))
+
+	# Each response is sent as it is made, not once it is complete, and
+	# others may push in the meantime.
+	def test_batch_streams_responses(self):
+		alice = self.seed(people(3000))
+		self.seed([['Place'], ['Paris']], "places")
+		bob_people = self.client("bob")
+		bob_places = self.client("bob", tablename="places")
+		top = ET.Element('batch')
+		for client, name in ((bob_people, "people"), (bob_places, "places")):
+			self.read(client)
+			ET.SubElement(top, 'table', name=name).append(client.sync_request()[0])
+		if self.wire_format == "binary":
+			request, content_type, decode = stbbin.encode_batch(top), stbbin.content_type, stbbin.decode_batch
+		else:
+			request, content_type, decode = ET.tostring(top, encoding='utf-8'), None, ET.XML
+		servers = []
+		def table(name):
+			servers.append(SharedTableServer(self.db, name, "stbcsv"))
+			return servers[-1]
+		response = handle_batch(StringIO.StringIO(request), "bob", table, content_type)
+		pieces = [response.next() for i in range(3)]
+		self.assertEqual(len(servers), 1)
+
+		self.edit(alice, {(1, 1): 'Oslo'})
+		self.assertEqual(alice.push(), (1, 0))
+		pieces.extend(response)
+		self.assertEqual(len(servers), 2)
+		self.assertTrue(len(pieces) > 5)
+		parts = decode("".join(pieces)).findall('table')
+		self.assertEqual([(part.get('name'), part.get('error')) for part in parts], [("people", None), ("places", None)])
+		self.assertEqual(len(parts[0].find('response').find('rows')), 3001)
+		for server in servers:
+			server.conn.close()
+
+class BinaryBatchTests(BatchTests):
+	wire_format = "binary"
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,468 @@
+#! /usr/bin/python
+# pycoact/tests/benchmarks.py
+# Last modified: 17 October 2026
+#
+# Timings for those parts of pycoact which have more than one way of
+# doing the same job, run against throw-away databases.
+#
+# Usage: ./benchmarks.py [<benchmark> ...]
+#
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import StringIO
+import xml.etree.cElementTree as ET
+
+sys.path.insert(1, "../..")
+from pycoact.server.table import SharedTableServer, XMLResponseWriter, XMLRequestReader
+from pycoact.server.geojson import GeojsonServer
+from pycoact import stbbin
+
+tempdir = tempfile.mkdtemp(prefix="pycoact-bench-")
+
+def timed(func, *args):
+	start = time.time()
+	result = func(*args)
+	return time.time() - start, result
+
+# A shared table of the given number of CSV rows (plus the header row),
+# all at version 1.
+def make_table(name, row_count):
+	filename = os.path.join(tempdir, "%s.db" % name)
+	if os.path.exists(filename):
+		os.unlink(filename)
+	server = SharedTableServer(filename, "bench", "stbcsv")
+	server.create()
+	server.conn.executemany("insert into bench (id, version, tver, user, data) values (?, 1, 1, 'bench', ?)",
+		[(id, "Name,Age" if id == 0 else "Person %d,%d" % (id, id % 90)) for id in range(row_count + 1)])
+	server.conn.execute("update coact_tables set tver = 1 where tablename = 'bench'")
+	server.conn.commit()
+	return server
+
+#=============================================================================
+# Push of many modified rows: row-at-a-time updates vs. the bulk path
+#=============================================================================
+def bench_push(row_count=50000, new_count=1000):
+	print "Push of %d modified rows (one in ten conflicting) and %d new rows:" % (row_count, new_count)
+
+	top = ET.Element('request')
+	ET.SubElement(top, 'type').text = 'push'
+	rows = ET.SubElement(top, 'rows')
+	row = ET.SubElement(rows, 'row', id='0', version='1')
+	row.text = "Name,Age"
+	for id in range(1, row_count + 1):
+		row = ET.SubElement(rows, 'row', id=str(id), version=('3' if id % 10 == 0 else '2'))
+		row.text = "Person %d,%d" % (id, id % 90 + 1)
+	new_rows = ET.SubElement(top, 'new_rows')
+	for i in range(new_count):
+		ET.SubElement(new_rows, 'row').text = "Newcomer %d,0" % i
+	request = ET.tostring(top)
+
+	results = []
+	for label, threshold in (("row-at-a-time", sys.maxint), ("bulk", 0)):
+		server = make_table("push_%s" % threshold, row_count)
+		server.bulk_threshold = threshold
+		elapsed, response = timed(lambda: "".join(server.handle_request(StringIO.StringIO(request), "bench")))
+		print "  %-14s %8.3f seconds" % (label, elapsed)
+		results.append(response)
+
+	assert results[0] == results[1], "responses differ"
+	print "  (identical responses)"
+
+	# The same again, timing only the SQL work on the modified rows
+	# and leaving out the parsing and formatting of XML.
+	print "Update of %d rows only:" % row_count
+	rows = [(id, (3 if id % 10 == 0 else 2), "Person %d,%d" % (id, id % 90 + 1)) for id in range(1, row_count + 1)]
+	results = []
+	for label, method in (("row-at-a-time", "update_rows"), ("bulk", "update_rows_bulk")):
+		server = make_table("update_%s" % method, row_count)
+		cursor = server.conn.cursor()
+		cursor.execute("create temp table if not exists coact_push (id integer primary key, version integer, data text, accepted integer)")
+		cursor.execute("begin immediate transaction")
+		elapsed, mods = timed(getattr(server, method), rows, 2, "bench")
+		server.conn.commit()
+		print "  %-14s %8.3f seconds" % (label, elapsed)
+		results.append(sorted(mods))
+	assert results[0] == results[1], "accepted rows differ"
+
+#=============================================================================
+# GeoJSON save of many changed features: unchecked vs. version-checked
+#=============================================================================
+def bench_geojson_save(feature_count=10000, new_count=1000):
+	import json
+	print "GeoJSON save of %d changed features (one in ten conflicting) and %d new ones:" % (feature_count, new_count)
+
+	def feature(i):
+		return {"type":"Feature","geometry":{"type":"Point","coordinates":[i % 360 - 180, i % 180 - 90]},"properties":{"name":"Feature %d" % i}}
+
+	request = json.dumps({"type":"FeatureCollection","features":
+		[dict(feature(id + 1), id=id, version=(2 if id % 10 == 0 else 1)) for id in range(1, feature_count + 1)]
+		+ [feature(i) for i in range(new_count)]
+		})
+
+	# GeojsonServer.save() as it was before it checked versions, which
+	# did an update and a select for each feature.
+	def unchecked_save(server, data, username):
+		cursor = server.conn.cursor()
+		cursor.execute("begin immediate transaction")
+		tver = server.table_version() + 1
+		result = []
+		for feature in data['features']:
+			id = feature.pop('id', None)
+			feature.pop('version', None)
+			as_json = json.dumps(feature,separators=(',',':'))
+			if id is not None:
+				cursor.execute("update bench set version=version+1, tver=?, user=?, data=? where id=?", (tver, username, as_json, id))
+				cursor.execute("select version from bench where id = ?", (id,))
+				result.append((id, cursor.fetchone()[0]))
+			else:
+				cursor.execute("insert into bench (version, tver, user, data) values (1,?,?,?)", (tver, username, as_json))
+				result.append((cursor.lastrowid, 1))
+		server.conn.commit()
+		return result
+
+	for label, save in (("unchecked", unchecked_save), ("checked", GeojsonServer.save)):
+		filename = os.path.join(tempdir, "geojson_%s.db" % label)
+		if os.path.exists(filename):
+			os.unlink(filename)
+		server = GeojsonServer(filename, "bench")
+		server.create()
+		server.conn.executemany("insert into bench (id, version, tver, user, data) values (?, 1, 1, 'bench', ?)",
+			[(id, json.dumps(feature(id), separators=(',',':'))) for id in range(1, feature_count + 1)])
+		server.conn.execute("update coact_tables set tver = 1 where tablename = 'bench'")
+		server.conn.commit()
+		elapsed, response = timed(save, server, json.loads(request), "bench")
+		print "  %-14s %8.3f seconds" % (label, elapsed)
+
+#=============================================================================
+# GeoJSON load: parsing each feature vs. sending its stored JSON
+#=============================================================================
+def bench_geojson_load(feature_count=100000):
+	import json
+	print "GeoJSON load of %d features:" % feature_count
+
+	def feature(i):
+		return {"type":"Feature","geometry":{"type":"Point","coordinates":[i % 360 - 180, i % 180 - 90]},"properties":{"name":"Feature %d" % i}}
+
+	responses = []
+	for label, stored in (("parsed", False), ("stored JSON", True)):
+		filename = os.path.join(tempdir, "geojson_load_%s.db" % stored)
+		server = GeojsonServer(filename, "bench")
+		server.create()
+		rows = []
+		for id in range(1, feature_count + 1):
+			data = json.dumps(feature(id), separators=(',',':'))
+			rows.append((id, data, GeojsonServer.feature_json(data, id, 1) if stored else None))
+		server.conn.executemany("insert into bench (id, version, tver, user, data, feature) values (?, 1, 1, 'bench', ?, ?)", rows)
+		server.index_features(server.conn.cursor(), [(id, GeojsonServer.geometry_bbox(feature(id)['geometry'])) for id in range(1, feature_count + 1)])
+		server.conn.execute("update coact_tables set tver = 1 where tablename = 'bench'")
+		server.conn.commit()
+		elapsed, response = timed(lambda: "".join(server.load_response("pulled_version=0")))
+		print "  %-14s %8.3f seconds, %9d bytes" % (label, elapsed, len(response))
+		responses.append(response)
+
+	assert responses[0] == responses[1], "responses differ"
+	print "  (identical responses)"
+
+	# The last table again, but only the features in one corner of the map
+	elapsed, response = timed(lambda: "".join(server.load_response("pulled_version=0&bbox=-180,-90,-144,-72")))
+	print "  %-14s %8.3f seconds, %9d bytes, %d features" % ("bounding box", elapsed, len(response), len(json.loads(response)['features']))
+
+#=============================================================================
+# XML vs. the binary format of stbbin.py
+#=============================================================================
+def bench_wire(row_count=100000):
+	import zlib
+	rows = [(id, id % 7 + 1, u"Person %d,%d,%d Main Street,Apt. %d" % (id, id % 90, id, id % 12)) for id in range(row_count)]
+	print "Pull response and push request of %d rows:" % row_count
+
+	def server_encode(writer):
+		return "".join([writer.start(), writer.field('version', 123), writer.start_rows('rows')]
+			+ [writer.row(text, id=id, version=version) for id, version, text in rows]
+			+ [writer.end_rows('rows'), writer.end()])
+
+	def client_request():
+		top = ET.Element('request')
+		ET.SubElement(top, 'type').text = 'push'
+		container = ET.SubElement(top, 'rows')
+		for id, version, text in rows:
+			ET.SubElement(container, 'row', id=str(id), version=str(version)).text = text
+		ET.SubElement(top, 'new_rows')
+		return top
+
+	def server_decode(reader_class, data):
+		return sum(1 for row in reader_class(StringIO.StringIO(data)).rows())
+
+	request = client_request()
+	decoded = []
+	for label, writer, encode, decode, reader_class in (
+			("XML", XMLResponseWriter(), lambda top: ET.tostring(top, encoding='utf-8'), ET.XML, XMLRequestReader),
+			("binary", stbbin.BinaryResponseWriter(), stbbin.encode_tree, stbbin.decode, stbbin.BinaryRequestReader),
+			):
+		print "  %s:" % label
+		elapsed, response = timed(server_encode, writer)
+		print "    server encodes pull response %8.3f seconds, %9d bytes (%d gzipped)" % (elapsed, len(response), len(zlib.compress(response)))
+		elapsed, tree = timed(decode, response)
+		print "    client decodes pull response %8.3f seconds" % elapsed
+		decoded.append([(row.get('id'), row.get('version'), row.text) for row in tree.find('rows')])
+		elapsed, data = timed(encode, request)
+		print "    client encodes push request  %8.3f seconds, %9d bytes (%d gzipped)" % (elapsed, len(data), len(zlib.compress(data)))
+		elapsed, count = timed(server_decode, reader_class, data)
+		assert count == row_count
+		print "    server decodes push request  %8.3f seconds" % elapsed
+	assert decoded[0] == decoded[1], "rows differ"
+	print "  (identical rows)"
+
+#=============================================================================
+# Whole rows vs. deltas (see csvdelta.py) for one changed cell in wide rows
+#=============================================================================
+def bench_delta(row_count=10000, column_count=60):
+	import zlib
+	from pycoact import csvdelta
+	print "Push and pull of %d rows of %d columns with one cell changed in each:" % (row_count, column_count)
+
+	def line(id, changed):
+		return ",".join(["Cell %d.%d" % (id, i) if i != id % column_count or not changed else "Changed %d" % id for i in range(column_count)])
+
+	def make_wide_table(name):
+		filename = os.path.join(tempdir, "%s.db" % name)
+		if os.path.exists(filename):
+			os.unlink(filename)
+		server = SharedTableServer(filename, "bench", "stbcsv")
+		server.create()
+		server.conn.executemany("insert into bench (id, version, tver, user, data) values (?, 1, 1, 'bench', ?)",
+			[(id, line(id, False)) for id in range(row_count + 1)])
+		server.conn.execute("update coact_tables set tver = 1 where tablename = 'bench'")
+		server.conn.commit()
+		return server
+
+	def push_request(deltas):
+		top = ET.Element('request')
+		ET.SubElement(top, 'type').text = 'push'
+		rows = ET.SubElement(top, 'rows')
+		ET.SubElement(rows, 'row', id='0', version='1').text = line(0, False)
+		if deltas:
+			rows = ET.SubElement(top, 'delta_rows')
+		for id in range(1, row_count + 1):
+			text = line(id, True)
+			if deltas:
+				text = csvdelta.make_delta(line(id, False), text)
+			ET.SubElement(rows, 'row', id=str(id), version='2').text = text
+		ET.SubElement(top, 'new_rows')
+		return ET.tostring(top)
+
+	pull_request = "<request><type>pull</type><pulled_version>1</pulled_version>%s</request>"
+	results = []
+	for label, deltas in (("whole rows", False), ("deltas", True)):
+		server = make_wide_table("delta_%s" % deltas)
+		request = push_request(deltas)
+		elapsed, response = timed(lambda: "".join(server.handle_request(StringIO.StringIO(request), "bench")))
+		print "  %-10s push %8.3f seconds, %9d bytes (%d gzipped)" % (label, elapsed, len(request), len(zlib.compress(request)))
+		request = pull_request % ("<deltas>1</deltas>" if deltas else "")
+		elapsed, response = timed(lambda: "".join(server.handle_request(StringIO.StringIO(request), "bench")))
+		print "  %-10s pull %8.3f seconds, %9d bytes (%d gzipped)" % (label, elapsed, len(response), len(zlib.compress(response)))
+		results.append(list(server.conn.execute("select id, version, data from bench order by id")))
+
+	assert results[0] == results[1], "tables differ"
+	print "  (identical tables)"
+
+#=============================================================================
+# Adding a column as a schema operation (see csvschema.py)
+#=============================================================================
+def bench_schema(row_count=100000):
+	from pycoact import csvschema
+	print "Adding a column to %d rows:" % row_count
+
+	server = make_table("schema", row_count)
+	elapsed, tver = timed(server.alter, [("add", 1, "Phone")])
+	print "  server rewrites rows      %8.3f seconds" % elapsed
+
+	# What a client which has pulled everything before the change
+	# then has to pull
+	request = "<request><type>pull</type><pulled_version>1</pulled_version><schema_version>0</schema_version></request>"
+	elapsed, response = timed(lambda: "".join(server.handle_request(StringIO.StringIO(request), "bench")))
+	print "  client pulls              %8.3f seconds, %9d bytes" % (elapsed, len(response))
+	operations = [(int(op.get('tver')), op.get('op'), int(op.get('position')), op.get('name')) for op in ET.XML(response).findall('schema_op')]
+	lines = [line for id, line in server.conn.execute("select id, data from bench where id != 0 order by id")]
+	old_lines = ["Person %d,%d" % (id, id % 90) for id in range(1, row_count + 1)]
+	elapsed, new_lines = timed(lambda: [csvschema.apply_ops(line, operations) for line in old_lines])
+	print "  client applies operation  %8.3f seconds" % elapsed
+	assert new_lines == lines, "rows differ"
+	print "  (identical rows)"
+
+# An XML local store of the given number of CSV rows (plus the header
+# row), as if pulled at version 1. Returns its filename.
+def make_local_store(name, row_count):
+	top = ET.Element('shared_table')
+	repository = ET.SubElement(top, 'repository')
+	for tag, text in (('url', 'http://localhost/bench'), ('realm', 'bench'), ('username', 'bench'), ('password', 'bench'), ('pulled_version', '1')):
+		ET.SubElement(repository, tag).text = text
+	rows = ET.SubElement(top, 'rows')
+	ET.SubElement(rows, 'row', id='0', version='1').text = 'Name,Age,"Town, county"'
+	for id in range(1, row_count + 1):
+		ET.SubElement(rows, 'row', id=str(id), version='1').text = '"Person %d",%d,"Town %d, County"' % (id, id % 90, id % 50)
+	filename = os.path.join(tempdir, "%s.xml" % name)
+	ET.ElementTree(top).write(filename)
+	return filename
+
+#=============================================================================
+# Reading an stbcsv table in the client: parsing every row vs. the cache
+# of parsed rows and one column at a time (see SharedTableCSV)
+#=============================================================================
+def bench_csv_reader(row_count=100000):
+	from pycoact.client.table_csv import SharedTableCSV
+	print "Reading %d rows of a local store:" % row_count
+
+	filename = make_local_store("csv_reader", row_count)
+
+	table = SharedTableCSV(filename)
+	elapsed, first = timed(lambda: list(table.csv_reader()))
+	print "  first csv_reader()        %8.3f seconds" % elapsed
+	elapsed, second = timed(lambda: list(table.csv_reader()))
+	print "  csv_reader() again        %8.3f seconds" % elapsed
+	assert first == second, "rows differ"
+
+	table = SharedTableCSV(filename)
+	elapsed, ages = timed(table.column, "Age", "i")
+	print "  column() on a fresh table %8.3f seconds" % elapsed
+	assert list(ages) == [int(cells[1]) for cells in first[1:]], "columns differ"
+	print "  (identical rows and columns)"
+
+#=============================================================================
+# Pull of one territory's rows: the whole table vs. a filtered pull, which
+# finds the rows through the side table of the filter columns
+#=============================================================================
+def bench_filter(row_count=100000, territory_count=100):
+	print "Pull of one of %d territories from %d rows:" % (territory_count, row_count)
+
+	server = make_table("filter", row_count)
+	server.conn.execute("update bench set data = 'Name,Territory' where id = 0")
+	server.conn.execute("update bench set data = 'Person ' || id || ',' || (id %% %d) where id != 0" % territory_count)
+	server.conn.commit()
+	elapsed, added = timed(server.add_filter_column, "Territory")
+	print "  declare filter column     %8.3f seconds" % elapsed
+
+	pull = "<request><type>pull</type><pulled_version>%d</pulled_version>%s</request>"
+	territory = '<filter column="Territory" value="7" />'
+	responses = {}
+	for label, request in (("whole table", pull % (0, "")), ("filtered", pull % (0, territory)),
+			("filtered, paged", pull % (0, territory + "<page_size>100</page_size>"))):
+		elapsed, response = timed(lambda: "".join(server.handle_request(StringIO.StringIO(request), "bench")))
+		print "  %-24s  %8.3f seconds, %9d bytes" % (label, elapsed, len(response))
+		responses[label] = response
+	assert len(ET.XML(responses["filtered"]).find('rows')) == row_count / territory_count + 1, "wrong rows"
+
+	# A push which moves some rows from one territory to another, and
+	# the pull of the client which then needs to hear of it
+	top = ET.Element('request')
+	ET.SubElement(top, 'type').text = 'push'
+	rows = ET.SubElement(top, 'rows')
+	ET.SubElement(rows, 'row', id='0', version='1').text = "Name,Territory"
+	for id in range(7, row_count, territory_count * 10):
+		ET.SubElement(rows, 'row', id=str(id), version='2').text = "Person %d,8" % id
+	request = ET.tostring(top)
+	elapsed, response = timed(lambda: "".join(server.handle_request(StringIO.StringIO(request), "bench")))
+	print "  push of %4d moved rows      %8.3f seconds" % (len(rows) - 1, elapsed)
+	request = pull % (1, territory)
+	elapsed, response = timed(lambda: "".join(server.handle_request(StringIO.StringIO(request), "bench")))
+	print "  filtered pull after it    %8.3f seconds, %9d bytes" % (elapsed, len(response))
+	assert len([row for row in ET.XML(response).find('rows') if row.get('filtered') is not None]) == len(rows) - 1, "wrong rows"
+
+#=============================================================================
+# Finding rows by the value of a column in the client: scanning what
+# csv_reader() returns vs. an index (see SharedTableCSV.add_index())
+#=============================================================================
+def bench_lookup(row_count=100000, lookup_count=200):
+	from pycoact.client.table_csv import SharedTableCSV
+	print "%d lookups in %d rows of a local store:" % (lookup_count, row_count)
+
+	table = SharedTableCSV(make_local_store("lookup", row_count))
+	towns = ["Town %d, County" % (i % 50) for i in range(lookup_count)]
+	rows = list(table.csv_reader())
+	def scan():
+		return [[i for i, cells in enumerate(rows) if i > 0 and cells[2] == town] for town in towns]
+	elapsed, scanned = timed(scan)
+	print "  scans                     %8.3f seconds" % elapsed
+
+	table.add_index("Town, county")
+	elapsed, index = timed(table.column_index, "Town, county")
+	print "  build hash index          %8.3f seconds" % elapsed
+	elapsed, found = timed(lambda: [table.lookup("Town, county", town) for town in towns])
+	print "  hash lookups              %8.3f seconds" % elapsed
+	assert found == scanned, "rows differ"
+
+	table.add_index("Age", sorted=True, convert=int)
+	elapsed, index = timed(table.column_index, "Age")
+	print "  build sorted index        %8.3f seconds" % elapsed
+	elapsed, found = timed(lambda: [table.lookup_range("Age", i % 80, i % 80 + 10) for i in range(lookup_count)])
+	print "  range lookups             %8.3f seconds" % elapsed
+	assert sorted(found[0]) == [i for i, cells in enumerate(rows) if i > 0 and 0 <= int(cells[1]) < 10], "rows differ"
+	print "  (identical rows)"
+
+#=============================================================================
+# Syncs of many tables: one request (and connection) per table vs. one
+# batch (see server/batch.py)
+#=============================================================================
+def bench_batch(table_count=20, row_count=1000, round_count=10):
+	from pycoact.server.batch import handle_batch
+	import sqlite3
+	print "%d rounds of syncs of %d tables of %d rows, each pushing a new row:" % (round_count, table_count, row_count)
+
+	filename = os.path.join(tempdir, "batch.db")
+	if os.path.exists(filename):
+		os.unlink(filename)
+	names = ["bench%d" % i for i in range(table_count)]
+	for name in names:
+		server = SharedTableServer(filename, name, "stbcsv")
+		server.create()
+		server.conn.executemany("insert into %s (id, version, tver, user, data) values (?, 1, 1, 'bench', ?)" % name,
+			[(id, "Name,Age" if id == 0 else "Person %d,%d" % (id, id % 90)) for id in range(row_count + 1)])
+		server.conn.commit()
+
+	sync = "<request><type>sync</type><pulled_version>%d</pulled_version><rows><row id=\"0\" version=\"1\">Name,Age</row></rows>" \
+		"<new_rows><row>New person,%d</row></new_rows></request>"
+
+	# Each table synced as coact.cgi would, with a connection of its own
+	def separate(round):
+		for name in names:
+			server = SharedTableServer(filename, name, "stbcsv")
+			"".join(server.handle_request(StringIO.StringIO(sync % (round, round)), "bench"))
+			server.conn.commit()
+			server.conn.close()
+
+	def batched(round):
+		conn = sqlite3.connect(filename)
+		request = "<batch>%s</batch>" % "".join(['<table name="%s">%s</table>' % (name, sync % (round, round)) for name in names])
+		response = "".join(handle_batch(StringIO.StringIO(request), "bench", lambda name: SharedTableServer(filename, name, "stbcsv", conn=conn)))
+		conn.close()
+		return response
+
+	elapsed, result = timed(lambda: [separate(round) for round in range(round_count)])
+	print "  one request per table     %8.3f seconds" % elapsed
+	elapsed, responses = timed(lambda: [batched(round) for round in range(round_count)])
+	print "  one batch                 %8.3f seconds" % elapsed
+	parts = ET.XML(responses[-1]).findall('table')
+	assert len(parts) == table_count and all([part.get('error') is None for part in parts]), "batch failed"
+
+benchmarks = {
+	"batch": bench_batch,
+	"lookup": bench_lookup,
+	"filter": bench_filter,
+	"csv_reader": bench_csv_reader,
+	"delta": bench_delta,
+	"schema": bench_schema,
+	"push": bench_push,
+	"geojson_load": bench_geojson_load,
+	"geojson_save": bench_geojson_save,
+	"wire": bench_wire,
+	}
+
+if __name__ == "__main__":
+	try:
+		for name in (sys.argv[1:] or sorted(benchmarks.keys())):
+			benchmarks[name]()
+	finally:
+		shutil.rmtree(tempdir)
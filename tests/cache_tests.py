@@ -0,0 +1,107 @@
+#! /usr/bin/python
+# coding=utf-8
+# pycoact/tests/cache_tests.py
+# Last modified: 17 October 2026
+#
+# Tests of the cache of pull responses kept by the WSGI server (see
+# server/cache.py): repeated pulls are answered from it, and changes to
+# a table, whether pushed or saved as GeoJSON, drop its responses.
+#
+# Usage: cache_tests.py [-v] [<test name>...]
+#
+
+import sys
+import json
+import unittest
+import StringIO
+from wsgiref.util import setup_testing_defaults
+
+sys.path.insert(1, "../..")
+from pycoact.server.geojson import GeojsonServer
+from harness import ServerTests, people
+
+class CacheTests(ServerTests):
+	# The hits and misses of the cache since the last call
+	def counts(self):
+		stats = self.application.cache.stats()
+		counts = (stats['hits'] - self.hits, stats['misses'] - self.misses)
+		self.hits, self.misses = stats['hits'], stats['misses']
+		return counts
+
+	def setUp(self):
+		ServerTests.setUp(self)
+		self.hits = self.misses = 0
+
+	def test_repeated_pull(self):
+		alice = self.seed(people(5))
+		self.counts()
+
+		# The first cold pull fills the cache, the next is answered from it.
+		bob = self.client("bob")
+		self.assertEqual(bob.pull(), (6, 0))
+		self.assertEqual(self.counts(), (0, 1))
+		carol = self.client("carol")
+		self.assertEqual(carol.pull(), (6, 0))
+		self.assertEqual(self.counts(), (1, 0))
+		self.assertEqual(self.read(carol), self.read(bob))
+		self.assertEqual(self.application.cache.stats()['entries'], 1)
+
+		# So it is with pulls which are up to date.
+		self.assertEqual(bob.pull(), (0, 0))
+		self.assertEqual(carol.pull(), (0, 0))
+		self.assertEqual(self.counts(), (1, 1))
+
+		# A push drops the table's responses, so that the next pulls
+		# get its changes.
+		self.edit(alice, {(1, 1): 'Oslo'})
+		alice.push()
+		self.assertEqual(self.application.cache.stats()['entries'], 0)
+		self.assertEqual(bob.pull(), (1, 0))
+		self.assertEqual(self.counts(), (0, 1))
+		self.assertEqual(carol.pull(), (1, 0))
+		self.assertEqual(self.counts(), (1, 0))
+		self.assertEqual(self.read(carol), self.read(alice))
+
+	#------------------------------------------------------------------
+	# GeoJSON tables
+	#------------------------------------------------------------------
+
+	# Send a request to the application as the WSGI server would and
+	# return the body of the response.
+	def call(self, method, tablename, query_string="", body=""):
+		environ = {'REQUEST_METHOD':method, 'PATH_INFO':"/db/%s.geojson" % tablename,
+			'QUERY_STRING':query_string, 'CONTENT_LENGTH':str(len(body)),
+			'REMOTE_USER':"alice", 'wsgi.input':StringIO.StringIO(body)}
+		setup_testing_defaults(environ)
+		status = []
+		response = self.application(environ, lambda s, headers, exc_info=None: status.append(s))
+		body = "".join(response)
+		self.assertEqual(status, ["200 OK"])
+		return json.loads(body)
+
+	def save(self, tablename, features):
+		return self.call("POST", tablename, body=json.dumps({"type":"FeatureCollection","features":features}))
+
+	def names(self, collection):
+		return dict([(f['id'], f['properties']['name']) for f in collection['features']])
+
+	def test_geojson_save(self):
+		server = GeojsonServer(self.db, "sites")
+		server.create()
+		server.conn.close()
+		point = lambda name: {"type":"Feature","geometry":{"type":"Point","coordinates":[1, 1]},"properties":{"name":name}}
+		self.save("sites", [point("a"), point("b")])
+		self.counts()
+
+		self.assertEqual(self.names(self.call("GET", "sites", "pulled_version=0")), {1: "a", 2: "b"})
+		self.assertEqual(self.names(self.call("GET", "sites", "pulled_version=0")), {1: "a", 2: "b"})
+		self.assertEqual(self.counts(), (1, 1))
+
+		# A save drops the table's responses.
+		self.assertEqual(self.save("sites", [dict(point("a2"), id=1, version=1)]), [[1, 2, "ok"]])
+		self.assertEqual(self.application.cache.stats()['entries'], 0)
+		self.assertEqual(self.names(self.call("GET", "sites", "pulled_version=0")), {1: "a2", 2: "b"})
+		self.assertEqual(self.counts(), (0, 1))
+
+if __name__ == "__main__":
+	unittest.main()
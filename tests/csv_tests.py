@@ -0,0 +1,100 @@
+#! /usr/bin/python
+# coding=utf-8
+# pycoact/tests/csv_tests.py
+# Last modified: 17 October 2026
+#
+# Tests of SharedTableCSV: the cells of one column, taken from the cache
+# of parsed rows where it is up to date, and the indexes of columns. Both
+# are kept in step with what csv_reader() returns as rows are pulled,
+# written, and deleted.
+#
+# Usage: csv_tests.py [-v] [<test name>...]
+#
+
+import sys
+import array
+import unittest
+
+sys.path.insert(1, "../..")
+from pycoact.client.table import SharedTableError
+from harness import ServerTests, people
+
+class CSVTests(ServerTests):
+	# The cells of a column as csv_reader() returns them
+	def scan(self, client, column):
+		return [cells[column] for cells in self.read(client)[1:]]
+
+	# The positions of the rows for which test(cells) is true, as
+	# lookup() returns them
+	def find(self, client, test):
+		return [i for i, cells in enumerate(self.read(client)) if i > 0 and test(cells)]
+
+	def test_column(self):
+		alice = self.seed(people(6))
+		bob = self.client("bob")
+		bob.pull()
+		self.assertEqual(bob.column('City'), self.scan(bob, 1))
+		self.assertEqual(bob.column(2, 'i'), array.array('i', range(21, 27)))
+
+		# Rows which have been parsed are parsed again once a pull has
+		# changed them.
+		self.read(bob)
+		self.edit(alice, {(2, 1): 'Oslo'})
+		alice.push()
+		bob.pull()
+		self.assertEqual(bob.column('City')[1], 'Oslo')
+		self.assertEqual(bob.column('City'), self.scan(bob, 1))
+
+		# So are those which are edited, and new rows are taken as they
+		# are written, while deleted ones are left out.
+		rows = self.read(bob)
+		rows[3][1] = 'Lima'
+		rows[4][2] = ''
+		self.write(bob, rows + [['Newcomer', 'Rome', '1']])
+		self.read(bob)
+		bob.delete_row(1)
+		self.assertEqual(bob.column('City'), ['Oslo', 'Lima', 'London', 'Rome', 'Paris', 'Rome'])
+		self.assertEqual(bob.column('City'), self.scan(bob, 1))
+
+		# Empty cells of a column of numbers are an error unless there
+		# is a value for them.
+		self.assertRaises(ValueError, bob.column, 'Age', 'i')
+		self.assertEqual(bob.column('Age', 'i', -1), array.array('i', [22, 23, -1, 25, 26, 1]))
+
+	def test_lookup(self):
+		alice = self.seed(people(9))
+		bob = self.client("bob")
+		bob.pull()
+		bob.add_index('City')
+		bob.add_index('Age', sorted=True, convert=int)
+		self.assertEqual(bob.lookup('City', 'Rome'), self.find(bob, lambda cells: cells[1] == 'Rome'))
+		self.assertEqual(bob.lookup('City', 'Rome', ids=True), [2, 5, 8])
+		self.assertEqual(bob.lookup_range('Age', 23, 26), [3, 4, 5])
+		self.assertEqual(bob.lookup_range('Age', high=22, ids=True), [1])
+		self.assertRaises(SharedTableError, bob.lookup_range, 'City', 'A', 'Z')
+
+		# The indexes follow pulls, edits, new rows, and deletions. A
+		# range takes rows in order of value, new ones among the rest.
+		self.edit(alice, {(3, 1): 'Rome'})
+		alice.push()
+		bob.pull()
+		rows = self.read(bob)
+		rows[1][2] = '27'
+		self.write(bob, rows + [['Newcomer', 'Rome', '24']])
+		self.read(bob)
+		bob.delete_row(2)
+		rome = self.find(bob, lambda cells: cells[1] == 'Rome')
+		self.assertEqual([self.read(bob)[i][0] for i in rome], ['Person 3', 'Person 5', 'Person 8', 'Newcomer'])
+		self.assertEqual(bob.lookup('City', 'Rome'), rome)
+		self.assertEqual([self.read(bob)[i][0] for i in bob.lookup_range('Age', 24, 28)],
+			['Person 4', 'Newcomer', 'Person 5', 'Person 6', 'Person 1', 'Person 7'])
+
+		# The index of a renamed column goes with it.
+		alice.csv_rows = None
+		alice.rename_column('City', 'Town')
+		bob.push()
+		self.assertEqual(bob.lookup('Town', 'Rome'), self.find(bob, lambda cells: cells[1] == 'Rome'))
+		self.assertRaises(SharedTableError, bob.lookup, 'City', 'Rome')
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,68 @@
+#! /usr/bin/python
+# coding=utf-8
+# pycoact/tests/delta_tests.py
+# Last modified: 17 October 2026
+#
+# Tests of deltas, which carry only the changed cells of wide rows, and
+# of the fallback to whole rows when a delta cannot be applied.
+#
+# Usage: delta_tests.py [-v] [<test name>...]
+#
+
+import sys
+import unittest
+
+sys.path.insert(1, "../..")
+from harness import ServerTests
+
+class DeltaTests(ServerTests):
+	def test_delta_expansion(self):
+		wide = [['Column %d' % i for i in range(40)]] + [['Cell %d.%d' % (row, i) for i in range(40)] for row in range(1, 4)]
+		alice = self.seed(wide)
+		bob = self.client("bob")
+		for client in (alice, bob):
+			client.delta_encoding = True
+		bob.pull()
+
+		self.edit(alice, {(1, 7): 'Changed'})
+		alice_exchanges = self.spy(alice)
+		self.assertEqual(alice.push(), (1, 0))
+		self.assertNotEqual(alice_exchanges[0][0].find('delta_rows'), None)
+		self.assertEqual(self.server_rows()[1], ",".join(self.read(alice)[1]))
+
+		exchanges = self.spy(bob)
+		self.assertEqual(bob.pull(), (1, 0))
+		self.assertEqual(len(exchanges), 1)
+		self.assertEqual([(id, attrib.get('delta')) for id, attrib in exchanges[0][1] if id != 0], [(1, '1')])
+		self.assertEqual(self.read(bob), self.read(alice))
+
+	def test_delta_fallback(self):
+		wide = [['Column %d' % i for i in range(40)]] + [['Cell %d.%d' % (row, i) for i in range(40)] for row in range(1, 4)]
+		alice = self.seed(wide)
+		bob = self.client("bob")
+		bob.delta_encoding = True
+		bob.pull()
+		self.edit(alice, {(2, 30): 'Changed'})
+		alice.push()
+
+		# Bob's copy of the row is not the version which the delta
+		# was made against, so he asks again for whole rows.
+		bob.load_indexes()
+		bob.rows_by_id[2].set('version', '0')
+		exchanges = self.spy(bob)
+		bob.pull()
+		self.assertEqual(len(exchanges), 2)
+		self.assertNotEqual(exchanges[0][0].find('deltas'), None)
+		self.assertEqual(exchanges[1][0].find('deltas'), None)
+		self.assertEqual([attrib.get('delta') for id, attrib in exchanges[1][1]], [None] * len(exchanges[1][1]))
+		self.assertEqual(self.read(bob), self.read(alice))
+		self.assertEqual(bob.rows_by_id[2].get('version'), '2')
+
+class BinaryDeltaTests(DeltaTests):
+	wire_format = "binary"
+
+class SqliteDeltaTests(DeltaTests):
+	store_format = "sqlite"
+
+if __name__ == "__main__":
+	unittest.main()
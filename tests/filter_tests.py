@@ -0,0 +1,55 @@
+#! /usr/bin/python
+# coding=utf-8
+# pycoact/tests/filter_tests.py
+# Last modified: 17 October 2026
+#
+# Tests of filtered pulls, which send only the rows matching a client's
+# filter on declared columns, and tell it of rows which leave it.
+#
+# Usage: filter_tests.py [-v] [<test name>...]
+#
+
+import sys
+import unittest
+
+sys.path.insert(1, "../..")
+from pycoact.server.table import SharedTableServer
+from harness import ServerTests, people
+
+class FilterTests(ServerTests):
+	def test_filtered_pull(self):
+		alice = self.seed(people(9))
+		server = SharedTableServer(self.db, "people", "stbcsv")
+		server.add_filter_column('City')
+		server.conn.close()
+
+		bob = self.client("bob")
+		bob.set_filter([('City', '=', 'Paris')])
+		bob.pull()
+		self.assertEqual([row[0] for row in self.read(bob)], ['Name', 'Person 3', 'Person 6', 'Person 9'])
+
+		# Rows which move out of the filter are dropped, and those which
+		# move into it arrive.
+		self.edit(alice, {(3, 1): 'London', (4, 1): 'Paris'})
+		alice.push()
+		exchanges = self.spy(bob)
+		self.assertEqual(bob.pull(), (2, 0))
+		self.assertTrue((3, {'id': '3', 'version': '2', 'filtered': '1'}) in exchanges[0][1])
+		self.assertEqual([row[0] for row in self.read(bob)], ['Name', 'Person 4', 'Person 6', 'Person 9'])
+
+		# So do rows which leave it through a sync.
+		self.edit(alice, {(6, 1): 'Rome'})
+		alice.push()
+		self.edit(bob, {(3, 2): '1'})
+		bob.sync()
+		self.assertEqual([row[0] for row in self.read(bob)], ['Name', 'Person 4', 'Person 9'])
+		self.assertEqual(self.server_rows()[9], 'Person 9,Paris,1')
+
+class BinaryFilterTests(FilterTests):
+	wire_format = "binary"
+
+class SqliteFilterTests(FilterTests):
+	store_format = "sqlite"
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,113 @@
+#! /usr/bin/python
+# coding=utf-8
+# pycoact/tests/geojson_tests.py
+# Last modified: 17 October 2026
+#
+# Tests of GeojsonServer, made by calling handle_request() as the CGI
+# and WSGI frontends do. Each test gets a fresh database in a temporary
+# directory.
+#
+# Usage: geojson_tests.py [-v] [<test name>...]
+#
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+sys.path.insert(1, "../..")
+from pycoact.server.geojson import GeojsonServer
+
+def point(name, x, y):
+	return {"type":"Feature","geometry":{"type":"Point","coordinates":[x, y]},"properties":{"name":name}}
+
+class GeojsonTests(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp(prefix="coact-tests-")
+		self.db = os.path.join(self.directory, "db.db")
+		self.server = GeojsonServer(self.db, "places")
+		self.server.create()
+
+	def tearDown(self):
+		self.server.conn.close()
+		shutil.rmtree(self.directory, True)
+
+	def save(self, features, username="alice"):
+		body = json.dumps({"type":"FeatureCollection","features":features})
+		return json.loads(self.server.handle_request(StringIO.StringIO(body), username, {"REQUEST_METHOD":"POST"}))
+
+	def load(self, query_string, username="alice"):
+		response = self.server.handle_request(None, username, {"REQUEST_METHOD":"GET", "QUERY_STRING":query_string})
+		return json.loads("".join(response))
+
+	# The features of a load as {id: (version, name)}
+	def features(self, collection):
+		return dict([(f['id'], (f['version'], (f['properties'] or {}).get('name'))) for f in collection['features']])
+
+	#------------------------------------------------------------------
+	# Saves
+	#------------------------------------------------------------------
+
+	def test_save_checks_versions(self):
+		self.assertEqual(self.save([point("a", 1, 1), point("b", 2, 2)]), [[1, 1, "new"], [2, 1, "new"]])
+		self.assertEqual(self.save([dict(point("a2", 1, 1), id=1, version=1)]), [[1, 2, "ok"]])
+		self.assertEqual(self.save([dict(point("a3", 1, 1), id=1, version=1)], "bob"), [[1, 2, "conflict"]])
+		self.assertEqual(self.save([dict(point("b", 2, 2), id=2, version=1, deleted=True)]), [[2, 2, "ok"]])
+		self.assertEqual(self.save([dict(point("b2", 2, 2), id=2, version=2)]), [[2, 2, "conflict"]])
+		self.assertEqual(self.features(self.load("pulled_version=0")), {1: (2, "a2"), 2: (2, None)})
+
+	# Clients from before versions were checked send none. Their changes
+	# are applied as they always were.
+	def test_save_without_versions(self):
+		self.save([point("a", 1, 1), point("b", 2, 2)])
+		self.save([dict(point("a2", 1, 1), id=1, version=1)])
+		self.assertEqual(self.save([dict(point("a3", 1, 1), id=1), dict(point("b2", 2, 2), id=2)]), [[1, 3, "ok"], [2, 2, "ok"]])
+		self.assertEqual(self.save([dict(point("c", 3, 3), id=3)]), [[3, None, "conflict"]])
+		self.assertEqual(self.features(self.load("pulled_version=0")), {1: (3, "a3"), 2: (2, "b2")})
+
+	#------------------------------------------------------------------
+	# Loads limited to a bounding box
+	#------------------------------------------------------------------
+
+	def test_bbox_load(self):
+		self.save([point("in", 1, 1), point("out", 10, 10), point("leaving", 1, 2), point("arriving", 10, 12), point("gone", 2, 2)])
+		collection = self.load("pulled_version=0&bbox=0,0,5,5")
+		self.assertEqual(self.features(collection), {1: (1, "in"), 3: (1, "leaving"), 5: (1, "gone")})
+		pulled_version = collection['repository']['pulled_version']
+
+		# A feature which moves out of the box is sent so that the client
+		# knows to drop it. One which has not changed is not sent at all.
+		self.save([dict(point("leaving", 8, 8), id=3, version=1), dict(point("arriving", 3, 3), id=4, version=1),
+			dict(point("out", 10, 11), id=2, version=1), dict(point("gone", 2, 2), id=5, version=1, deleted=True)])
+		collection = self.load("pulled_version=%d&bbox=0,0,5,5" % pulled_version)
+		features = dict([(f['id'], f) for f in collection['features']])
+		self.assertEqual(sorted(features.keys()), [2, 3, 4, 5])
+		self.assertEqual((features[3]['version'], features[3].get('filtered'), features[3]['geometry']), (2, True, None))
+		self.assertEqual((features[2]['version'], features[2].get('filtered')), (2, True))
+		self.assertEqual((features[4]['properties']['name'], features[4].get('filtered')), ("arriving", None))
+		self.assertEqual((features[5].get('deleted'), features[5].get('filtered')), (True, None))
+
+		# So it is if the table has yet to be indexed.
+		self.server.conn.execute("drop table places_rtree")
+		self.server.spatial_index = None
+		unindexed = self.load("pulled_version=%d&bbox=0,0,5,5" % pulled_version)
+		self.assertEqual(dict([(f['id'], f) for f in unindexed['features']]), features)
+
+	#------------------------------------------------------------------
+	# Errors
+	#------------------------------------------------------------------
+
+	# A load which fails is answered with an error rather than with a
+	# response which stops part way.
+	def test_load_error(self):
+		self.save([point("a", 1, 1)])
+		self.server.conn.execute("drop table places")
+		response = self.server.handle_request(None, "alice", {"REQUEST_METHOD":"GET", "QUERY_STRING":"pulled_version=0"})
+		self.assertTrue(isinstance(response, basestring))
+		self.assertTrue("error" in json.loads(response))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,160 @@
+# coding=utf-8
+# pycoact/tests/harness.py
+# Last modified: 17 October 2026
+#
+# What the tests of SharedTable clients and the WSGI server share. Each
+# test gets a fresh database in a temporary directory, served by
+# CoactApplication (see server/wsgi.py) on a port of its own for each
+# user, and clients with local stores there too.
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+import SocketServer
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+sys.path.insert(1, "../..")
+from pycoact.server.table import SharedTableServer
+from pycoact.server.wsgi import CoactApplication
+from pycoact.server.meta import connect, get_table_version
+from pycoact.client import transport, store_sqlite
+from pycoact.client.table import SharedTableError
+from pycoact.client.table_csv import SharedTableCSV
+
+#=============================================================================
+# Test HTTP servers
+#=============================================================================
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+	daemon_threads = True
+
+class QuietRequestHandler(WSGIRequestHandler):
+	def log_message(self, *args):
+		pass
+
+# Serve application on a free port, attributing every request to username
+# as a web server in front of it would after authenticating the user.
+def start_server(application, username):
+	def user_application(environ, start_response):
+		environ['REMOTE_USER'] = username
+		return application(environ, start_response)
+	httpd = make_server('127.0.0.1', 0, user_application, server_class=ThreadingWSGIServer, handler_class=QuietRequestHandler)
+	thread = threading.Thread(target=httpd.serve_forever)
+	thread.daemon = True
+	thread.start()
+	return httpd
+
+header = ['Name', 'City', 'Age']
+cities = ['Paris', 'London', 'Rome']
+
+def people(count):
+	return [header] + [['Person %d' % i, cities[i % len(cities)], str(20 + i)] for i in range(1, count + 1)]
+
+#=============================================================================
+# The base class of the tests
+#=============================================================================
+
+# Subclasses set wire_format to "binary" to run the same tests with the
+# binary wire format (see stbbin.py), or store_format to "sqlite" to run
+# them with clients whose local stores are kept in SQLite (see
+# store_sqlite.py).
+class ServerTests(unittest.TestCase):
+	wire_format = "xml"
+	store_format = "xml"
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp(prefix="coact-tests-")
+		self.db = os.path.join(self.directory, "db.db")
+		for tablename in ("people", "places"):
+			SharedTableServer(self.db, tablename, "stbcsv").create()
+		self.application = CoactApplication(self.directory, debug_level=0)
+		self.servers = {}
+
+	def tearDown(self):
+		for httpd in self.servers.values():
+			httpd.shutdown()
+			httpd.server_close()
+		self.application.pool.close()
+		transport.transports.clear()
+		shutil.rmtree(self.directory, True)
+
+	# A client of username's with a local store of its own called name.
+	def client(self, username, name=None, tablename="people"):
+		httpd = self.servers.get(username)
+		if httpd is None:
+			httpd = self.servers[username] = start_server(self.application, username)
+		filename = os.path.join(self.directory, "%s-%s.xml" % (name or username, tablename))
+		fh = open(filename, "w")
+		fh.write("<shared_table><repository><url>http://127.0.0.1:%d/db/%s.stbcsv</url>"
+			"<realm>coact</realm><username>%s</username><password>secret</password>"
+			"<pulled_version>0</pulled_version></repository></shared_table>\n" % (httpd.server_port, tablename, username))
+		fh.close()
+		if self.store_format == "sqlite":
+			xml_filename, filename = filename, filename[:-len(".xml")] + ".db"
+			store_sqlite.convert(xml_filename, filename)
+		return self.reopen(filename)
+
+	# A fresh client object for a local store which has been saved
+	def reopen(self, filename):
+		client = SharedTableCSV(filename)
+		client.wire_format = self.wire_format
+		return client
+
+	def read(self, client):
+		return list(client.csv_reader())
+
+	def write(self, client, rows):
+		writer = client.csv_writer()
+		for row in rows:
+			writer.writerow(row)
+
+	# Change cells of the rows of client, given as {(row, column): value}
+	def edit(self, client, changes):
+		rows = self.read(client)
+		for (row, column), value in changes.items():
+			rows[row][column] = value
+		self.write(client, rows)
+
+	# Have alice create the table with the rows given.
+	def seed(self, rows, tablename="people"):
+		alice = self.client("alice", tablename=tablename)
+		alice.new_table = True
+		self.read(alice)
+		self.write(alice, rows)
+		alice.push()
+		alice.new_table = False
+		return alice
+
+	def table_version(self, tablename="people"):
+		conn = connect(self.db)
+		try:
+			return get_table_version(conn, tablename)
+		finally:
+			conn.close()
+
+	def server_rows(self, tablename="people"):
+		conn = connect(self.db)
+		try:
+			return dict(conn.execute("select id, data from %s where deleted = 0" % tablename))
+		finally:
+			conn.close()
+
+	# Record the requests which client sends and the responses it gets
+	# (their rows as (id, attributes) before they are merged) and fail
+	# the request numbered fail_at, counting from 1.
+	def spy(self, client, fail_at=None):
+		exchanges = []
+		post_xml = client.post_xml
+		def spying_post_xml(xml, transport=None):
+			if fail_at is not None and len(exchanges) + 1 == fail_at:
+				raise SharedTableError("connection lost")
+			resp = post_xml(xml, transport)
+			rows = resp.find('rows')
+			exchanges.append((xml, [(int(row.get('id')), dict(row.attrib)) for row in (rows if rows is not None else [])]))
+			return resp
+		client.post_xml = spying_post_xml
+		return exchanges
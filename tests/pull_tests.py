@@ -0,0 +1,120 @@
+#! /usr/bin/python
+# coding=utf-8
+# pycoact/tests/pull_tests.py
+# Last modified: 17 October 2026
+#
+# Tests of pulls: pages which resume from a continuation, responses
+# which are still being sent while others push, and pulls which wait
+# for a change.
+#
+# Usage: pull_tests.py [-v] [<test name>...]
+#
+
+import sys
+import time
+import unittest
+import threading
+import StringIO
+import xml.etree.cElementTree as ET
+
+sys.path.insert(1, "../..")
+from pycoact import stbbin
+from pycoact.server.table import SharedTableServer
+from pycoact.client.table import SharedTableError
+from harness import ServerTests, people
+
+class PullTests(ServerTests):
+	def test_paged_pull_resumes_from_continuation(self):
+		alice = self.seed(people(10))
+		bob = self.client("bob")
+		exchanges = self.spy(bob, fail_at=3)
+		self.assertRaises(SharedTableError, bob.pull, 3)
+		self.assertEqual([row[0] for row in exchanges[0][1]], [0, 1, 2, 3])
+		self.assertEqual([row[0] for row in exchanges[1][1]], [0, 4, 5, 6])
+
+		# Each page was saved along with where the next one starts.
+		bob = self.reopen(bob.local_filename)
+		continuation = bob.xml_repository.find('continuation')
+		self.assertNotEqual(continuation, None)
+		self.assertEqual(continuation.get('id'), '6')
+		self.assertEqual(self.read(bob), people(10)[:7])
+
+		# Rows changed in the meantime, both those already pulled and
+		# those still to come, turn up in later pages.
+		self.edit(alice, {(1, 1): 'Oslo', (8, 1): 'Lima'})
+		alice.push()
+		exchanges = self.spy(bob)
+		bob.pull(3)
+		self.assertNotEqual(exchanges[0][0].find('continuation'), None)
+		self.assertEqual([row[0] for row in exchanges[0][1]], [0, 7, 9, 10])
+		self.assertEqual([row[0] for row in exchanges[1][1]], [0, 1, 8])
+		self.assertEqual(self.read(bob), self.read(alice))
+		self.assertEqual(bob.xml_repository.find('continuation'), None)
+		self.assertEqual(self.reopen(bob.local_filename).xml_pulled_version.text, str(self.table_version()))
+
+	# Neither a pull nor a sync which is still being sent may keep
+	# others from pushing.
+	def test_push_while_responses_are_sent(self):
+		alice = self.seed(people(3000))
+		carol = self.client("carol")
+		server = SharedTableServer(self.db, "people", "stbcsv")
+		content_type = stbbin.content_type if self.wire_format == "binary" else None
+
+		def request(top):
+			if content_type is None:
+				return StringIO.StringIO(ET.tostring(top, encoding='utf-8'))
+			return StringIO.StringIO(stbbin.encode_tree(top))
+
+		pull = ET.Element('request')
+		ET.SubElement(pull, 'type').text = 'pull'
+		ET.SubElement(pull, 'pulled_version').text = '0'
+		response = iter(server.handle_request(request(pull), "carol", content_type))
+		first = response.next()
+
+		self.edit(alice, {(1, 1): 'Oslo'})
+		self.assertEqual(alice.push(), (1, 0))
+		self.assertTrue(len(first + "".join(response)) > 65536)
+
+		self.read(carol)
+		sync, count_push_changes = carol.sync_request()
+		response = iter(server.handle_request(request(sync), "carol", content_type))
+		first = response.next()
+
+		self.edit(alice, {(2, 1): 'Oslo'})
+		self.assertEqual(alice.push(), (1, 0))
+		self.assertTrue(len(first + "".join(response)) > 65536)
+		server.conn.close()
+
+	# A pull which waits for a change is woken by a push. It gives its
+	# database handle back to the pool while it waits.
+	def test_push_wakes_waiting_pull(self):
+		alice = self.seed(people(3))
+		bob = self.client("bob")
+		bob.pull()
+		results = []
+		thread = threading.Thread(target=lambda: results.append(bob.pull(wait=30)))
+		thread.start()
+		notifier = self.application.notifier
+		pool = self.application.pool
+		deadline = time.time() + 10
+		while notifier.waiting == 0 and time.time() < deadline:
+			time.sleep(0.01)
+		self.assertEqual(notifier.waiting, 1)
+		self.assertEqual(len(pool.idle), pool.opened)
+
+		self.edit(alice, {(1, 1): 'Oslo'})
+		alice.push()
+		thread.join(10)
+		self.assertFalse(thread.is_alive())
+		self.assertEqual(results, [(1, 0)])
+		self.assertEqual(notifier.woken, 1)
+		self.assertEqual(self.read(bob), self.read(alice))
+
+class BinaryPullTests(PullTests):
+	wire_format = "binary"
+
+class SqlitePullTests(PullTests):
+	store_format = "sqlite"
+
+if __name__ == "__main__":
+	unittest.main()
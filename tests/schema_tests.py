@@ -0,0 +1,52 @@
+#! /usr/bin/python
+# coding=utf-8
+# pycoact/tests/schema_tests.py
+# Last modified: 17 October 2026
+#
+# Tests of schema operations: columns added, renamed and dropped by one
+# client, and replayed by others over their unpushed edits.
+#
+# Usage: schema_tests.py [-v] [<test name>...]
+#
+
+import sys
+import unittest
+
+sys.path.insert(1, "../..")
+from harness import ServerTests, people
+
+class SchemaTests(ServerTests):
+	def test_schema_ops_replayed_over_pending_edits(self):
+		alice = self.seed(people(4))
+		bob = self.client("bob")
+		bob.pull()
+		self.edit(bob, {(1, 0): 'Bob', (4, 2): '64'})
+		self.write(bob, self.read(bob) + [['Newcomer', 'Rome', '1']])
+
+		alice.csv_rows = None
+		alice.add_column('Name', 'Email')
+		alice.rename_column('City', 'Town')
+		alice.drop_column('Age')
+
+		# Bob's push is refused until he has applied the operations to
+		# his own copies of the rows, edited or new, and then goes
+		# through.
+		bob.csv_rows = None
+		bob.push()
+		rows = self.read(bob)
+		self.assertEqual(rows[0], ['Name', 'Email', 'Town'])
+		self.assertEqual(rows[1], ['Bob', '', 'London'])
+		self.assertEqual(rows[-1], ['Newcomer', '', 'Rome'])
+		self.assertEqual(self.server_rows()[1], 'Bob,,London')
+
+		alice.pull()
+		self.assertEqual(self.read(alice), rows)
+
+class BinarySchemaTests(SchemaTests):
+	wire_format = "binary"
+
+class SqliteSchemaTests(SchemaTests):
+	store_format = "sqlite"
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,74 @@
+#! /usr/bin/python
+# coding=utf-8
+# pycoact/tests/store_tests.py
+# Last modified: 17 October 2026
+#
+# Tests of the conversion of local stores from XML to SQLite and back
+# (see client/store_sqlite.py). The behaviour of clients with SQLite
+# local stores is tested by running the other tests with them.
+#
+# Usage: store_tests.py [-v] [<test name>...]
+#
+
+import os
+import sys
+import unittest
+import xml.etree.cElementTree as ET
+
+sys.path.insert(1, "../..")
+from pycoact.client import store_sqlite
+from harness import ServerTests, people
+
+class StoreTests(ServerTests):
+	# The contents of a local store as XML: the repository and the rows
+	# of each container as (attributes, text)
+	def contents(self, filename):
+		root = ET.parse(filename).getroot()
+		contents = {'repository': ET.tostring(root.find('repository'))}
+		for tag in store_sqlite.row_containers:
+			container = root.find(tag)
+			contents[tag] = [(row.attrib, row.text) for row in (container if container is not None else [])]
+		return contents
+
+	def test_convert_round_trip(self):
+		alice = self.seed(people(5))
+		bob = self.client("bob")
+		bob.pull()
+
+		# Leave bob with a conflict, a changed row, and a new row.
+		self.edit(alice, {(1, 2): '31'})
+		alice.push()
+		rows = self.read(bob)
+		rows[1][2] = '41'
+		rows[2][1] = 'Zurich'
+		self.write(bob, rows + [['Newcomer', 'Rome', '1']])
+		self.assertEqual(bob.pull(), (1, 1))
+		bob.save()
+		self.read(bob)
+		self.assertEqual(len(bob.get_conflicts()), 1)
+
+		db_filename = os.path.join(self.directory, "bob-people.db")
+		xml_filename = os.path.join(self.directory, "bob-people-exported.xml")
+		store_sqlite.convert(bob.local_filename, db_filename)
+		self.assertRaises(ValueError, store_sqlite.convert, bob.local_filename, db_filename)
+		store_sqlite.export(db_filename, xml_filename)
+		contents = self.contents(bob.local_filename)
+		self.assertEqual(self.contents(xml_filename), contents)
+		self.assertEqual([len(contents[tag]) for tag in store_sqlite.row_containers], [1, 6, 1])
+
+		# A client with the converted store carries on where bob left off.
+		converted = self.reopen(db_filename)
+		self.assertTrue(converted.sqlite_store)
+		self.assertEqual(self.read(converted), self.read(bob))
+		self.assertEqual([conflict.get_row() for conflict in converted.get_conflicts()],
+			[conflict.get_row() for conflict in bob.get_conflicts()])
+		rows = self.read(converted)
+		converted.get_conflicts()[0].resolve()
+		self.write(converted, rows)
+		self.assertEqual(converted.push(), (3, 0))
+		converted.save()
+		alice.pull()
+		self.assertEqual(self.read(alice), self.read(self.reopen(db_filename)))
+
+if __name__ == "__main__":
+	unittest.main()
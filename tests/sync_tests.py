@@ -0,0 +1,53 @@
+#! /usr/bin/python
+# coding=utf-8
+# pycoact/tests/sync_tests.py
+# Last modified: 17 October 2026
+#
+# Tests of syncs, which push and pull in one round trip, and of the
+# conflicts which they report.
+#
+# Usage: sync_tests.py [-v] [<test name>...]
+#
+
+import sys
+import unittest
+
+sys.path.insert(1, "../..")
+from harness import ServerTests, people
+
+class SyncTests(ServerTests):
+	def test_sync_conflicts(self):
+		alice = self.seed(people(5))
+		bob = self.client("bob")
+		bob.pull()
+
+		self.edit(alice, {(1, 2): '31'})
+		alice.push()
+		self.edit(bob, {(1, 2): '41', (2, 2): '42'})
+		(push_changes, push_conflicts), (pull_changes, pull_conflicts) = bob.sync()
+		self.assertEqual((push_changes, push_conflicts), (2, 1))
+		self.assertEqual(pull_conflicts, 1)
+
+		rows = self.read(bob)
+		conflicts = bob.get_conflicts()
+		self.assertEqual(len(conflicts), 1)
+		self.assertEqual(conflicts[0].get_row(), (1, ['Person 1', 'London', '31']))
+		self.assertEqual(rows[1][2], '41')
+		self.assertEqual(self.server_rows()[2], 'Person 2,Rome,42')
+
+		# Once resolved, bob's version wins.
+		conflicts[0].resolve()
+		self.write(bob, rows)
+		self.assertEqual(bob.sync()[0], (1, 0))
+		alice.sync()
+		self.assertEqual(self.read(alice), self.read(bob))
+		self.assertEqual(self.read(alice)[1], ['Person 1', 'London', '41'])
+
+class BinarySyncTests(SyncTests):
+	wire_format = "binary"
+
+class SqliteSyncTests(SyncTests):
+	store_format = "sqlite"
+
+if __name__ == "__main__":
+	unittest.main()
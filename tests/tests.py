@@ -38,7 +38,8 @@ class TestRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 			self.send_response(200)
 			self.send_header("Content-Type", "application/xml")
 			self.end_headers()
-			self.wfile.write(response)
+			for chunk in response:
+				self.wfile.write(chunk)
 
 		except Exception as e:
 			import traceback, sys
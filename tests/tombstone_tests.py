@@ -0,0 +1,70 @@
+#! /usr/bin/python
+# coding=utf-8
+# pycoact/tests/tombstone_tests.py
+# Last modified: 17 October 2026
+#
+# Tests of deletions: the tombstones which pulls send, their compaction,
+# and the reset of clients which have missed purged tombstones.
+#
+# Usage: tombstone_tests.py [-v] [<test name>...]
+#
+
+import sys
+import unittest
+
+sys.path.insert(1, "../..")
+from pycoact.server.meta import connect
+from pycoact.server.compact import compact
+from harness import ServerTests, people
+
+class TombstoneTests(ServerTests):
+	def test_tombstones_compaction_and_reset(self):
+		alice = self.seed(people(5))
+		bob = self.client("bob")
+		carol = self.client("carol")
+		bob.pull()
+		carol.pull()
+		self.edit(carol, {(2, 2): '99'})
+
+		# A deletion reaches those who pull as a tombstone.
+		self.read(alice)
+		alice.delete_row(2)
+		self.assertEqual(alice.push(), (1, 0))
+		bob.pull()
+		self.assertEqual(self.read(bob), self.read(alice))
+		self.assertFalse(2 in self.server_rows())
+
+		# Carol has not pulled for so long that she no longer holds
+		# compaction back, so once bob's next pull has told the server
+		# that he has the tombstone, it is purged.
+		bob.pull()
+		conn = connect(self.db)
+		conn.execute("update coact_clients set last_seen = 0 where username = 'carol'")
+		conn.commit()
+		count, purged_version = compact(conn, "people")
+		conn.close()
+		self.assertEqual(count, 1)
+
+		# Carol is told to start over. The row she changed, which has
+		# since been deleted, becomes a new row.
+		exchanges = self.spy(carol)
+		carol.pull()
+		self.assertEqual(len(exchanges), 2)
+		rows = self.read(carol)
+		self.assertEqual(rows[:-1], self.read(alice))
+		self.assertEqual(rows[-1], ['Person 2', 'Rome', '99'])
+
+		# It is pushed as such and gets an id which has never been used.
+		self.assertEqual(carol.push(), (1, 0))
+		self.assertEqual(self.server_rows()[6], 'Person 2,Rome,99')
+		alice.pull()
+		self.assertEqual(self.read(alice), self.read(carol))
+
+class BinaryTombstoneTests(TombstoneTests):
+	wire_format = "binary"
+
+class SqliteTombstoneTests(TombstoneTests):
+	store_format = "sqlite"
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,218 @@
+#! /usr/bin/python
+# coding=utf-8
+# pycoact/tests/transport_tests.py
+# Last modified: 17 October 2026
+#
+# Tests of the HTTP transport of SharedTable (see client/transport.py)
+# against a test server which keeps connections open, as HTTP/1.1
+# allows, and demands digest authentication.
+#
+# Usage: transport_tests.py [-v] [<test name>...]
+#
+
+import sys
+import hashlib
+import urllib2
+import httplib
+import unittest
+import threading
+import SocketServer
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler, ServerHandler
+
+sys.path.insert(1, "../..")
+from pycoact.client.transport import Transport
+
+#=============================================================================
+# Test HTTP server
+#=============================================================================
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+	daemon_threads = True
+
+class KeepAliveServerHandler(ServerHandler):
+	http_version = "1.1"
+
+# Handles requests on the same connection until the client closes it or
+# the application asks for it to be closed (see DigestApplication). The
+# environ of each request identifies its connection by the client's port.
+class KeepAliveRequestHandler(WSGIRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, *args):
+		pass
+
+	def handle(self):
+		while True:
+			self.raw_requestline = self.rfile.readline(65537)
+			if not self.raw_requestline or not self.parse_request():
+				return
+			environ = self.get_environ()
+			environ['test.connection'] = self.client_address[1]
+			environ['test.close'] = lambda: setattr(self, 'close_connection', 1)
+			handler = KeepAliveServerHandler(self.rfile, self.wfile, self.get_stderr(), environ)
+			handler.request_handler = self
+			handler.run(self.server.get_app())
+			if self.close_connection:
+				return
+
+def md5(data):
+	return hashlib.md5(data).hexdigest()
+
+# Answers POSTs with "OK" if they carry digest credentials for username
+# and password with the current nonce, and with a challenge otherwise.
+# Each request is logged as (connection, whether it had credentials,
+# status).
+#
+# If hang_up is set, the connection is closed after the next response
+# without telling the client, as servers do with connections left idle.
+# If cut_short is set, the next response is cut off part way through.
+class DigestApplication(object):
+	realm = "coact"
+
+	def __init__(self, username, password):
+		self.username = username
+		self.password = password
+		self.nonce = "nonce1"
+		self.stale_nonces = set()
+		self.nonce_counts = []
+		self.log = []
+		self.hang_up = False
+		self.cut_short = False
+
+	def __call__(self, environ, start_response):
+		environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+		authorization = environ.get('HTTP_AUTHORIZATION')
+		status, stale = self.check(authorization, environ['PATH_INFO'])
+		self.log.append((environ['test.connection'], authorization is not None, int(status[:3])))
+		if self.hang_up or self.cut_short:
+			environ['test.close']()
+			self.hang_up = False
+		if status.startswith("401"):
+			challenge = 'Digest realm="%s", nonce="%s", qop="auth", opaque="x"' % (self.realm, self.nonce)
+			if stale:
+				challenge += ', stale=true'
+			start_response(status, [('WWW-Authenticate', challenge), ('Content-Length', '0')])
+			return [""]
+		if self.cut_short:
+			self.cut_short = False
+			start_response(status, [('Content-Type', 'text/plain'), ('Content-Length', '100')])
+			return ["O"]
+		start_response(status, [('Content-Type', 'text/plain'), ('Content-Length', '2')])
+		return ["OK"]
+
+	# Check a request's Authorization header. Returns its status and
+	# whether its nonce was stale.
+	def check(self, authorization, path):
+		if authorization is None or not authorization.startswith("Digest "):
+			return "401 Unauthorized", False
+		fields = urllib2.parse_keqv_list(urllib2.parse_http_list(authorization[len("Digest "):]))
+		if fields['nonce'] in self.stale_nonces:
+			return "401 Unauthorized", True
+		if fields['nonce'] != self.nonce or fields['uri'] != path or fields.get('opaque') != "x":
+			return "401 Unauthorized", False
+		ha1 = md5("%s:%s:%s" % (self.username, self.realm, self.password))
+		ha2 = md5("POST:%s" % path)
+		expected = md5("%s:%s:%s:%s:auth:%s" % (ha1, self.nonce, fields['nc'], fields['cnonce'], ha2))
+		if fields['username'] != self.username or fields['response'] != expected:
+			return "401 Unauthorized", False
+		self.nonce_counts.append(int(fields['nc'], 16))
+		return "200 OK", False
+
+	def new_nonce(self):
+		self.stale_nonces.add(self.nonce)
+		self.nonce += "x"
+
+#=============================================================================
+# The tests
+#=============================================================================
+
+class TransportTests(unittest.TestCase):
+	def setUp(self):
+		self.application = DigestApplication("alice", "secret")
+		self.httpd = make_server('127.0.0.1', 0, self.application, server_class=ThreadingWSGIServer, handler_class=KeepAliveRequestHandler)
+		thread = threading.Thread(target=self.httpd.serve_forever)
+		thread.daemon = True
+		thread.start()
+		self.url = "http://127.0.0.1:%d/db/people.stbcsv" % self.httpd.server_port
+
+	def tearDown(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+
+	def transport(self, password="secret"):
+		transport = Transport(self.url, "coact", "alice", password)
+		self.addCleanup(transport.close)
+		return transport
+
+	def post(self, transport):
+		return transport.post("<request />", {'Content-Type': 'application/xml'})
+
+	# The connections of the requests logged by the application, each as
+	# the number of the first request which used it
+	def connections(self):
+		ports = [port for port, authorized, status in self.application.log]
+		return [ports.index(port) for port in ports]
+
+	# The first request is challenged. Those after it reuse the connection
+	# and send their credentials at once.
+	def test_reuses_connection_and_credentials(self):
+		transport = self.transport()
+		responses = [self.post(transport) for i in range(3)]
+		self.assertEqual([response.read() for response in responses], ["OK"] * 3)
+		self.assertEqual([(authorized, status) for port, authorized, status in self.application.log],
+			[(False, 401), (True, 200), (True, 200), (True, 200)])
+		self.assertEqual(self.connections(), [0, 0, 0, 0])
+		self.assertEqual(self.application.nonce_counts, [1, 2, 3])
+		self.assertEqual([response.round_trips for response in responses], [3, 1, 1])
+		self.assertEqual((transport.stats['connections'], transport.stats['challenges']), (1, 1))
+
+	# A stale nonce is answered once more with the new one.
+	def test_stale_nonce(self):
+		transport = self.transport()
+		self.post(transport)
+		self.application.new_nonce()
+		self.assertEqual(self.post(transport).read(), "OK")
+		self.assertEqual([(authorized, status) for port, authorized, status in self.application.log[2:]],
+			[(True, 401), (True, 200)])
+		self.assertEqual(self.application.nonce_counts, [1, 1])
+		self.assertEqual(self.post(transport).read(), "OK")
+		self.assertEqual(self.application.log[-1][1:], (True, 200))
+		self.assertEqual(transport.stats['challenges'], 2)
+
+	# A wrong password is challenged once and then given up on.
+	def test_wrong_password(self):
+		transport = self.transport("wrong")
+		try:
+			self.post(transport)
+			self.fail("post() should have failed")
+		except urllib2.HTTPError as e:
+			self.assertEqual(e.code, 401)
+		self.assertEqual([(authorized, status) for port, authorized, status in self.application.log],
+			[(False, 401), (True, 401)])
+
+	# A request on a connection which the server has closed without a
+	# word is sent again on a new one.
+	def test_resends_on_closed_connection(self):
+		transport = self.transport()
+		self.post(transport)
+		self.application.hang_up = True
+		self.post(transport)
+		self.assertEqual(self.post(transport).read(), "OK")
+		self.assertEqual([(authorized, status) for port, authorized, status in self.application.log],
+			[(False, 401), (True, 200), (True, 200), (True, 200)])
+		self.assertEqual(self.connections(), [0, 0, 0, 3])
+		self.assertEqual(transport.stats['connections'], 2)
+
+	# A request which the server has started to answer is not sent
+	# again, since the server may have applied it.
+	def test_no_resend_once_answered(self):
+		transport = self.transport()
+		self.post(transport)
+		self.application.cut_short = True
+		self.assertRaises(httplib.IncompleteRead, self.post, transport)
+		self.assertEqual(len(self.application.log), 3)
+		self.assertEqual(self.post(transport).read(), "OK")
+		self.assertEqual(self.connections(), [0, 0, 0, 3])
+
+if __name__ == "__main__":
+	unittest.main()